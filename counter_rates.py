@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Server-side counter rates for the RDMA exporters
+Keeps a short per-series history and exports per-second rate gauges
+"""
+
+import threading
+import time
+from collections import deque
+
+# Modulus of counters declared 32-bit (e.g. mlx5 Q counters such as out_of_sequence)
+WRAP_32 = 1 << 32
+
+
+class RateTracker:
+    """Derives per-second rates from counter samples with precise timestamps
+
+    Each series keeps (timestamp, adjusted value) points for 'window'
+    seconds. Counter resets, and wraps of the families listed in 'wrap_32',
+    are folded into a per-series offset so the adjusted value never
+    decreases. Any decrease of another counter is a reset: guessing a wrap
+    from the values would turn the reset of a 64-bit counter sitting near
+    2^32 into a rate spike. The rate is computed between the oldest and
+    newest points in the window.
+    """
+
+    def __init__(self, families, window=15.0, wrap_32=()):
+        # rate family base name -> HELP text for its '<name>_rate' gauge
+        self.families = families
+        self.window = window
+        self.wrap_32 = frozenset(wrap_32)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, family, labels, value, timestamp=None):
+        """Record one counter sample; 'labels' is the rendered label string"""
+        if timestamp is None:
+            timestamp = time.monotonic()
+        key = (family, labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # [points, last raw value, offset]
+                series = self._series[key] = [deque(), value, 0]
+            points, last_raw, offset = series
+            if value < last_raw:
+                if family in self.wrap_32 and last_raw - value > WRAP_32 // 2:
+                    offset += WRAP_32
+                else:
+                    # Reset: the counter restarted from zero
+                    offset += last_raw
+                series[2] = offset
+            series[1] = value
+            points.append((timestamp, value + offset))
+            while len(points) > 2 and timestamp - points[0][0] > self.window:
+                points.popleft()
+
+    def rate(self, family, labels):
+        """Per-second rate of a series, or None with fewer than two points"""
+        with self._lock:
+            series = self._series.get((family, labels))
+            if series is None or len(series[0]) < 2:
+                return None
+            (t0, v0), (t1, v1) = series[0][0], series[0][-1]
+        if t1 <= t0:
+            return None
+        return (v1 - v0) / (t1 - t0)
+
+    def expire(self, now=None):
+        """Forget series that have not been observed for a whole window"""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            stale = [key for key, series in self._series.items()
+                     if now - series[0][-1][0] > self.window]
+            for key in stale:
+                del self._series[key]
+
+    def render(self):
+        """Exposition lines for every '<family>_rate' gauge with a rate"""
+        self.expire()
+        with self._lock:
+            keys = sorted(self._series)
+        lines = []
+        current = None
+        for family, labels in keys:
+            rate = self.rate(family, labels)
+            if rate is None:
+                continue
+            if family != current:
+                current = family
+                lines.append(f"# HELP {family}_rate {self.families.get(family, family)} per second")
+                lines.append(f"# TYPE {family}_rate gauge")
+            lines.append(f'{family}_rate{{{labels}}} {rate:.3f}')
+        return lines
@@ -1,16 +1,25 @@
 #!/usr/bin/env python3
 """
 ESXi Statistics Exporter for Prometheus
-Collects pause frame statistics from ESXi hosts
+Collects pause frame and pNic statistics of the RDMA uplinks of ESXi hosts
 """
 
-from flask import Flask, Response
+import argparse
+import concurrent.futures
 import subprocess
 import re
+import threading
+import time
 
-app = Flask(__name__)
+import exporter_selfstats
+import exposition
+import sample_ring
+from counter_rates import RateTracker
+from exporter_http import serve
+from exporter_selfstats import PROFILER, instrumented, record_error
+from ssh_pool import SSHError, SSHPool
 
-# ESXi Host Configuration
+# ESXi Host Configuration; 'vmnics' is used until (or unless) discovery finds the RDMA uplinks
 ESXI_HOSTS = {
     "esxi1": {
         "ip": "192.168.50.32",
@@ -26,101 +35,568 @@ ESXI_HOSTS = {
     }
 }
 
-def get_esxi_pause_stats(host_name, host_config):
-    """Get pause frame statistics from ESXi host"""
+# One persistent SSH session per ESXi host
+SSH_POOL = SSHPool()
+
+# Marker line opening each vmnic's section of the batched vsish output
+SECTION_MARKER = '@@vmnic '
+
+# Table-driven export of vsish pNic counters: the first pattern matching the
+# whole counter name decides the family; named groups become labels, followed
+# by the rule's fixed labels. The short names come from the 'packet stats'
+# block, the spaced ones from the driver's generic statistics after
+# 'private stats:' (see vsish_pnic_stats_nmlx5.txt).
+VSISH_COUNTER_TABLE = [
+    (r'rxPauseCtrlPhy', 'esxi_pause_rx_phy'),
+    (r'txPauseCtrlPhy', 'esxi_pause_tx_phy'),
+    (r'rx_global_pause', 'esxi_pause_rx_global'),
+    (r'tx_global_pause', 'esxi_pause_tx_global'),
+    (r'rx_global_pause_duration', 'esxi_pause_rx_duration'),
+    (r'tx_global_pause_duration', 'esxi_pause_tx_duration'),
+    (r'rx_global_pause_transition', 'esxi_pause_rx_transitions'),
+    (r'tx_global_pause_transition', 'esxi_pause_tx_transitions'),
+    (r'txPauseStormWarningEvents', 'esxi_pause_storm_warnings'),
+    (r'txPauseStormErrorEvents', 'esxi_pause_storm_errors'),
+    (r'(?P<direction>rx|tx)_prio(?P<priority>[0-7])_pause', 'esxi_pause_prio_frames'),
+    (r'(?P<direction>rx|tx)_prio(?P<priority>[0-7])_pause_duration', 'esxi_pause_prio_duration'),
+    (r'(?P<direction>rx|tx)_prio(?P<priority>[0-7])_pause_transition', 'esxi_pause_prio_transitions'),
+    (r'(?P<direction>rx|tx)bytes', 'esxi_nic_bytes'),
+    (r'(?P<direction>rx|tx)pkt', 'esxi_nic_packets'),
+    (r'(?P<direction>rx|tx)drp', 'esxi_nic_dropped'),
+    (r'(?P<direction>rx|tx)err', 'esxi_nic_errors'),
+    (r'Bytes received', 'esxi_nic_bytes', {'direction': 'rx'}),
+    (r'Bytes sent', 'esxi_nic_bytes', {'direction': 'tx'}),
+    (r'Packets received', 'esxi_nic_packets', {'direction': 'rx'}),
+    (r'Packets sent', 'esxi_nic_packets', {'direction': 'tx'}),
+    (r'Receive packets dropped', 'esxi_nic_dropped', {'direction': 'rx'}),
+    (r'Transmit packets dropped', 'esxi_nic_dropped', {'direction': 'tx'}),
+    (r'Total receive errors', 'esxi_nic_errors', {'direction': 'rx'}),
+    (r'Total transmit errors', 'esxi_nic_errors', {'direction': 'tx'}),
+    (r'(?P<counter>\w*(?:[Rr]ing_?[Ff]ull|out_of_buffer|OutOfBuffer)\w*)', 'esxi_nic_ring_full'),
+]
+VSISH_COUNTER_RULES = [(re.compile(rule[0]), rule[1], rule[2] if len(rule) > 2 else {})
+                       for rule in VSISH_COUNTER_TABLE]
+
+# "   name:value" lines of 'vsish -e cat /net/pNics/<vmnic>/stats'; names may
+# contain spaces ("Bytes received: 123"), and the first private counter
+# shares its line with the "private stats:" heading
+VSISH_COUNTER_RE = re.compile(r'^[ \t]*(?:private stats:[ \t]*)?([A-Za-z_][\w .-]*?)[ \t]*:[ \t]*(\d+)[ \t]*$',
+                              re.MULTILINE)
+
+# (family, type, help) in exposition order
+ESXI_FAMILIES = [
+    ('esxi_pause_rx_phy', 'counter', 'ESXi physical RX pause frames'),
+    ('esxi_pause_tx_phy', 'counter', 'ESXi physical TX pause frames'),
+    ('esxi_pause_rx_global', 'counter', 'ESXi global RX pause frames'),
+    ('esxi_pause_tx_global', 'counter', 'ESXi global TX pause frames'),
+    ('esxi_pause_rx_duration', 'counter', 'ESXi RX pause duration (microseconds)'),
+    ('esxi_pause_tx_duration', 'counter', 'ESXi TX pause duration (microseconds)'),
+    ('esxi_pause_rx_transitions', 'counter', 'ESXi RX pause state transitions'),
+    ('esxi_pause_tx_transitions', 'counter', 'ESXi TX pause state transitions'),
+    ('esxi_pause_storm_warnings', 'counter', 'ESXi pause storm warning events'),
+    ('esxi_pause_storm_errors', 'counter', 'ESXi pause storm error events'),
+    ('esxi_pause_prio_frames', 'counter', 'ESXi pause frames per PFC priority'),
+    ('esxi_pause_prio_duration', 'counter', 'ESXi pause duration per PFC priority (microseconds)'),
+    ('esxi_pause_prio_transitions', 'counter', 'ESXi pause state transitions per PFC priority'),
+    ('esxi_pause_time_fraction', 'gauge',
+     'Share of the last polling interval the link spent paused (priority "global" for link-level pause)'),
+    ('esxi_nic_bytes', 'counter', 'ESXi pNic bytes'),
+    ('esxi_nic_packets', 'counter', 'ESXi pNic packets'),
+    ('esxi_nic_dropped', 'counter', 'ESXi pNic dropped packets'),
+    ('esxi_nic_errors', 'counter', 'ESXi pNic errors'),
+    ('esxi_nic_ring_full', 'counter', 'ESXi pNic ring-full / out-of-buffer events'),
+    ('esxi_vmnic_info', 'gauge', 'Discovered ESXi pNic with its vSwitch and RDMA classification (always 1)'),
+]
+
+# Pause duration counters (and the priority they cover) feeding esxi_pause_time_fraction
+PAUSE_DURATION_FAMILIES = {
+    'esxi_pause_rx_duration': ('rx', 'global'),
+    'esxi_pause_tx_duration': ('tx', 'global'),
+}
+# nmlx5 reports pause durations in microseconds
+PAUSE_DURATION_SECONDS = 1e-6
+
+# counter name -> (family, label names, label values) or None
+_counter_exports = {}
+
+def classify_vsish_counter(name):
+    """(family, label names, label values) for a vsish counter name, or None; cached"""
+    try:
+        return _counter_exports[name]
+    except KeyError:
+        pass
+    export = None
+    for rule, family, labels in VSISH_COUNTER_RULES:
+        match = rule.fullmatch(name)
+        if match:
+            export = (family, tuple(rule.groupindex) + tuple(labels),
+                      match.groups() + tuple(labels.values()))
+            break
+    _counter_exports[name] = export
+    return export
+
+def vsish_batch_command(vmnics):
+    """One remote shell command dumping the stats of every vmnic in marked sections"""
+    return (f'for nic in {" ".join(vmnics)}; do echo "{SECTION_MARKER}$nic"; '
+            f'vsish -e cat /net/pNics/$nic/stats; done')
+
+def split_sections(output, marker=SECTION_MARKER):
+    """Split batched output into {section name: section text}"""
+    sections = {}
+    vmnic = None
+    lines = []
+    for line in output.split('\n'):
+        if line.startswith(marker):
+            if vmnic is not None:
+                sections[vmnic] = '\n'.join(lines)
+            vmnic = line[len(marker):].strip()
+            lines = []
+        elif vmnic is not None:
+            lines.append(line)
+    if vmnic is not None:
+        sections[vmnic] = '\n'.join(lines)
+    return sections
+
+def parse_vsish_stats(output):
+    """[(family, label names, label values, value)] for every known counter, in one pass
+
+    A series reported twice (rxbytes and 'Bytes received') keeps its first value.
+    """
+    samples = []
+    seen = set()
+    for match in VSISH_COUNTER_RE.finditer(output):
+        export = classify_vsish_counter(match.group(1))
+        if export is not None and export not in seen:
+            seen.add(export)
+            samples.append(export + (int(match.group(2)),))
+    return samples
+
+# Marker and commands of the batched discovery invocation
+DISCOVERY_MARKER = '@@esxcli '
+DISCOVERY_COMMANDS = {
+    'nics': 'esxcli network nic list',
+    'rdma': 'esxcli rdma device list',
+    'vswitch': 'esxcli network vswitch standard list',
+    'dvs': 'esxcli network vswitch dvs vmware list',
+    'vmknics': 'esxcli network ip interface list',
+    'rdma_vmknics': 'esxcli rdma device vmknic list',
+}
+# Standard port groups whose vSwitch uplinks count as RDMA uplinks
+RDMA_PORTGROUP_RE = re.compile(r'(?i)rdma|roce')
+
+def parse_esxcli_table(text):
+    """Rows of an esxcli table as dicts, using the dashed rule under the header for column spans"""
+    lines = text.split('\n')
+    for index in range(1, len(lines)):
+        if re.fullmatch(r'-+(\s+-+)*\s*', lines[index]):
+            break
+    else:
+        return []
+    starts = [match.start() for match in re.finditer(r'-+', lines[index])]
+    # A column runs up to the next one; the last one to the end of the line
+    spans = list(zip(starts, starts[1:] + [None]))
+    header = [lines[index - 1][start:end].strip() for start, end in spans]
+    return [{name: line[start:end].strip() for name, (start, end) in zip(header, spans)}
+            for line in lines[index + 1:] if line.strip()]
+
+def parse_esxcli_blocks(text):
+    """'Key: value' blocks of esxcli list output (one per vSwitch or vmknic) as dicts
+
+    A key without a value that opens deeper-indented 'Key: value' groups, like
+    the DVPort entries of a distributed switch, maps to a list of dicts, one
+    per group; groups are separated by blank lines.
+    """
+    blocks = []
+    nested = key_indent = None
+    for line in text.split('\n'):
+        if line and not line[0].isspace():
+            blocks.append({})
+            nested = key_indent = None
+            continue
+        if not blocks:
+            continue
+        if not line.strip():
+            if nested and nested[-1]:
+                nested.append({})
+            continue
+        if ':' not in line:
+            continue
+        indent = len(line) - len(line.lstrip())
+        key, _, value = line.strip().partition(':')
+        value = value.strip()
+        if key_indent is None:
+            key_indent = indent
+        if nested is not None and indent > key_indent:
+            if key in nested[-1]:
+                nested.append({})
+            nested[-1][key] = value
+        elif value:
+            nested = None
+            blocks[-1][key] = value
+        else:
+            nested = blocks[-1][key] = [{}]
+    for block in blocks:
+        for key, value in block.items():
+            if isinstance(value, list):
+                block[key] = [group for group in value if group] or ''
+    return blocks
+
+def classify_uplinks(sections):
+    """{vmnic: {'driver', 'link', 'vswitch', 'rdma_device'}} from the discovery sections
+
+    A vmnic is an RDMA uplink when it is an uplink of a vSwitch carrying an
+    RDMA port group: a standard port group whose name matches
+    RDMA_PORTGROUP_RE, or a port group holding a vmknic bound to an RDMA
+    device. Hosts only know distributed port groups by key (dvportgroup-N),
+    so on a DVS the bound vmknic is what marks one; its VDS port is looked up
+    in the DVPort entries of the DVS listing. Every nmlx5 uplink has a paired
+    vmrdma device whether or not RoCE traffic uses it, so the pairing is only
+    reported ('rdma_device'), not used to classify.
+    """
+    nics = {}
+    for row in parse_esxcli_table(sections.get('nics', '')):
+        if row.get('Name'):
+            nics[row['Name']] = {'driver': row.get('Driver', ''), 'link': row.get('Link Status', ''),
+                                 'vswitch': '', 'rdma_device': '', 'rdma': False}
+    for row in parse_esxcli_table(sections.get('rdma', '')):
+        uplink = row.get('Paired Uplink', '')
+        if uplink in nics:
+            nics[uplink]['rdma_device'] = row.get('Name', '')
+
+    vswitches = parse_esxcli_blocks(sections.get('vswitch', ''))
+    dvswitches = parse_esxcli_blocks(sections.get('dvs', ''))
+    # (DVS name, DVPort ID) -> DVPortgroup ID
+    dvports = {(block.get('Name', ''), port.get('Port ID', '')): port.get('DVPortgroup ID', '')
+               for block in dvswitches for port in block.get('DVPort') or ()}
+    bound = {row.get('Vmknic') for row in parse_esxcli_table(sections.get('rdma_vmknics', ''))}
+    # Standard port group names, and (DVS name, DVPortgroup ID) of distributed ones
+    rdma_portgroups = set()
+    for vmknic in parse_esxcli_blocks(sections.get('vmknics', '')):
+        if vmknic.get('Name') not in bound:
+            continue
+        dvs = vmknic.get('VDS Name', 'N/A')
+        if dvs != 'N/A':
+            portgroup = dvports.get((dvs, vmknic.get('VDS Port', '')))
+            if portgroup:
+                rdma_portgroups.add((dvs, portgroup))
+        else:
+            rdma_portgroups.add(vmknic.get('Portgroup', ''))
+
+    for block in vswitches:
+        portgroups = [name.strip() for name in block.get('Portgroups', '').split(',')]
+        rdma = any(name and (RDMA_PORTGROUP_RE.search(name) or name in rdma_portgroups) for name in portgroups)
+        classify_vswitch(nics, block, rdma)
+    for block in dvswitches:
+        rdma = any((block.get('Name', ''), port.get('DVPortgroup ID', '')) in rdma_portgroups
+                   for port in block.get('DVPort') or ())
+        classify_vswitch(nics, block, rdma)
+    return nics
+
+def classify_vswitch(nics, block, rdma):
+    """Record a vSwitch on its uplinks, marking them as RDMA uplinks when 'rdma'"""
+    for uplink in block.get('Uplinks', '').split(','):
+        uplink = uplink.strip()
+        if uplink in nics:
+            nics[uplink]['vswitch'] = block.get('Name', '')
+            nics[uplink]['rdma'] |= rdma
+
+class VmnicDiscovery:
+    """Per-host pNic inventory and RDMA-uplink classification, cached for 'ttl' seconds
+
+    Discovery is one batched esxcli invocation over the host's SSH session,
+    run from the polling task when the cache is stale; steady-state polls
+    only read the cache. If discovery fails the previous result, or else the
+    configured 'vmnics', is used and discovery is retried on the next poll;
+    if it finds no RDMA uplink the previous result is kept for 'ttl'.
+    """
+
+    def __init__(self, ttl=300.0):
+        self.ttl = ttl
+        # host name -> (nics from classify_uplinks, time.monotonic() of discovery)
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def nics(self, host_name, host_config, connection):
+        """Cached {vmnic: info} of a host (may be empty before the first successful discovery)"""
+        with self._lock:
+            cached = self._cache.get(host_name)
+        if self.ttl <= 0:
+            return {}
+        if cached is not None and time.monotonic() - cached[1] < self.ttl:
+            return cached[0]
+
+        command = '; '.join(f'echo "{DISCOVERY_MARKER}{name}"; {cmd}' for name, cmd in DISCOVERY_COMMANDS.items())
+        try:
+            result = connection.run(command, timeout=10)
+            nics = classify_uplinks(split_sections(result.stdout, DISCOVERY_MARKER))
+        except Exception as e:
+            print(f"vmnic discovery failed for {host_name}: {e}")
+            record_error()
+            # Not cached, so the next poll tries again
+            return cached[0] if cached is not None else {}
+        if not any(info['rdma'] for info in nics.values()):
+            if cached is not None:
+                nics = cached[0]
+            elif nics:
+                print(f"No RDMA uplinks discovered on {host_name}; using {host_config['vmnics']}")
+        elif cached is None or cached[0] != nics:
+            rdma = sorted(name for name, info in nics.items() if info['rdma'])
+            print(f"Discovered RDMA uplinks on {host_name}: {', '.join(rdma)}")
+        with self._lock:
+            self._cache[host_name] = (nics, time.monotonic())
+        return nics
+
+    def vmnics(self, host_name, host_config, connection):
+        """RDMA uplinks to collect, falling back to the configured vmnics"""
+        nics = self.nics(host_name, host_config, connection)
+        rdma = sorted(name for name, info in nics.items() if info['rdma'])
+        return rdma or host_config["vmnics"], nics
+
+DISCOVERY = VmnicDiscovery()
+
+def format_vmnic_info(host_name, host_ip, nics):
+    """esxi_vmnic_info lines for every discovered pNic"""
+    return [f'esxi_vmnic_info{{host="{host_name}",vmnic="{vmnic}",esxi_ip="{host_ip}",'
+            f'driver="{info["driver"]}",link="{info["link"]}",vswitch="{info["vswitch"]}",'
+            f'rdma_device="{info["rdma_device"]}",rdma="{str(info["rdma"]).lower()}"}} 1'
+            for vmnic, info in sorted(nics.items())]
+
+# Pause duration rates between polls; window 0 keeps just the last two samples
+PAUSE_RATES = RateTracker({}, window=0.0)
+
+def format_vmnic_stats(host_name, host_ip, vmnic, output, collected_at):
+    """Exposition lines for one vmnic's vsish output, plus its pause-time fractions"""
     metrics = []
+    base = f'host="{host_name}",vmnic="{vmnic}",esxi_ip="{host_ip}"'
+    for family, names, values, value in parse_vsish_stats(output):
+        labels = base + ''.join(f',{name}="{label}"' for name, label in zip(names, values))
+        metrics.append(f'{family}{{{labels}}} {value}')
 
+        if family in PAUSE_DURATION_FAMILIES:
+            direction, priority = PAUSE_DURATION_FAMILIES[family]
+        elif family == 'esxi_pause_prio_duration':
+            direction, priority = values
+        else:
+            continue
+        key = f'{base},direction="{direction}",priority="{priority}"'
+        PAUSE_RATES.observe('pause_duration', key, value, collected_at)
+        rate = PAUSE_RATES.rate('pause_duration', key)
+        if rate is not None:
+            fraction = min(1.0, max(0.0, rate * PAUSE_DURATION_SECONDS))
+            metrics.append(f'esxi_pause_time_fraction{{{key}}} {fraction:.6f}')
+    return metrics
+
+@PROFILER.worker
+@instrumented('get_esxi_pause_stats')
+def get_esxi_pause_stats(host_name, host_config):
+    """Get the pNic statistics of every RDMA uplink with one remote command
+
+    Returns the exposition lines, or None when the host could not be reached.
+    """
     host_ip = host_config["ip"]
-    user = host_config["user"]
-    password = host_config["password"]
+    connection = SSH_POOL.get(host_ip, host_config["user"], host_config["password"])
 
-    for vmnic in host_config["vmnics"]:
-        try:
-            # Use sshpass to connect and get stats
-            cmd = [
-                'sshpass', '-p', password,
-                'ssh', '-o', 'StrictHostKeyChecking=no',
-                f'{user}@{host_ip}',
-                f'vsish -e cat /net/pNics/{vmnic}/stats | grep -i pause'
-            ]
-
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-
-            if result.returncode == 0:
-                output = result.stdout
-            else:
-                print(f"Error from {host_name} {vmnic}: returncode={result.returncode}")
-                print(f"stderr: {result.stderr}")
-                continue
+    try:
+        vmnics, nics = DISCOVERY.vmnics(host_name, host_config, connection)
+        result = connection.run(vsish_batch_command(vmnics), timeout=10)
+    except subprocess.TimeoutExpired:
+        print(f"Timeout getting stats from {host_name}")
+        record_error()
+        return None
+    except SSHError as e:
+        print(f"SSH error for {host_name}: {e}")
+        record_error()
+        return None
+    except Exception as e:
+        print(f"Error getting stats from {host_name}: {e}")
+        record_error()
+        return None
 
-                # Parse pause frame statistics
-                stats_map = {
-                    'rxPauseCtrlPhy': 'esxi_pause_rx_phy',
-                    'txPauseCtrlPhy': 'esxi_pause_tx_phy',
-                    'rx_global_pause': 'esxi_pause_rx_global',
-                    'tx_global_pause': 'esxi_pause_tx_global',
-                    'rx_global_pause_duration': 'esxi_pause_rx_duration',
-                    'tx_global_pause_duration': 'esxi_pause_tx_duration',
-                    'rx_global_pause_transition': 'esxi_pause_rx_transitions',
-                    'txPauseStormWarningEvents': 'esxi_pause_storm_warnings',
-                    'txPauseStormErrorEvents': 'esxi_pause_storm_errors',
-                }
-
-                for stat_name, metric_name in stats_map.items():
-                    match = re.search(rf'{stat_name}:\s+(\d+)', output)
-                    if match:
-                        value = match.group(1)
-                        metrics.append(
-                            f'{metric_name}{{host="{host_name}",vmnic="{vmnic}",esxi_ip="{host_ip}"}} {value}'
-                        )
-
-        except subprocess.TimeoutExpired:
-            print(f"Timeout getting stats from {host_name} {vmnic}")
-        except Exception as e:
-            print(f"Error getting stats from {host_name} {vmnic}: {e}")
+    # The exit status is that of the last vsish; missing sections are what count
+    if result.stderr.strip():
+        print(f"stderr from {host_name}: {result.stderr.strip()}")
+
+    metrics = format_vmnic_info(host_name, host_ip, nics)
+    collected_at = time.monotonic()
+    sections = split_sections(result.stdout)
+    for vmnic in vmnics:
+        if vmnic not in sections:
+            print(f"No stats from {host_name} {vmnic}")
+            record_error()
+            continue
+        metrics.extend(format_vmnic_stats(host_name, host_ip, vmnic, sections[vmnic], collected_at))
 
     return metrics
 
-@app.route('/metrics')
-def metrics():
-    """Prometheus metrics endpoint"""
+class HostPoller:
+    """Polls every ESXi host concurrently in the background
+
+    Each round submits one get_esxi_pause_stats() per host to a thread pool
+    and waits at most 'deadline' seconds. A host still busy from an earlier
+    round is not resubmitted. The last successful lines of every host are
+    kept and served with esxi_scrape_success (did the latest round succeed
+    within the deadline) and esxi_sample_age_seconds, so scrapes never wait
+    on SSH.
+    """
+
+    def __init__(self, hosts, interval=15.0, deadline=10.0):
+        self.hosts = hosts
+        self.interval = interval
+        self.deadline = deadline
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(hosts)),
+                                                              thread_name_prefix='esxi-poll')
+        self._pending = {}
+        # host name -> (exposition lines, time.monotonic() of the sample)
+        self.samples = {}
+        self.success = {}
+        self._lock = threading.Lock()
+
+    def _store(self, host_name, future):
+        # Also runs for results that arrive after the deadline
+        lines = future.result() if future.exception() is None else None
+        if lines is not None:
+            with self._lock:
+                self.samples[host_name] = (lines, time.monotonic())
+
+    @PROFILER.profiled
+    def poll(self):
+        """Run one polling round (what /debug/profile?scrapes=N profiles, N rounds)"""
+        futures = {}
+        for host_name, host_config in self.hosts.items():
+            previous = self._pending.get(host_name)
+            if previous is not None and not previous.done():
+                self.success[host_name] = 0
+                continue
+            future = self.executor.submit(get_esxi_pause_stats, host_name, host_config)
+            future.add_done_callback(lambda future, host_name=host_name: self._store(host_name, future))
+            self._pending[host_name] = future
+            futures[future] = host_name
+
+        done, _ = concurrent.futures.wait(futures, timeout=self.deadline)
+        for future, host_name in futures.items():
+            self.success[host_name] = int(future in done and future.exception() is None
+                                          and future.result() is not None)
+
+    def start(self):
+        threading.Thread(target=self._run, name='esxi-poller', daemon=True).start()
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Error polling ESXi hosts: {e}")
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def lines(self):
+        """Last good metric lines of every host"""
+        with self._lock:
+            samples = list(self.samples.values())
+        return [line for host_lines, _ in samples for line in host_lines]
+
+    def render(self):
+        """Exposition lines for per-host success and sample age"""
+        now = time.monotonic()
+        with self._lock:
+            samples = dict(self.samples)
+        lines = [
+            "# HELP esxi_scrape_success Whether the latest poll of the host succeeded within the deadline",
+            "# TYPE esxi_scrape_success gauge",
+        ]
+        for host_name, host_config in self.hosts.items():
+            lines.append(f'esxi_scrape_success{{host="{host_name}",esxi_ip="{host_config["ip"]}"}} '
+                         f'{self.success.get(host_name, 0)}')
+        lines += [
+            "# HELP esxi_sample_age_seconds Seconds since the served values of the host were collected",
+            "# TYPE esxi_sample_age_seconds gauge",
+        ]
+        for host_name, host_config in self.hosts.items():
+            if host_name in samples:
+                lines.append(f'esxi_sample_age_seconds{{host="{host_name}",esxi_ip="{host_config["ip"]}"}} '
+                             f'{now - samples[host_name][1]:.3f}')
+        return lines
+
+POLLER = HostPoller(ESXI_HOSTS)
+
+# sample_ring.SampleRing when --ring-file is given
+RING = None
+
+def collect():
+    """Render the last good pause statistics of every ESXi host as exposition text"""
+    # Values from the background poller; scrapes do no SSH. Samples are
+    # grouped under their family's HELP/TYPE as the text format expects.
+    by_family = {}
+    for line in POLLER.lines():
+        by_family.setdefault(line.partition('{')[0], []).append(line)
+
     output = []
+    for family, metric_type, help_text in ESXI_FAMILIES:
+        output.append(f'# HELP {family} {help_text}')
+        output.append(f'# TYPE {family} {metric_type}')
+        output.extend(by_family.get(family, ()))
+    return '\n'.join(output) + '\n'
 
-    # Add metric descriptions
-    output.append('# HELP esxi_pause_rx_phy ESXi physical RX pause frames')
-    output.append('# TYPE esxi_pause_rx_phy counter')
-    output.append('# HELP esxi_pause_tx_phy ESXi physical TX pause frames')
-    output.append('# TYPE esxi_pause_tx_phy counter')
-    output.append('# HELP esxi_pause_rx_global ESXi global RX pause frames')
-    output.append('# TYPE esxi_pause_rx_global counter')
-    output.append('# HELP esxi_pause_tx_global ESXi global TX pause frames')
-    output.append('# TYPE esxi_pause_tx_global counter')
-    output.append('# HELP esxi_pause_rx_duration ESXi RX pause duration (units)')
-    output.append('# TYPE esxi_pause_rx_duration counter')
-    output.append('# HELP esxi_pause_rx_transitions ESXi RX pause state transitions')
-    output.append('# TYPE esxi_pause_rx_transitions counter')
-    output.append('# HELP esxi_pause_storm_warnings ESXi pause storm warning events')
-    output.append('# TYPE esxi_pause_storm_warnings counter')
-    output.append('# HELP esxi_pause_storm_errors ESXi pause storm error events')
-    output.append('# TYPE esxi_pause_storm_errors counter')
-    output.append('')
-
-    # Collect metrics from all ESXi hosts
-    for host_name, host_config in ESXI_HOSTS.items():
-        host_metrics = get_esxi_pause_stats(host_name, host_config)
-        output.extend(host_metrics)
-
-    return Response('\n'.join(output) + '\n', mimetype='text/plain')
-
-@app.route('/health')
-def health():
+def metrics(query=None):
+    """Prometheus metrics endpoint"""
+    output = POLLER.render()
+    output.extend(exporter_selfstats.render())
+    output.extend(SSH_POOL.render())
+    if RING is not None:
+        output.extend(RING.render())
+    return collect() + '\n'.join(output) + '\n'
+
+def record_loop(ring, interval):
+    """Record the polled values every 'interval' seconds, independent of scrapes"""
+    while True:
+        started = time.monotonic()
+        try:
+            ring.add_exposition(collect())
+        except Exception as e:
+            print(f"Error recording ESXi stats: {e}")
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+def health(query=None):
     """Health check endpoint"""
     return 'OK'
 
+ROUTES = {
+    '/metrics': metrics,
+    '/health': health,
+    '/debug/profile': PROFILER.route,
+}
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ESXi Statistics Exporter for Prometheus')
+    parser.add_argument('--port', type=int, default=9104, help='HTTP port (default: 9104)')
+    parser.add_argument('--interval', type=float, default=15.0, metavar='SECONDS',
+                        help='Background polling interval for the ESXi hosts (default: 15)')
+    parser.add_argument('--deadline', type=float, default=10.0, metavar='SECONDS',
+                        help='Seconds a polling round waits for the hosts (default: 10)')
+    parser.add_argument('--discovery-ttl', type=float, default=300.0, metavar='SECONDS',
+                        help='Rediscover pNics and RDMA uplinks this often; 0 uses the configured vmnics '
+                             '(default: 300)')
+    parser.add_argument('--ring-interval', type=float, default=15.0, metavar='SECONDS',
+                        help='Collection interval for the ring file (default: 15)')
+    sample_ring.add_arguments(parser)
+    exposition.add_arguments(parser)
+    args = parser.parse_args()
+    exposition.enable_formats(args.exposition_formats)
+
     print("Starting ESXi Statistics Exporter...")
     print("Monitoring ESXi hosts:")
     for name, config in ESXI_HOSTS.items():
-        print(f"  {name}: {config['ip']} - vmnics: {', '.join(config['vmnics'])}")
-    print("\nListening on http://0.0.0.0:9104/metrics")
-    app.run(host='0.0.0.0', port=9104)
+        print(f"  {name}: {config['ip']} - configured vmnics: {', '.join(config['vmnics'])}")
+    DISCOVERY.ttl = args.discovery_ttl
+    POLLER.interval = args.interval
+    POLLER.deadline = args.deadline
+    POLLER.start()
+    print(f"Polling every {args.interval}s (deadline {args.deadline}s)")
+    RING = sample_ring.from_args(args)
+    if RING is not None:
+        ROUTES['/backfill'] = RING.route
+        threading.Thread(target=record_loop, args=(RING, args.ring_interval),
+                         name='ring-record', daemon=True).start()
+        print(f"Recording to {RING.path} every {args.ring_interval}s")
+    print(f"\nListening on http://0.0.0.0:{args.port}/metrics")
+    serve(ROUTES, args.port)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Driver statistics reader (the counters behind `ethtool -S`)
+Uses the SIOCETHTOOL ioctl over one persistent socket instead of forking ethtool
+"""
+
+import ctypes
+import errno
+import fcntl
+import json
+import socket
+import struct
+import sys
+from array import array
+
+SIOCETHTOOL = 0x8946
+ETHTOOL_GSTRINGS = 0x1b
+ETHTOOL_GSTATS = 0x1d
+ETHTOOL_GSSET_INFO = 0x37
+ETH_SS_STATS = 1
+ETH_GSTRING_LEN = 32
+IFNAMSIZ = 16
+
+
+class EthtoolStatsReader:
+    """Reads per-interface driver statistics through SIOCETHTOOL
+
+    The ETH_SS_STATS string set of each interface is resolved once and
+    cached; later reads fetch only the u64 value array (ETHTOOL_GSTATS).
+    GSTATS writes as many values as the driver reports at that moment,
+    whatever the size of our buffer, so each read checks the count with
+    ETHTOOL_GSSET_INFO first and resolves names and buffer again when it
+    changed (e.g. mlx5 after a channel-count change).
+
+    The generic-netlink ethtool family (ETHTOOL_MSG_STATS_GET) only carries
+    the standardised IEEE/RMON groups, not driver-private counters such as
+    mlx5's rx_prio3_pause, so the ioctl interface is used here.
+    """
+
+    def __init__(self, ioctl=fcntl.ioctl):
+        self._ioctl = ioctl
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # interface -> (names tuple, ctypes buffer for ETHTOOL_GSTATS)
+        self._layouts = {}
+
+    def _ethtool(self, interface, buf):
+        """Issue one SIOCETHTOOL request with 'buf' as the ethtool command"""
+        ifreq = bytearray(struct.pack(f'{IFNAMSIZ}sP', interface.encode(), ctypes.addressof(buf)))
+        ifreq.extend(bytes(40 - len(ifreq)))
+        self._ioctl(self._sock.fileno(), SIOCETHTOOL, ifreq)
+
+    def _stat_count(self, interface):
+        buf = ctypes.create_string_buffer(struct.pack('IIQI', ETHTOOL_GSSET_INFO, 0, 1 << ETH_SS_STATS, 0), 20)
+        self._ethtool(interface, buf)
+        _, _, mask, count = struct.unpack('IIQI', buf.raw)
+        return count if mask & (1 << ETH_SS_STATS) else 0
+
+    def _resolve(self, interface):
+        count = self._stat_count(interface)
+        buf = ctypes.create_string_buffer(12 + count * ETH_GSTRING_LEN)
+        struct.pack_into('III', buf, 0, ETHTOOL_GSTRINGS, ETH_SS_STATS, count)
+        self._ethtool(interface, buf)
+        count = min(count, struct.unpack_from('III', buf, 0)[2])
+
+        raw = buf.raw
+        names = tuple(
+            raw[12 + i * ETH_GSTRING_LEN:12 + (i + 1) * ETH_GSTRING_LEN].split(b'\0', 1)[0].decode('ascii', 'replace')
+            for i in range(count)
+        )
+        stats_buf = ctypes.create_string_buffer(8 + count * 8)
+        layout = (names, stats_buf)
+        self._layouts[interface] = layout
+        return layout
+
+    def names(self, interface):
+        """Counter names for an interface, resolved once"""
+        layout = self._layouts.get(interface) or self._resolve(interface)
+        return layout[0]
+
+    def read(self, interface):
+        """Current counter values as an array('Q') aligned with names()"""
+        layout = self._layouts.get(interface)
+        if layout is None or self._stat_count(interface) != len(layout[0]):
+            layout = self._resolve(interface)
+        names, buf = layout
+        struct.pack_into('II', buf, 0, ETHTOOL_GSTATS, len(names))
+        self._ethtool(interface, buf)
+        n_stats = min(len(names), struct.unpack_from('II', buf, 0)[1])
+        values = array('Q')
+        values.frombytes(memoryview(buf).cast('B')[8:8 + n_stats * 8])
+        return values
+
+    def stats(self, interface):
+        """Counter name -> value dict, equivalent to parsing `ethtool -S`"""
+        values = self.read(interface)
+        return dict(zip(self.names(interface), values))
+
+    def forget(self, interface):
+        """Drop the cached string set of an interface"""
+        self._layouts.pop(interface, None)
+
+    def close(self):
+        self._sock.close()
+        self._layouts.clear()
+
+
+class RecordedEthtool:
+    """Test double for the SIOCETHTOOL ioctl, answering from recorded replies
+
+    'recording' maps interface -> list of {"names": [...], "values": [...]}
+    snapshots, as written by 'ethtool_stats.py --record'. Each GSTATS
+    request moves the interface to its next snapshot (the last one repeats),
+    so a longer second snapshot replays a driver whose stat set grew. Like
+    the kernel, GSTRINGS and GSTATS write the snapshot's full count without
+    looking at the caller's buffer. Use as EthtoolStatsReader(ioctl=...).
+    """
+
+    def __init__(self, recording):
+        self.recording = recording
+        self.position = {}
+
+    def snapshot(self, interface):
+        snapshots = self.recording[interface]
+        return snapshots[min(self.position.get(interface, 0), len(snapshots) - 1)]
+
+    def __call__(self, fd, request, ifreq):
+        name, address = struct.unpack_from(f'{IFNAMSIZ}sP', ifreq)
+        interface = name.split(b'\0', 1)[0].decode()
+        if request != SIOCETHTOOL or interface not in self.recording:
+            raise OSError(errno.ENODEV, f"No recording for {interface}")
+        command = ctypes.c_uint32.from_address(address).value
+        snapshot = self.snapshot(interface)
+        names, values = snapshot['names'], snapshot['values']
+        if command == ETHTOOL_GSSET_INFO:
+            reply = struct.pack('IIQI', command, 0, 1 << ETH_SS_STATS, len(names))
+        elif command == ETHTOOL_GSTRINGS:
+            reply = struct.pack('III', command, ETH_SS_STATS, len(names)) + b''.join(
+                name.encode()[:ETH_GSTRING_LEN - 1].ljust(ETH_GSTRING_LEN, b'\0') for name in names)
+        elif command == ETHTOOL_GSTATS:
+            reply = struct.pack(f'II{len(values)}Q', command, len(values), *values)
+            self.position[interface] = self.position.get(interface, 0) + 1
+        else:
+            raise OSError(errno.EOPNOTSUPP, f"Unrecorded ethtool command {command:#x}")
+        ctypes.memmove(address, reply, len(reply))
+
+
+def record(interfaces, reads=1):
+    """Recording of 'reads' snapshots per interface for RecordedEthtool"""
+    reader = EthtoolStatsReader()
+    recording = {}
+    for interface in interfaces:
+        recording[interface] = []
+        for _ in range(reads):
+            reader.forget(interface)
+            recording[interface].append({'names': list(reader.names(interface)),
+                                         'values': list(reader.read(interface))})
+    reader.close()
+    return recording
+
+
+if __name__ == '__main__':
+    # ethtool_stats.py <interface>                      print the counters
+    # ethtool_stats.py --record FILE <interface>...     save replies for RecordedEthtool
+    # ethtool_stats.py --replay FILE                    read every snapshot of a recording
+    if len(sys.argv) >= 4 and sys.argv[1] == '--record':
+        with open(sys.argv[2], 'w') as f:
+            json.dump(record(sys.argv[3:]), f, indent=1)
+        sys.exit(0)
+    if len(sys.argv) == 3 and sys.argv[1] == '--replay':
+        with open(sys.argv[2]) as f:
+            recording = json.load(f)
+        reader = EthtoolStatsReader(ioctl=RecordedEthtool(recording))
+        for interface, snapshots in recording.items():
+            for number, snapshot in enumerate(snapshots):
+                stats = reader.stats(interface)
+                status = 'ok' if stats == dict(zip(snapshot['names'], snapshot['values'])) else 'MISMATCH'
+                print(f"{interface} snapshot {number}: {len(stats)} counters {status}")
+        sys.exit(0)
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} <interface> | --record FILE <interface>... | --replay FILE")
+        sys.exit(1)
+    reader = EthtoolStatsReader()
+    print(f"NIC statistics for {sys.argv[1]}:")
+    for name, value in reader.stats(sys.argv[1]).items():
+        print(f"     {name}: {value}")
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Shared HTTP serving for the Prometheus exporters
+Threaded server with keep-alive, gzip, ETag/If-None-Match and content
+negotiation between the text, OpenMetrics and protobuf formats
+"""
+
+import gzip
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+
+from exposition import CONTENT_TYPES, TEXT_CONTENT_TYPE, ExpositionConverter, extras_snapshot, negotiate
+
+# Bodies smaller than this are sent uncompressed even when gzip is accepted
+GZIP_MIN_BYTES = 512
+
+
+class Payload:
+    """Response body split into a cacheable part and a small per-request tail
+
+    The ETag and the gzip encoding of 'body' are cached; 'tail' (for example
+    a staleness gauge) is rendered per request and appended as a second gzip
+    member, which every gzip decoder concatenates transparently.
+
+    Text-format payloads are converted to OpenMetrics or protobuf when the
+    scraper asks for them. 'extras' (see exposition.register_extras) holds
+    the native histograms and exemplars taken with the body; when None they
+    are snapshotted at conversion time.
+    """
+
+    __slots__ = ('body', 'tail', 'etag', 'content_type', 'extras')
+
+    def __init__(self, body, tail=b'', etag=None, content_type=TEXT_CONTENT_TYPE, extras=None):
+        self.body = body
+        self.tail = tail
+        self.etag = etag or compute_etag(body)
+        self.content_type = content_type
+        self.extras = extras
+
+
+class Stream:
+    """Response body produced incrementally, sent with chunked transfer encoding
+
+    Used for large responses (e.g. /backfill) that should not be built in
+    memory; streams get no ETag and no gzip.
+    """
+
+    __slots__ = ('chunks', 'content_type')
+
+    def __init__(self, chunks, content_type=TEXT_CONTENT_TYPE):
+        self.chunks = chunks
+        self.content_type = content_type
+
+
+def compute_etag(body):
+    """Strong ETag for a response body"""
+    return '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+
+
+def to_payload(result):
+    """Normalise a route's return value (Payload, bytes or str) into a Payload"""
+    if isinstance(result, Payload):
+        return result
+    if isinstance(result, str):
+        result = result.encode('utf-8')
+    return Payload(result)
+
+
+def etag_matches(header, etag):
+    """True when an If-None-Match header lists 'etag' (weak comparison) or is '*'"""
+    for tag in (header or '').split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def accepts_gzip(header):
+    """True when an Accept-Encoding header allows gzip"""
+    for item in (header or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        if coding.strip().lower() in ('gzip', '*'):
+            params = params.replace(' ', '')
+            return params not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+class ExporterRequestHandler(BaseHTTPRequestHandler):
+    """Dispatches GET requests to the server's route table
+
+    Route callables receive the parsed query string as a dict and return a
+    Payload, Stream, bytes or str.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Idle keep-alive connections are closed after this many seconds
+    timeout = 60
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        route = self.server.routes.get(url.path)
+        if route is None:
+            self.send_plain(404, b'Not Found\n')
+            return
+
+        try:
+            result = route(dict(parse_qsl(url.query)))
+            if isinstance(result, Stream):
+                self.send_stream(result)
+                return
+            payload = to_payload(result)
+        except Exception as e:
+            print(f"Error serving {url.path}: {e}")
+            self.send_plain(500, f'Error: {e}\n'.encode('utf-8'))
+            return
+
+        fmt = 'text'
+        if payload.content_type == TEXT_CONTENT_TYPE and url.path in self.server.metrics_paths:
+            fmt = negotiate(self.headers.get('Accept'))
+        # Decided on the text body so a 304 needs no conversion; every
+        # format and encoding of the body gets its own ETag
+        use_gzip = (accepts_gzip(self.headers.get('Accept-Encoding'))
+                    and len(payload.body) + len(payload.tail) >= GZIP_MIN_BYTES)
+        format_etag = payload.etag if fmt == 'text' else f'{payload.etag[:-1]}-{fmt}"'
+        etag = f'{format_etag[:-1]}-gz"' if use_gzip else format_etag
+
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Vary', 'Accept, Accept-Encoding')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body, tail = payload.body, payload.tail
+        if fmt != 'text':
+            body = self.server.converted_body(url.path, fmt, format_etag, payload)
+            tail = self.server.converter.convert(tail, fmt) if tail else b''
+        if use_gzip:
+            body = self.server.gzip_body((url.path, fmt), format_etag, body)
+            tail = gzip.compress(tail, compresslevel=1) if tail else b''
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPES[fmt] if fmt != 'text' else payload.content_type)
+        self.send_header('Content-Length', str(len(body) + len(tail)))
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept, Accept-Encoding')
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+        if tail:
+            self.wfile.write(tail)
+
+    def send_stream(self, stream):
+        self.send_response(200)
+        self.send_header('Content-Type', stream.content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for chunk in stream.chunks:
+                if chunk:
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        except Exception as e:
+            # Headers are gone already; drop the connection so the client sees a truncated body
+            print(f"Error streaming {self.path}: {e}")
+            self.close_connection = True
+            return
+        self.wfile.write(b'0\r\n\r\n')
+
+    def send_plain(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Suppress logging"""
+        pass
+
+
+class ExporterHTTPServer(ThreadingHTTPServer):
+    """Thread-per-connection server holding the route table, format and gzip caches"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # Routes serving exposition text that may be converted to other formats
+    metrics_paths = ('/metrics',)
+
+    def __init__(self, server_address, routes):
+        super().__init__(server_address, ExporterRequestHandler)
+        self.routes = routes
+        self.converter = ExpositionConverter()
+        self._converted = {}
+        self._gzip_cache = {}
+        self._gzip_lock = threading.Lock()
+
+    def converted_body(self, path, fmt, etag, payload):
+        """Payload body in an OpenMetrics/protobuf format, converted once per ETag and (path, format)"""
+        cached = self._converted.get((path, fmt))
+        if cached is not None and cached[0] == etag:
+            return cached[1]
+        extras = payload.extras if payload.extras is not None else extras_snapshot()
+        body = self.converter.convert(payload.body, fmt, extras, eof=not payload.tail)
+        with self._gzip_lock:
+            self._converted[(path, fmt)] = (etag, body)
+        return body
+
+    def gzip_body(self, key, etag, body):
+        """gzip-encoded body, compressed once per ETag and (path, format)"""
+        cached = self._gzip_cache.get(key)
+        if cached is not None and cached[0] == etag:
+            return cached[1]
+        compressed = gzip.compress(body, compresslevel=6)
+        with self._gzip_lock:
+            self._gzip_cache[key] = (etag, compressed)
+        return compressed
+
+
+def make_server(routes, port, host='0.0.0.0'):
+    """Create an exporter HTTP server for a {path: callable} route table"""
+    return ExporterHTTPServer((host, port), routes)
+
+
+def serve(routes, port, host='0.0.0.0'):
+    """Serve the route table until interrupted"""
+    make_server(routes, port, host).serve_forever()
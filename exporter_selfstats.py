@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Exporter self-instrumentation
+Per-collector wall/CPU time, subprocess count, bytes parsed and errors,
+plus on-demand cProfile dumps of upcoming scrapes
+"""
+
+import bisect
+import cProfile
+import functools
+import io
+import marshal
+import pstats
+import subprocess
+import threading
+import time
+
+import exposition
+from exporter_http import Payload
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_MAX_SCRAPES = 100
+PROFILE_TIMEOUT = 300
+
+_local = threading.local()
+
+
+class CollectorStats:
+    """Cumulative statistics of one instrumented collector function"""
+
+    __slots__ = ('calls', 'errors', 'subprocesses', 'parsed_bytes',
+                 'wall_buckets', 'wall_sum', 'cpu_buckets', 'cpu_sum', 'wall_native', 'cpu_native')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.subprocesses = 0
+        self.parsed_bytes = 0
+        self.wall_buckets = [0] * (len(DURATION_BUCKETS) + 1)
+        self.wall_sum = 0.0
+        self.cpu_buckets = [0] * (len(DURATION_BUCKETS) + 1)
+        self.cpu_sum = 0.0
+        # Same observations as native histograms for the protobuf format
+        self.wall_native = exposition.NativeHistogram()
+        self.cpu_native = exposition.NativeHistogram()
+
+
+_stats = {}
+# Guards _stats and every CollectorStats field: collectors run on executor threads
+_stats_lock = threading.Lock()
+
+
+def _current():
+    """Stats of the innermost instrumented call on this thread, or None"""
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def instrumented(name):
+    """Decorator recording a collector's timing, forks, parsed bytes and errors"""
+    def decorator(func):
+        with _stats_lock:
+            stats = _stats.setdefault(name, CollectorStats())
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = getattr(_local, 'stack', None)
+            if stack is None:
+                stack = _local.stack = []
+            stack.append(stats)
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                with _stats_lock:
+                    stats.errors += 1
+                raise
+            finally:
+                wall = time.perf_counter() - wall_start
+                cpu = time.thread_time() - cpu_start
+                stack.pop()
+                with _stats_lock:
+                    stats.calls += 1
+                    stats.wall_sum += wall
+                    stats.wall_buckets[bisect.bisect_left(DURATION_BUCKETS, wall)] += 1
+                    stats.cpu_sum += cpu
+                    stats.cpu_buckets[bisect.bisect_left(DURATION_BUCKETS, cpu)] += 1
+                    stats.wall_native.observe(wall)
+                    stats.cpu_native.observe(cpu)
+        return wrapper
+    return decorator
+
+
+def record_bytes(count):
+    """Attribute 'count' parsed bytes to the current collector"""
+    stats = _current()
+    if stats is not None:
+        with _stats_lock:
+            stats.parsed_bytes += count
+
+
+def record_error():
+    """Count a handled error against the current collector"""
+    stats = _current()
+    if stats is not None:
+        with _stats_lock:
+            stats.errors += 1
+
+
+def run_command(args, **kwargs):
+    """subprocess.run() that counts the fork and its output bytes"""
+    stats = _current()
+    if stats is not None:
+        with _stats_lock:
+            stats.subprocesses += 1
+    result = subprocess.run(args, **kwargs)
+    if stats is not None and result.stdout:
+        with _stats_lock:
+            stats.parsed_bytes += len(result.stdout)
+    return result
+
+
+def _histogram_lines(name, labels, buckets, total):
+    lines = []
+    cumulative = 0
+    for le, count in zip(DURATION_BUCKETS, buckets):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+    cumulative += buckets[-1]
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+    lines.append(f'{name}_sum{{{labels}}} {total:.6f}')
+    lines.append(f'{name}_count{{{labels}}} {cumulative}')
+    return lines
+
+
+def render():
+    """Exposition lines for every instrumented collector"""
+    with _stats_lock:
+        snapshot = sorted(_stats.items())
+        wall = ["# HELP exporter_collector_duration_seconds Wall time per collector call",
+                "# TYPE exporter_collector_duration_seconds histogram"]
+        cpu = ["# HELP exporter_collector_cpu_seconds CPU time per collector call (calling thread)",
+               "# TYPE exporter_collector_cpu_seconds histogram"]
+        counters = {
+            'calls': ["# HELP exporter_collector_calls_total Collector calls",
+                      "# TYPE exporter_collector_calls_total counter"],
+            'subprocesses': ["# HELP exporter_collector_subprocesses_total Subprocesses forked by collectors",
+                             "# TYPE exporter_collector_subprocesses_total counter"],
+            'parsed_bytes': ["# HELP exporter_collector_parsed_bytes_total Bytes of command/API output parsed",
+                             "# TYPE exporter_collector_parsed_bytes_total counter"],
+            'errors': ["# HELP exporter_collector_errors_total Errors raised or handled inside collectors",
+                       "# TYPE exporter_collector_errors_total counter"],
+        }
+        for name, stats in snapshot:
+            labels = f'collector="{name}"'
+            wall.extend(_histogram_lines('exporter_collector_duration_seconds', labels,
+                                         stats.wall_buckets, stats.wall_sum))
+            cpu.extend(_histogram_lines('exporter_collector_cpu_seconds', labels,
+                                        stats.cpu_buckets, stats.cpu_sum))
+            for field, lines in counters.items():
+                lines.append(f'exporter_collector_{field}_total{{{labels}}} {getattr(stats, field)}')
+
+    if not snapshot:
+        return []
+    lines = wall + cpu
+    for field_lines in counters.values():
+        lines.extend(field_lines)
+    return lines
+
+
+def native_histograms():
+    """Native histogram extras for the duration histograms (see exposition.register_extras)"""
+    extras = {}
+    with _stats_lock:
+        for name, stats in _stats.items():
+            labels = f'collector="{name}"'
+            extras[('exporter_collector_duration_seconds', labels)] = {'native': stats.wall_native.copy()}
+            extras[('exporter_collector_cpu_seconds', labels)] = {'native': stats.cpu_native.copy()}
+    return extras
+
+
+exposition.register_extras(native_histograms)
+
+
+class ScrapeProfiler:
+    """Profiles the next N scrapes on request (/debug/profile?scrapes=N)
+
+    cProfile only records the thread that enabled it, so work a profiled
+    scrape hands to pool threads is wrapped with worker(): each worker
+    thread gets its own Profile, merged with the scrape's when the job ends.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._job = None
+
+    def profiled(self, func):
+        """Decorator for the scrape/collection entry point"""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            job = self._job
+            # Only one thread can drive a cProfile.Profile at a time
+            if job is None or not job['busy'].acquire(blocking=False):
+                return func(*args, **kwargs)
+            try:
+                job['profile'].enable()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    job['profile'].disable()
+                    job['remaining'] -= 1
+                    if job['remaining'] <= 0:
+                        with self._lock:
+                            if self._job is job:
+                                self._job = None
+                        job['done'].set()
+            finally:
+                job['busy'].release()
+        return wrapper
+
+    def worker(self, func):
+        """Decorator for work run on another thread on behalf of a profiled scrape"""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            job = self._job
+            # Only while a profiled scrape is running (it holds 'busy')
+            if job is None or not job['busy'].locked():
+                return func(*args, **kwargs)
+            ident = threading.get_ident()
+            with self._lock:
+                profile = job['workers'].get(ident)
+                if profile is None:
+                    profile = job['workers'][ident] = cProfile.Profile()
+                job['running'].add(ident)
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+ profiles every thread from the scrape's Profile
+                profile = None
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.disable()
+                with self._lock:
+                    job['running'].discard(ident)
+        return wrapper
+
+    def request(self, scrapes, timeout=PROFILE_TIMEOUT):
+        """Profile the next 'scrapes' scrapes; returns pstats.Stats over all threads, or None on timeout"""
+        job = {
+            'profile': cProfile.Profile(),
+            'workers': {},
+            'running': set(),
+            'remaining': scrapes,
+            'busy': threading.Lock(),
+            'done': threading.Event(),
+        }
+        with self._lock:
+            if self._job is not None:
+                raise RuntimeError("A profile is already being captured")
+            self._job = job
+        if not job['done'].wait(timeout):
+            with self._lock:
+                if self._job is job:
+                    self._job = None
+            return None
+        # Workers still running past the scrape deadline are left out
+        with self._lock:
+            workers = [profile for ident, profile in job['workers'].items() if ident not in job['running']]
+        return pstats.Stats(job['profile'], *workers)
+
+    def route(self, query):
+        """HTTP route: ?scrapes=N (default 1), ?format=text|raw (raw is a pstats dump)"""
+        scrapes = max(1, min(int(query.get('scrapes', 1)), PROFILE_MAX_SCRAPES))
+        stats = self.request(scrapes)
+        if stats is None:
+            return f"Timed out waiting for {scrapes} scrape(s)\n"
+
+        if query.get('format') == 'raw':
+            # Same format as cProfile's dump_stats(): load with pstats.Stats(path)
+            return Payload(marshal.dumps(stats.stats), content_type='application/octet-stream')
+
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats(query.get('sort', 'cumulative')).print_stats(int(query.get('limit', 60)))
+        return out.getvalue()
+
+
+PROFILER = ScrapeProfiler()
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""
+Exposition formats for the Prometheus exporters
+Content negotiation and conversion of the text format to OpenMetrics and
+delimited protobuf, with created timestamps, native histograms and exemplars
+"""
+
+import math
+import re
+import struct
+import threading
+import time
+
+TEXT_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+PROTOBUF_CONTENT_TYPE = ('application/vnd.google.protobuf; proto=io.prometheus.client.MetricFamily; '
+                         'encoding=delimited')
+CONTENT_TYPES = {
+    'text': TEXT_CONTENT_TYPE,
+    'openmetrics': OPENMETRICS_CONTENT_TYPE,
+    'protobuf': PROTOBUF_CONTENT_TYPE,
+}
+# Tie-break between equally weighted Accept entries: cheapest to ingest first
+FORMAT_PREFERENCE = {'protobuf': 3, 'openmetrics': 2, 'text': 1}
+
+# Formats /metrics may negotiate. OpenMetrics and protobuf expose counters as
+# '<name>_total' (rdma_cnp_sent -> rdma_cnp_sent_total), which the bundled
+# Grafana dashboards do not query, so they are opt-in (--exposition-formats).
+ENABLED_FORMATS = {'text'}
+
+# Counters under these prefixes start at zero with the exporter process, so
+# its start time is their created timestamp. Hardware counters get none: a
+# created timestamp at exporter start would read as a jump from zero.
+PROCESS_COUNTER_PREFIXES = ('exporter_collector_', 'exporter_remote_write_', 'rdma_microburst_')
+PROCESS_START = time.time()
+
+# io.prometheus.client.MetricType
+PB_TYPES = {'counter': 0, 'gauge': 1, 'summary': 2, 'untyped': 3, 'histogram': 4}
+
+LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+LABEL_UNESCAPE_RE = re.compile(r'\\(.)')
+LABELS_CACHE_MAX = 50000
+
+
+def encode_varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def pb_field(tag, payload):
+    """Length-delimited protobuf field; 'tag' is the encoded key byte"""
+    return tag + encode_varint(len(payload)) + payload
+
+
+def pb_double(tag, value):
+    return tag + struct.pack('<d', value)
+
+
+def pb_uint(tag, value):
+    return tag + encode_varint(value & 0xffffffffffffffff)
+
+
+def pb_sint(tag, value):
+    return tag + encode_varint(value * 2 if value >= 0 else -value * 2 - 1)
+
+
+def pb_timestamp(tag, seconds):
+    """google.protobuf.Timestamp field"""
+    whole = math.floor(seconds)
+    return pb_field(tag, pb_uint(b'\x08', whole) + pb_uint(b'\x10', int((seconds - whole) * 1e9)))
+
+
+def negotiate(accept, formats=None):
+    """Pick 'protobuf', 'openmetrics' or 'text' for an Accept header, among 'formats' (default: enabled ones)"""
+    if formats is None:
+        formats = ENABLED_FORMATS
+    best, best_q = 'text', 0.0
+    for item in (accept or '').split(','):
+        media, *params = [part.strip() for part in item.split(';')]
+        params = dict(param.partition('=')[::2] for param in params)
+        try:
+            q = float(params.get('q', 1))
+        except ValueError:
+            continue
+        media = media.lower()
+        if media == 'application/vnd.google.protobuf':
+            if (params.get('proto') != 'io.prometheus.client.MetricFamily'
+                    or params.get('encoding') != 'delimited'):
+                continue
+            fmt = 'protobuf'
+        elif media == 'application/openmetrics-text':
+            if params.get('version', '1.0.0') not in ('1.0.0', '0.0.1'):
+                continue
+            fmt = 'openmetrics'
+        elif media in ('text/plain', '*/*'):
+            fmt = 'text'
+        else:
+            continue
+        if fmt not in formats and fmt != 'text':
+            continue
+        if q > best_q or (q == best_q and FORMAT_PREFERENCE[fmt] > FORMAT_PREFERENCE[best]):
+            best, best_q = fmt, q
+    return best
+
+
+def format_list(value):
+    """argparse type for --exposition-formats"""
+    formats = {name.strip() for name in value.split(',') if name.strip()}
+    unknown = formats - set(CONTENT_TYPES)
+    if unknown:
+        raise ValueError(f"unknown format(s): {', '.join(sorted(unknown))}")
+    return formats | {'text'}
+
+
+def add_arguments(parser):
+    """Add --exposition-formats to an exporter's argument parser"""
+    parser.add_argument('--exposition-formats', type=format_list, default={'text'}, metavar='FORMATS',
+                        help='Comma-separated formats /metrics may negotiate from the Accept header: text, '
+                             'openmetrics, protobuf. The latter two rename counters to <name>_total, which '
+                             'the bundled dashboards do not query (default: text)')
+
+
+def enable_formats(formats):
+    """Set the formats negotiate() may pick (text is always available)"""
+    ENABLED_FORMATS.clear()
+    ENABLED_FORMATS.update(formats)
+    ENABLED_FORMATS.add('text')
+
+
+class NativeHistogram:
+    """Sparse exponential histogram (a Prometheus native histogram)
+
+    Bucket i of schema s covers (2^((i-1)/2^s), 2^(i/2^s)]; observations with
+    an absolute value up to 'zero_threshold' go to the zero bucket. Only
+    positive observations are expected (durations, counter deltas).
+    """
+
+    __slots__ = ('schema', 'zero_threshold', 'zero_count', 'count', 'sum', 'buckets')
+
+    def __init__(self, schema=3, zero_threshold=0.0):
+        self.schema = schema
+        self.zero_threshold = zero_threshold
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        # bucket index -> count
+        self.buckets = {}
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        if value <= self.zero_threshold:
+            self.zero_count += 1
+            return
+        mantissa, exponent = math.frexp(value)
+        if mantissa == 0.5:
+            # Exact powers of two sit on a bucket's upper bound
+            index = (exponent - 1) << self.schema
+        else:
+            index = math.ceil(math.log2(value) * (1 << self.schema))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def copy(self):
+        other = NativeHistogram(self.schema, self.zero_threshold)
+        other.zero_count, other.count, other.sum = self.zero_count, self.count, self.sum
+        other.buckets = dict(self.buckets)
+        return other
+
+    def encode_fields(self):
+        """Native fields of an io.prometheus.client.Histogram message"""
+        out = [pb_sint(b'\x28', self.schema), pb_double(b'\x31', self.zero_threshold),
+               pb_uint(b'\x38', self.zero_count)]
+        spans, deltas = [], []
+        previous_index = previous_count = None
+        for index in sorted(self.buckets):
+            count = self.buckets[index]
+            if previous_index is not None and index == previous_index + 1:
+                spans[-1][1] += 1
+            else:
+                gap = index if previous_index is None else index - previous_index - 1
+                spans.append([gap, 1])
+            deltas.append(count - (previous_count or 0))
+            previous_index, previous_count = index, count
+        for offset, length in spans:
+            out.append(pb_field(b'\x62', pb_sint(b'\x08', offset) + pb_uint(b'\x10', length)))
+        if deltas:
+            packed = b''.join(encode_varint(d * 2 if d >= 0 else -d * 2 - 1) for d in deltas)
+            out.append(pb_field(b'\x6a', packed))
+        return b''.join(out)
+
+
+_extras_sources = []
+_extras_lock = threading.Lock()
+
+
+def register_extras(source):
+    """Register a callable returning {(family, label text): {'native': ..., 'exemplar': ...}}
+
+    'native' is a NativeHistogram for a histogram series; 'exemplar' is a
+    (labels dict, value, Unix timestamp) tuple for a counter series. The
+    label text is rendered exactly like the series in the text format.
+    """
+    with _extras_lock:
+        _extras_sources.append(source)
+
+
+def unregister_extras(source):
+    with _extras_lock:
+        if source in _extras_sources:
+            _extras_sources.remove(source)
+
+
+def extras_snapshot():
+    """Merged extras of every registered source, taken now"""
+    with _extras_lock:
+        sources = list(_extras_sources)
+    extras = {}
+    for source in sources:
+        for key, value in source().items():
+            extras.setdefault(key, {}).update(value)
+    return extras
+
+
+def parse_text(body):
+    """Split a text-format body into [[name, help, type, [(sample name, label text, value)]], ...]"""
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    families = []
+    by_name = {}
+    current = None
+
+    def family(name):
+        entry = by_name.get(name)
+        if entry is None:
+            entry = by_name[name] = [name, '', 'untyped', []]
+            families.append(entry)
+        return entry
+
+    for line in body.split('\n'):
+        if not line:
+            continue
+        if line[0] == '#':
+            parts = line.split(' ', 3)
+            if len(parts) >= 3 and parts[1] in ('HELP', 'TYPE'):
+                current = family(parts[2])
+                if parts[1] == 'HELP':
+                    current[1] = parts[3] if len(parts) > 3 else ''
+                else:
+                    current[2] = parts[3].strip() if len(parts) > 3 else 'untyped'
+            continue
+        series, _, value = line.rpartition(' ')
+        name, _, labels = series.partition('{')
+        labels = labels[:-1]
+        if current is None or not _belongs(name, current):
+            current = family(name)
+        current[3].append((name, labels, value))
+    return families
+
+
+def _belongs(sample_name, family):
+    name, metric_type = family[0], family[2]
+    if sample_name == name:
+        return True
+    if metric_type in ('histogram', 'summary'):
+        return sample_name in (name + '_bucket', name + '_sum', name + '_count')
+    return False
+
+
+def _canonical_le(value):
+    return value if value in ('+Inf', '-Inf', 'NaN') else repr(float(value))
+
+
+class ExpositionConverter:
+    """Converts text-format bodies to OpenMetrics text or delimited protobuf"""
+
+    def __init__(self):
+        self._labels_cache = {}
+
+    def label_pairs(self, text):
+        """[(name, value), ...] of a rendered label string, cached"""
+        pairs = self._labels_cache.get(text)
+        if pairs is None:
+            pairs = [(name, LABEL_UNESCAPE_RE.sub(lambda m: '\n' if m.group(1) == 'n' else m.group(1), value))
+                     for name, value in LABEL_RE.findall(text)]
+            if len(self._labels_cache) >= LABELS_CACHE_MAX:
+                self._labels_cache.clear()
+            self._labels_cache[text] = pairs
+        return pairs
+
+    def _histograms(self, family):
+        """Group histogram samples by series: {label text without le: [buckets, sum, count]}"""
+        series = {}
+        for sample_name, labels, value in family[3]:
+            if sample_name.endswith('_bucket'):
+                pairs = self.label_pairs(labels)
+                le = next((v for k, v in pairs if k == 'le'), '+Inf')
+                key = ','.join(f'{k}="{v}"' for k, v in LABEL_RE.findall(labels) if k != 'le')
+                series.setdefault(key, [[], '0', '0'])[0].append((le, value))
+            elif sample_name.endswith('_sum'):
+                series.setdefault(labels, [[], '0', '0'])[1] = value
+            else:
+                series.setdefault(labels, [[], '0', '0'])[2] = value
+        return series
+
+    def convert(self, body, fmt, extras=None, eof=True):
+        if fmt == 'openmetrics':
+            return self.openmetrics(body, extras, eof)
+        if fmt == 'protobuf':
+            return self.protobuf(body, extras)
+        return body
+
+    def openmetrics(self, body, extras=None, eof=True):
+        """OpenMetrics 1.0 text for a text-format body"""
+        extras = extras or {}
+        out = []
+        for name, help_text, metric_type, samples in parse_text(body):
+            if metric_type == 'untyped':
+                metric_type = 'unknown'
+            base = name[:-6] if metric_type == 'counter' and name.endswith('_total') else name
+            process_local = base.startswith(PROCESS_COUNTER_PREFIXES)
+            if help_text:
+                out.append(f'# HELP {base} {help_text}')
+            out.append(f'# TYPE {base} {metric_type}')
+
+            if metric_type == 'histogram':
+                for labels, (buckets, total, count) in self._histograms([name, help_text, metric_type, samples]).items():
+                    braces = f'{{{labels}}}' if labels else ''
+                    prefix = f'{labels},' if labels else ''
+                    for le, value in buckets:
+                        out.append(f'{base}_bucket{{{prefix}le="{_canonical_le(le)}"}} {value}')
+                    out.append(f'{base}_count{braces} {count}')
+                    out.append(f'{base}_sum{braces} {total}')
+                    if process_local:
+                        out.append(f'{base}_created{braces} {PROCESS_START:.3f}')
+                continue
+
+            for _, labels, value in samples:
+                braces = f'{{{labels}}}' if labels else ''
+                if metric_type != 'counter':
+                    out.append(f'{base}{braces} {value}')
+                    continue
+                line = f'{base}_total{braces} {value}'
+                exemplar = extras.get((name, labels), {}).get('exemplar')
+                if exemplar is not None:
+                    exemplar_labels, exemplar_value, timestamp = exemplar
+                    exemplar_text = ','.join(f'{k}="{v}"' for k, v in exemplar_labels.items())
+                    line += f' # {{{exemplar_text}}} {exemplar_value!r} {timestamp:.3f}'
+                out.append(line)
+                if process_local:
+                    out.append(f'{base}_created{braces} {PROCESS_START:.3f}')
+        if eof:
+            out.append('# EOF')
+        return ('\n'.join(out) + '\n').encode('utf-8')
+
+    def _label_fields(self, labels):
+        return b''.join(
+            pb_field(b'\x0a', pb_field(b'\x0a', k.encode('utf-8')) + pb_field(b'\x12', v.encode('utf-8')))
+            for k, v in self.label_pairs(labels)
+        )
+
+    def protobuf(self, body, extras=None):
+        """Length-delimited io.prometheus.client.MetricFamily messages for a text-format body"""
+        extras = extras or {}
+        out = []
+        for name, help_text, metric_type, samples in parse_text(body):
+            if metric_type not in PB_TYPES or metric_type == 'summary':
+                metric_type = 'untyped'
+            # Same series names as the OpenMetrics format: counters end in _total
+            family_name = name + '_total' if metric_type == 'counter' and not name.endswith('_total') else name
+            process_local = name.startswith(PROCESS_COUNTER_PREFIXES)
+            metrics = []
+
+            if metric_type == 'histogram':
+                for labels, (buckets, total, count) in self._histograms([name, help_text, metric_type, samples]).items():
+                    native = extras.get((name, labels), {}).get('native')
+                    fields = [pb_uint(b'\x08', int(float(count))), pb_double(b'\x11', float(total))]
+                    for le, value in buckets:
+                        if le == '+Inf':
+                            continue
+                        fields.append(pb_field(b'\x1a', pb_uint(b'\x08', int(float(value)))
+                                               + pb_double(b'\x11', float(le))))
+                    if native is not None:
+                        # Count and sum come from the same snapshot as the native buckets
+                        fields[0] = pb_uint(b'\x08', native.count)
+                        fields[1] = pb_double(b'\x11', native.sum)
+                        fields.append(native.encode_fields())
+                    if process_local:
+                        fields.append(pb_timestamp(b'\x7a', PROCESS_START))
+                    metrics.append(self._label_fields(labels) + pb_field(b'\x3a', b''.join(fields)))
+            else:
+                for _, labels, value in samples:
+                    value = pb_double(b'\x09', float(value))
+                    if metric_type == 'counter':
+                        exemplar = extras.get((name, labels), {}).get('exemplar')
+                        if exemplar is not None:
+                            exemplar_labels, exemplar_value, timestamp = exemplar
+                            value += pb_field(b'\x12', b''.join(
+                                pb_field(b'\x0a', pb_field(b'\x0a', k.encode('utf-8'))
+                                         + pb_field(b'\x12', str(v).encode('utf-8')))
+                                for k, v in exemplar_labels.items())
+                                + pb_double(b'\x11', exemplar_value) + pb_timestamp(b'\x1a', timestamp))
+                        if process_local:
+                            value += pb_timestamp(b'\x1a', PROCESS_START)
+                        metric = pb_field(b'\x1a', value)
+                    elif metric_type == 'gauge':
+                        metric = pb_field(b'\x12', value)
+                    else:
+                        metric = pb_field(b'\x2a', value)
+                    metrics.append(self._label_fields(labels) + metric)
+
+            message = [pb_field(b'\x0a', family_name.encode('utf-8'))]
+            if help_text:
+                message.append(pb_field(b'\x12', help_text.encode('utf-8')))
+            message.append(pb_uint(b'\x18', PB_TYPES[metric_type]))
+            message.extend(pb_field(b'\x22', metric) for metric in metrics)
+            message = b''.join(message)
+            out.append(encode_varint(len(message)) + message)
+        return b''.join(out)
@@ -16,6 +16,12 @@ pkill -9 -f esxi_stats_exporter.py
 echo ""
 echo "3. Starting ESXi exporter..."
 cd ~
+for module in exporter_http.py exposition.py exporter_selfstats.py sample_ring.py ssh_pool.py; do
+    if [ ! -f ~/$module ]; then
+        echo "❌ ~/$module missing - copy it next to esxi_stats_exporter.py"
+        exit 1
+    fi
+done
 nohup python3 ~/esxi_stats_exporter.py > /tmp/esxi_stats_exporter.log 2>&1 &
 
 echo ""
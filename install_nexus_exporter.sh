@@ -9,12 +9,12 @@ echo "=== Installing Nexus Switch Prometheus Exporter ==="
 MONITORING_SERVER="192.168.11.152"
 
 # Copy exporter to server
-scp nexus_prometheus_exporter.py versa@${MONITORING_SERVER}:/tmp/
+scp nexus_prometheus_exporter.py exporter_http.py exposition.py exporter_selfstats.py metric_registry.py versa@${MONITORING_SERVER}:/tmp/
 
 # Install and configure
 ssh versa@${MONITORING_SERVER} << 'EOF'
 sudo mkdir -p /opt/nexus_exporter
-sudo mv /tmp/nexus_prometheus_exporter.py /opt/nexus_exporter/
+sudo mv /tmp/nexus_prometheus_exporter.py /tmp/exporter_http.py /tmp/exposition.py /tmp/exporter_selfstats.py /tmp/metric_registry.py /opt/nexus_exporter/
 sudo chmod +x /opt/nexus_exporter/nexus_prometheus_exporter.py
 
 # Create systemd service
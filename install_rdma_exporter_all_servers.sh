@@ -20,6 +20,14 @@ fi
 
 INSTALL_DIR="/opt/rdma_exporter"
 RDMA_USER="rdma_exporter"
+# RDMA_AGENT=1 runs rdma_agent.py instead: one sampling pass serving both
+# the rdma_exporter (9101) and rdma_stats_exporter (9103) metrics
+RDMA_AGENT="${RDMA_AGENT:-0}"
+if [ "$RDMA_AGENT" = "1" ]; then
+    EXPORTER_SCRIPT="rdma_agent.py"
+else
+    EXPORTER_SCRIPT="rdma_exporter.py"
+fi
 
 echo ""
 echo "[1/5] Installing dependencies..."
@@ -40,15 +48,16 @@ echo ""
 echo "[3/5] Installing RDMA exporter..."
 mkdir -p $INSTALL_DIR
 
-# Copy the rdma_exporter.py script (must be present in current directory)
-if [ -f "rdma_exporter.py" ]; then
-    cp rdma_exporter.py $INSTALL_DIR/
-    chmod +x $INSTALL_DIR/rdma_exporter.py
+# Copy the rdma_exporter.py script and its shared modules (must be present in current directory)
+EXPORTER_FILES="rdma_exporter.py exporter_http.py exposition.py exporter_selfstats.py ethtool_stats.py counter_rates.py metric_registry.py remote_write.py sample_ring.py qp_stats.py rdma_stats_exporter.py rdma_agent.py"
+if ls $EXPORTER_FILES >/dev/null 2>&1; then
+    cp $EXPORTER_FILES $INSTALL_DIR/
+    chmod +x $INSTALL_DIR/rdma_exporter.py $INSTALL_DIR/rdma_agent.py
     chown -R $RDMA_USER:$RDMA_USER $INSTALL_DIR
     echo "  ✓ RDMA exporter installed to $INSTALL_DIR"
 else
-    echo "  ✗ ERROR: rdma_exporter.py not found in current directory!"
-    echo "  Please copy rdma_exporter.py to the same directory as this script"
+    echo "  ✗ ERROR: one of $EXPORTER_FILES not found in current directory!"
+    echo "  Please copy $EXPORTER_FILES to the same directory as this script"
     exit 1
 fi
 
@@ -64,7 +73,7 @@ After=network-online.target
 User=root
 Group=root
 Type=simple
-ExecStart=/usr/bin/python3 $INSTALL_DIR/rdma_exporter.py
+ExecStart=/usr/bin/python3 $INSTALL_DIR/$EXPORTER_SCRIPT
 
 Restart=always
 RestartSec=5
@@ -98,6 +107,10 @@ echo "✓ RDMA Exporter installation complete on $(hostname)!"
 echo "============================================================"
 echo ""
 echo "RDMA Exporter is now running on port 9101"
+if [ "$RDMA_AGENT" = "1" ]; then
+    echo "rdma_stats_exporter metrics are served by the same agent on port 9103;"
+    echo "stop and disable any separate rdma_stats_exporter on this host"
+fi
 echo ""
 echo "Test locally:"
 echo "  curl http://localhost:9101/metrics | grep rdma"
@@ -115,5 +128,6 @@ echo "  - rdma_cnp_sent (CNP packets sent)"
 echo "  - rdma_cnp_handled (CNP packets handled)"
 echo "  - rdma_operations (RDMA read/write operations)"
 echo "  - pfc_pause_frames (PFC pause frames per priority)"
+echo "  - ethtool_priority_bytes/packets (per-priority traffic from ethtool -S)"
 echo "  - network_bytes/packets (Network statistics)"
 echo "============================================================"
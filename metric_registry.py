@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Compact metric registry for the exporters
+Label sets are encoded to bytes once; rendering is a single join
+"""
+
+import threading
+from array import array
+
+
+def escape_label_value(value):
+    """Escape a label value for the exposition format"""
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value):
+    """Encode a sample value; integral values are written without a fraction"""
+    if value.is_integer() and abs(value) < 1e18:
+        return b'%d\n' % value
+    return repr(value).encode('ascii') + b'\n'
+
+
+class Series:
+    """One labelled series; its exposition prefix is encoded once"""
+
+    __slots__ = ('family', 'slot', 'labels', 'prefix')
+
+    def __init__(self, family, slot, labels, prefix):
+        self.family = family
+        self.slot = slot
+        # Rendered label string, e.g. 'device="rocep11s0"' (reused as a key elsewhere)
+        self.labels = labels
+        self.prefix = prefix
+
+    def set(self, value):
+        family = self.family
+        family.values[self.slot] = value
+        family.generations[self.slot] = family.registry.generation
+
+
+class MetricFamily:
+    """A metric name with fixed label names; values live in flat arrays"""
+
+    __slots__ = ('registry', 'name', 'labelnames', 'header', 'series_by_key',
+                 'prefixes', 'values', 'generations')
+
+    def __init__(self, registry, name, help_text, metric_type='counter', labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.labelnames = tuple(labelnames)
+        self.header = f"# HELP {name} {help_text}\n# TYPE {name} {metric_type}\n".encode('utf-8')
+        self.series_by_key = {}
+        self.prefixes = []
+        self.values = array('d')
+        self.generations = array('L')
+
+    def labels(self, *values):
+        """Series for the given label values (in labelnames order), created on first use"""
+        series = self.series_by_key.get(values)
+        if series is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            labels = ','.join(f'{name}="{escape_label_value(value)}"'
+                              for name, value in zip(self.labelnames, values))
+            prefix = (f'{self.name}{{{labels}}} ' if labels else f'{self.name} ').encode('utf-8')
+            series = Series(self, len(self.prefixes), labels, prefix)
+            self.prefixes.append(prefix)
+            self.values.append(0.0)
+            self.generations.append(0)
+            self.series_by_key[values] = series
+        return series
+
+    def set(self, values, value):
+        self.labels(*values).set(value)
+
+    def discard_stale(self):
+        """Drop series not set in the current round, for label sets that churn (e.g. QP numbers)"""
+        generation = self.registry.generation
+        kept = [(key, series) for key, series in self.series_by_key.items()
+                if self.generations[series.slot] == generation]
+        values = array('d', (self.values[series.slot] for _, series in kept))
+        self.series_by_key = {}
+        self.prefixes = []
+        for slot, (key, series) in enumerate(kept):
+            series.slot = slot
+            self.series_by_key[key] = series
+            self.prefixes.append(series.prefix)
+        self.values = values
+        self.generations = array('L', [generation] * len(kept))
+
+    def render_into(self, out, generation):
+        """Append the header and every series set in this generation to 'out'"""
+        prefixes, values, generations = self.prefixes, self.values, self.generations
+        header_written = False
+        for slot in range(len(prefixes)):
+            if generations[slot] != generation:
+                continue
+            if not header_written:
+                out.append(self.header)
+                header_written = True
+            out.append(prefixes[slot])
+            out.append(format_value(values[slot]))
+
+
+class MetricRegistry:
+    """Ordered set of metric families rendered together
+
+    Call begin() before each collection; only series set since then are
+    rendered, so vanished devices and timed-out collectors drop out.
+    """
+
+    def __init__(self):
+        self.families = {}
+        self.generation = 0
+        # Held by exporters that collect from concurrent request threads
+        self.lock = threading.Lock()
+
+    def family(self, name, help_text, metric_type='counter', labelnames=()):
+        """Register (or return the existing) metric family"""
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = MetricFamily(self, name, help_text, metric_type, labelnames)
+        return family
+
+    def begin(self):
+        """Start a new collection round"""
+        self.generation += 1
+
+    def render(self):
+        """Exposition text of the current round as bytes"""
+        out = []
+        generation = self.generation
+        for family in self.families.values():
+            family.render_into(out, generation)
+        return b''.join(out)
@@ -4,15 +4,29 @@ Nexus Switch Prometheus Exporter
 Exposes switch metrics for Grafana visualization
 """
 
-from flask import Flask, Response
-import requests
+import argparse
+import http.server
 import json
+import os
 import re
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
 from urllib3.exceptions import InsecureRequestWarning
 
-requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
+import exporter_selfstats
+import exposition
+from exporter_http import serve
+from exporter_selfstats import PROFILER, instrumented, record_bytes, record_error
+from metric_registry import MetricRegistry
 
-app = Flask(__name__)
+requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
 
 # Configuration
 SWITCH_IP = "192.168.50.229"
@@ -22,13 +36,125 @@ INTERFACES = [
     "ethernet1/1/1", "ethernet1/1/2", "ethernet1/2/1", "ethernet1/2/2",  # Physical ports
     "ii1/1/1", "ii1/1/2", "ii1/1/3", "ii1/1/4", "ii1/1/5", "ii1/1/6"     # Internal fabric
 ]
-
-def get_switch_data(command):
+# Show commands per NX-API request; large batches can exceed the switch's response size limit
+BATCH_SIZE = 8
+
+PFC_COMMAND = "show interface priority-flow-control"
+FLOWCONTROL_COMMAND = "show interface flowcontrol"
+
+REGISTRY = MetricRegistry()
+REGISTRY.family('nexus_pfc_rx_pause', 'PFC pause frames received', labelnames=('interface',))
+REGISTRY.family('nexus_pfc_tx_pause', 'PFC pause frames transmitted', labelnames=('interface',))
+REGISTRY.family('nexus_flowcontrol_rx_pause', 'Flow control pause frames received', labelnames=('interface',))
+REGISTRY.family('nexus_flowcontrol_tx_pause', 'Flow control pause frames transmitted', labelnames=('interface',))
+REGISTRY.family('nexus_interface_rx_bytes', 'Interface RX bytes', labelnames=('interface',))
+REGISTRY.family('nexus_interface_tx_bytes', 'Interface TX bytes', labelnames=('interface',))
+REGISTRY.family('nexus_interface_rx_packets', 'Interface RX packets', labelnames=('interface', 'type'))
+REGISTRY.family('nexus_interface_tx_packets', 'Interface TX packets', labelnames=('interface', 'type'))
+REGISTRY.family('nexus_queue_tx_packets', 'Queue TX packets per QoS group', labelnames=('interface', 'qos_group'))
+REGISTRY.family('nexus_queue_tx_bytes', 'Queue TX bytes per QoS group', labelnames=('interface', 'qos_group'))
+REGISTRY.family('nexus_queue_dropped_packets', 'Queue dropped packets per QoS group',
+                labelnames=('interface', 'qos_group'))
+REGISTRY.family('nexus_queue_dropped_bytes', 'Queue dropped bytes per QoS group',
+                labelnames=('interface', 'qos_group'))
+
+class ResumingTLSContext(ssl.SSLContext):
+    """Client TLS context that offers the last session when opening a new connection
+
+    urllib3 wraps every socket through the pool's context, so remembering the
+    session here lets a reconnect (after the switch closes an idle keep-alive
+    connection) resume with an abbreviated handshake instead of a full one.
+    TLS 1.3 tickets only arrive after the handshake, so the session is taken
+    from the previous socket when the next one is wrapped, or when it closes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.session_cache = None
+        self.handshakes = 0
+        self.resumed = 0
+        self._last_socket = None
+        self.sslsocket_class = ResumingTLSSocket
+
+    def remember(self, tls):
+        session = tls.session
+        if session is not None and (session.has_ticket or self.session_cache is None):
+            self.session_cache = session
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        last = self._last_socket and self._last_socket()
+        if last is not None:
+            self.remember(last)
+        if kwargs.get('session') is None:
+            kwargs['session'] = self.session_cache
+        tls = super().wrap_socket(sock, *args, **kwargs)
+        self.handshakes += 1
+        self.resumed += tls.session_reused
+        self._last_socket = weakref.ref(tls)
+        return tls
+
+
+class ResumingTLSSocket(ssl.SSLSocket):
+    """SSLSocket that hands its session back to the context before closing"""
+
+    def close(self):
+        try:
+            self.context.remember(self)
+        except (AttributeError, OSError, ValueError):
+            pass
+        super().close()
+
+
+class NXAPIClient:
+    """NX-API over one keep-alive HTTPS session
+
+    Requests share a small urllib3 pool, so consecutive commands reuse the
+    TCP connection and TLS session. Basic auth is only sent until the switch
+    hands out its 'nxapi_auth' cookie; later requests present the cookie,
+    and a 401 (expired cookie) re-authenticates once. keep_alive=False
+    restores the old behaviour of a fresh connection and login per request;
+    batch_size is how many show commands a scrape packs into one request.
+    """
+
+    def __init__(self, host, username, password, timeout=10, keep_alive=True, pool_size=2,
+                 batch_size=BATCH_SIZE):
+        self.url = f"https://{host}/ins"
+        self.auth = (username, password)
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.batch_size = max(1, batch_size)
+        self.tls = ResumingTLSContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.tls.check_hostname = False
+        self.tls.verify_mode = ssl.CERT_NONE
+        self.session = requests.Session()
+        self.session.headers['content-type'] = 'application/json'
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        adapter.init_poolmanager(1, pool_size, ssl_context=self.tls)
+        self.session.mount('https://', adapter)
+
+    def post(self, payload):
+        """POST an ins_api payload; returns the requests.Response"""
+        if not self.keep_alive:
+            return requests.post(self.url, auth=self.auth, json=payload, verify=False, timeout=self.timeout)
+        with_auth = self.session.cookies.get('nxapi_auth') is None
+        # verify=False per request: Session.verify loses to REQUESTS_CA_BUNDLE in the environment
+        response = self.session.post(self.url, auth=self.auth if with_auth else None,
+                                     json=payload, verify=False, timeout=self.timeout)
+        if response.status_code == 401 and not with_auth:
+            self.session.cookies.clear()
+            response = self.session.post(self.url, auth=self.auth, json=payload, verify=False,
+                                         timeout=self.timeout)
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+CLIENT = NXAPIClient(SWITCH_IP, USERNAME, PASSWORD)
+
+
+def get_switch_data(command, client=None):
     """Execute CLI command on Nexus switch via NX-API"""
-    url = f"https://{SWITCH_IP}/ins"
-    headers = {
-        'content-type': 'application/json'
-    }
     payload = {
         "ins_api": {
             "version": "1.0",
@@ -41,29 +167,87 @@ def get_switch_data(command):
     }
 
     try:
-        response = requests.post(
-            url,
-            auth=(USERNAME, PASSWORD),
-            headers=headers,
-            json=payload,
-            verify=False,
-            timeout=10
-        )
+        response = (client or CLIENT).post(payload)
+        record_bytes(len(response.content))
         if response.status_code == 200:
             return response.json()
+        record_error()
         return None
     except Exception as e:
         print(f"Error querying switch: {e}")
+        record_error()
         return None
 
-def parse_pfc_stats():
+def counters_command(interface):
+    return f"show interface {interface} counters"
+
+
+def queuing_command(interface):
+    return f"show queuing interface {interface}"
+
+
+def scrape_commands():
+    """Show commands needed for one scrape, in the order they are sent"""
+    commands = [PFC_COMMAND, FLOWCONTROL_COMMAND]
+    commands += [counters_command(interface) for interface in INTERFACES]
+    commands += [queuing_command(interface) for interface in INTERFACES]
+    return commands
+
+
+def split_outputs(data, commands):
+    """Demultiplex a batched cli_show response into {command: body}
+
+    NX-API answers ' ;'-separated input with one entry per command in
+    outputs.output (a list, or a single dict for one command), each with its
+    own code and the command it answers echoed in 'input'; outputs are matched
+    on that echo, failed or unmatched ones are reported and left out.
+    """
+    outputs = data['ins_api']['outputs']['output']
+    if isinstance(outputs, dict):
+        outputs = [outputs]
+    wanted = {' '.join(command.split()): command for command in commands}
+    bodies = {}
+    for output in outputs:
+        command = wanted.get(' '.join(str(output.get('input', '')).split()))
+        if command is None:
+            print(f"Error querying switch: unexpected output for '{output.get('input')}'")
+            record_error()
+        elif str(output.get('code')) == '200' and 'body' in output:
+            bodies[command] = output['body']
+        else:
+            print(f"Error from switch for '{command}': {output.get('msg', 'no output')}")
+            record_error()
+    if len(outputs) != len(commands):
+        print(f"Error querying switch: {len(outputs)} outputs for {len(commands)} commands")
+        record_error()
+    return bodies
+
+
+@instrumented('get_switch_outputs')
+def get_switch_outputs(commands, client=None):
+    """Run show commands in batches of the client's batch_size per NX-API request; returns {command: body}"""
+    client = client or CLIENT
+    bodies = {}
+    for start in range(0, len(commands), client.batch_size):
+        batch = commands[start:start + client.batch_size]
+        data = get_switch_data(' ;'.join(batch), client)
+        if data and 'ins_api' in data:
+            try:
+                bodies.update(split_outputs(data, batch))
+            except Exception as e:
+                print(f"Error parsing switch response: {e}")
+                record_error()
+    return bodies
+
+
+@instrumented('parse_pfc_stats')
+def parse_pfc_stats(bodies):
     """Get PFC pause frame statistics"""
-    metrics = []
-    data = get_switch_data("show interface priority-flow-control")
+    families = REGISTRY.families
+    body = bodies.get(PFC_COMMAND)
 
-    if data and 'ins_api' in data:
+    if body is not None:
         try:
-            body = data['ins_api']['outputs']['output']['body']
             if 'TABLE_module' in body:
                 modules = body['TABLE_module']['ROW_module']
                 if not isinstance(modules, list):
@@ -82,23 +266,23 @@ def parse_pfc_stats():
                                 rx_stats = int(intf.get('rx-stats', 0))
                                 tx_stats = int(intf.get('tx-stats', 0))
 
-                                metrics.append(f'nexus_pfc_rx_pause{{interface="{interface}"}} {rx_stats}')
-                                metrics.append(f'nexus_pfc_tx_pause{{interface="{interface}"}} {tx_stats}')
+                                families['nexus_pfc_rx_pause'].labels(interface).set(rx_stats)
+                                families['nexus_pfc_tx_pause'].labels(interface).set(tx_stats)
         except Exception as e:
             print(f"Error parsing PFC stats: {e}")
+            record_error()
 
-    return metrics
 
-def parse_interface_counters():
+@instrumented('parse_interface_counters')
+def parse_interface_counters(bodies):
     """Get interface counters"""
-    metrics = []
+    families = REGISTRY.families
 
     for interface in INTERFACES:
-        data = get_switch_data(f"show interface {interface} counters")
+        body = bodies.get(counters_command(interface))
 
-        if data and 'ins_api' in data:
+        if body is not None:
             try:
-                body = data['ins_api']['outputs']['output']['body']
                 if 'TABLE_rx_counters' in body:
                     rx_rows = body['TABLE_rx_counters']['ROW_rx_counters']
                     if not isinstance(rx_rows, list):
@@ -115,10 +299,10 @@ def parse_interface_counters():
                         rx_broadcast += int(rx_data.get('eth_inbcast', 0))
                         rx_bytes += int(rx_data.get('eth_inbytes', 0))
 
-                    metrics.append(f'nexus_interface_rx_packets{{interface="{interface}",type="unicast"}} {rx_unicast}')
-                    metrics.append(f'nexus_interface_rx_packets{{interface="{interface}",type="multicast"}} {rx_multicast}')
-                    metrics.append(f'nexus_interface_rx_packets{{interface="{interface}",type="broadcast"}} {rx_broadcast}')
-                    metrics.append(f'nexus_interface_rx_bytes{{interface="{interface}"}} {rx_bytes}')
+                    families['nexus_interface_rx_packets'].labels(interface, 'unicast').set(rx_unicast)
+                    families['nexus_interface_rx_packets'].labels(interface, 'multicast').set(rx_multicast)
+                    families['nexus_interface_rx_packets'].labels(interface, 'broadcast').set(rx_broadcast)
+                    families['nexus_interface_rx_bytes'].labels(interface).set(rx_bytes)
 
                 if 'TABLE_tx_counters' in body:
                     tx_rows = body['TABLE_tx_counters']['ROW_tx_counters']
@@ -136,25 +320,25 @@ def parse_interface_counters():
                         tx_broadcast += int(tx_data.get('eth_outbcast', 0))
                         tx_bytes += int(tx_data.get('eth_outbytes', 0))
 
-                    metrics.append(f'nexus_interface_tx_packets{{interface="{interface}",type="unicast"}} {tx_unicast}')
-                    metrics.append(f'nexus_interface_tx_packets{{interface="{interface}",type="multicast"}} {tx_multicast}')
-                    metrics.append(f'nexus_interface_tx_packets{{interface="{interface}",type="broadcast"}} {tx_broadcast}')
-                    metrics.append(f'nexus_interface_tx_bytes{{interface="{interface}"}} {tx_bytes}')
+                    families['nexus_interface_tx_packets'].labels(interface, 'unicast').set(tx_unicast)
+                    families['nexus_interface_tx_packets'].labels(interface, 'multicast').set(tx_multicast)
+                    families['nexus_interface_tx_packets'].labels(interface, 'broadcast').set(tx_broadcast)
+                    families['nexus_interface_tx_bytes'].labels(interface).set(tx_bytes)
             except Exception as e:
                 print(f"Error parsing interface {interface}: {e}")
+                record_error()
 
-    return metrics
 
-def parse_queue_stats():
+@instrumented('parse_queue_stats')
+def parse_queue_stats(bodies):
     """Get queuing statistics with TX traffic per QoS group"""
-    metrics = []
+    families = REGISTRY.families
 
     for interface in INTERFACES:
-        data = get_switch_data(f"show queuing interface {interface}")
+        body = bodies.get(queuing_command(interface))
 
-        if data and 'ins_api' in data:
+        if body is not None:
             try:
-                body = data['ins_api']['outputs']['output']['body']
                 module_table = body.get('TABLE_module', {})
                 module_row = module_table.get('ROW_module', {})
                 queue_if_table = module_row.get('TABLE_queuing_interface', {})
@@ -209,24 +393,24 @@ def parse_queue_stats():
                             elif stat_type == 'Dropped' and stat_units == 'Byts':
                                 dropped_bytes = total
 
-                        metrics.append(f'nexus_queue_tx_packets{{interface="{interface}",qos_group="{qos_label}"}} {tx_pkts}')
-                        metrics.append(f'nexus_queue_tx_bytes{{interface="{interface}",qos_group="{qos_label}"}} {tx_bytes}')
-                        metrics.append(f'nexus_queue_dropped_packets{{interface="{interface}",qos_group="{qos_label}"}} {dropped_pkts}')
-                        metrics.append(f'nexus_queue_dropped_bytes{{interface="{interface}",qos_group="{qos_label}"}} {dropped_bytes}')
+                        families['nexus_queue_tx_packets'].labels(interface, qos_label).set(tx_pkts)
+                        families['nexus_queue_tx_bytes'].labels(interface, qos_label).set(tx_bytes)
+                        families['nexus_queue_dropped_packets'].labels(interface, qos_label).set(dropped_pkts)
+                        families['nexus_queue_dropped_bytes'].labels(interface, qos_label).set(dropped_bytes)
 
             except Exception as e:
                 print(f"Error parsing queue stats for {interface}: {e}")
+                record_error()
 
-    return metrics
 
-def parse_flowcontrol_stats():
+@instrumented('parse_flowcontrol_stats')
+def parse_flowcontrol_stats(bodies):
     """Get flow control statistics"""
-    metrics = []
-    data = get_switch_data("show interface flowcontrol")
+    families = REGISTRY.families
+    body = bodies.get(FLOWCONTROL_COMMAND)
 
-    if data and 'ins_api' in data:
+    if body is not None:
         try:
-            body = data['ins_api']['outputs']['output']['body']
             if 'TABLE_flowcontrol' in body:
                 interfaces = body['TABLE_flowcontrol']['ROW_flowcontrol']
                 if not isinstance(interfaces, list):
@@ -239,69 +423,171 @@ def parse_flowcontrol_stats():
                         rx_pause = int(intf.get('rx-pause', 0))
                         tx_pause = int(intf.get('tx-pause', 0))
 
-                        metrics.append(f'nexus_flowcontrol_rx_pause{{interface="{interface}"}} {rx_pause}')
-                        metrics.append(f'nexus_flowcontrol_tx_pause{{interface="{interface}"}} {tx_pause}')
+                        families['nexus_flowcontrol_rx_pause'].labels(interface).set(rx_pause)
+                        families['nexus_flowcontrol_tx_pause'].labels(interface).set(tx_pause)
         except Exception as e:
             print(f"Error parsing flow control stats: {e}")
+            record_error()
+
 
-    return metrics
-
-@app.route('/metrics')
-def metrics():
-    """Prometheus metrics endpoint"""
-    all_metrics = []
-
-    # Collect all metrics
-    all_metrics.extend(parse_pfc_stats())
-    all_metrics.extend(parse_interface_counters())
-    all_metrics.extend(parse_queue_stats())
-    all_metrics.extend(parse_flowcontrol_stats())
-
-    # Add metadata
-    output = "# HELP nexus_pfc_rx_pause PFC pause frames received\n"
-    output += "# TYPE nexus_pfc_rx_pause counter\n"
-    output += "# HELP nexus_pfc_tx_pause PFC pause frames transmitted\n"
-    output += "# TYPE nexus_pfc_tx_pause counter\n"
-    output += "# HELP nexus_flowcontrol_rx_pause Flow control pause frames received\n"
-    output += "# TYPE nexus_flowcontrol_rx_pause counter\n"
-    output += "# HELP nexus_flowcontrol_tx_pause Flow control pause frames transmitted\n"
-    output += "# TYPE nexus_flowcontrol_tx_pause counter\n"
-    output += "# HELP nexus_interface_rx_bytes Interface RX bytes\n"
-    output += "# TYPE nexus_interface_rx_bytes counter\n"
-    output += "# HELP nexus_interface_tx_bytes Interface TX bytes\n"
-    output += "# TYPE nexus_interface_tx_bytes counter\n"
-    output += "# HELP nexus_interface_rx_packets Interface RX packets\n"
-    output += "# TYPE nexus_interface_rx_packets counter\n"
-    output += "# HELP nexus_interface_tx_packets Interface TX packets\n"
-    output += "# TYPE nexus_interface_tx_packets counter\n"
-    output += "# HELP nexus_queue_tx_packets Queue TX packets per QoS group\n"
-    output += "# TYPE nexus_queue_tx_packets counter\n"
-    output += "# HELP nexus_queue_tx_bytes Queue TX bytes per QoS group\n"
-    output += "# TYPE nexus_queue_tx_bytes counter\n"
-    output += "# HELP nexus_queue_dropped_packets Queue dropped packets per QoS group\n"
-    output += "# TYPE nexus_queue_dropped_packets counter\n"
-    output += "# HELP nexus_queue_dropped_bytes Queue dropped bytes per QoS group\n"
-    output += "# TYPE nexus_queue_dropped_bytes counter\n"
-    output += "\n"
-
-    output += "\n".join(all_metrics)
-    output += "\n"
-
-    return Response(output, mimetype='text/plain')
-
-@app.route('/health')
-def health():
+@PROFILER.profiled
+def metrics(query=None, client=None):
+    """Prometheus metrics endpoint; 'client' defaults to the module's NX-API session"""
+    # Concurrent scrapes share the registry, so collect and render one at a time
+    with REGISTRY.lock:
+        REGISTRY.begin()
+        bodies = get_switch_outputs(scrape_commands(), client)
+        parse_pfc_stats(bodies)
+        parse_interface_counters(bodies)
+        parse_queue_stats(bodies)
+        parse_flowcontrol_stats(bodies)
+        body = REGISTRY.render()
+
+    return body + ("\n".join(exporter_selfstats.render()) + "\n").encode('utf-8')
+
+def health(query=None):
     """Health check endpoint"""
     return "OK"
 
+ROUTES = {
+    '/metrics': metrics,
+    '/health': health,
+    '/debug/profile': PROFILER.route,
+}
+
+
+class NXAPIStandIn(http.server.ThreadingHTTPServer):
+    """Local HTTPS server answering NX-API cli_show requests (batched too) with empty bodies
+
+    Mimics the parts that matter for connection cost: HTTP/1.1 keep-alive,
+    TLS with session resumption, and an 'nxapi_auth' cookie issued on basic
+    auth. Counts accepted connections and logins for the benchmark.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        super().__init__(('127.0.0.1', port), NXAPIStandInHandler)
+        self.connections = 0
+        self.requests = 0
+        self.logins = 0
+        self.tokens = set()
+        self._certdir = tempfile.TemporaryDirectory(prefix='nxapi-standin-')
+        cert = os.path.join(self._certdir.name, 'cert.pem')
+        key = os.path.join(self._certdir.name, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                        '-subj', '/CN=localhost', '-keyout', key, '-out', cert],
+                       check=True, capture_output=True)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+    def get_request(self):
+        request = super().get_request()
+        self.connections += 1
+        return request
+
+    def server_close(self):
+        super().server_close()
+        self._certdir.cleanup()
+
+
+class NXAPIStandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body in one segment, or delayed ACKs dominate the timings
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        self.server.requests += 1
+        cookie = self.headers.get('Cookie', '')
+        token = cookie.partition('nxapi_auth=')[2].split(';')[0]
+        new_token = None
+        if token not in self.server.tokens:
+            if not self.headers.get('Authorization', '').startswith('Basic '):
+                self.send_response(401)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.server.logins += 1
+            new_token = os.urandom(8).hex()
+            self.server.tokens.add(new_token)
+
+        commands = payload.get('ins_api', {}).get('input', '').split(' ;')
+        outputs = [{'input': command.strip(), 'msg': 'Success', 'code': '200', 'body': {}}
+                   for command in commands]
+        body = json.dumps({'ins_api': {'type': 'cli_show', 'version': '1.0', 'sid': 'eoc',
+                                       'outputs': {'output': outputs if len(outputs) > 1 else outputs[0]}}})
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if new_token:
+            self.send_header('Set-Cookie', f'nxapi_auth={new_token}; Secure; HttpOnly')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_benchmark(iterations=20, batch_size=BATCH_SIZE):
+    """Compare per-request connections, the keep-alive session and batched commands against a local stand-in"""
+    server = NXAPIStandIn()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = f'127.0.0.1:{server.server_address[1]}'
+    print(f"Benchmarking {iterations} scrapes against a local NX-API stand-in ({host})")
+    try:
+        for label, keep_alive, batch in (('per-request', False, 1), ('session', True, 1),
+                                         (f'batch of {batch_size}', True, batch_size)):
+            client = NXAPIClient(host, USERNAME, PASSWORD, keep_alive=keep_alive, batch_size=batch)
+            connections, logins, requests_served = server.connections, server.logins, server.requests
+            started = time.perf_counter()
+            for _ in range(iterations):
+                metrics(client=client)
+            wall_ms = (time.perf_counter() - started) * 1000 / iterations
+            print(f"  {label:<12} {wall_ms:8.2f} ms/scrape  "
+                  f"{(server.requests - requests_served) / iterations:5.1f} requests/scrape  "
+                  f"{(server.connections - connections) / iterations:5.1f} TLS handshakes/scrape  "
+                  f"({client.tls.resumed} resumed)  {(server.logins - logins) / iterations:5.1f} logins/scrape")
+            client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Nexus Switch Prometheus Exporter')
+    parser.add_argument('--port', type=int, default=9102, help='Port to listen on (default: 9102)')
+    parser.add_argument('--no-keep-alive', dest='keep_alive', action='store_false',
+                        help='Open a new connection and log in for every NX-API request')
+    parser.add_argument('--benchmark', type=int, metavar='N', nargs='?', const=20,
+                        help='Time N scrapes against a local NX-API stand-in per request, with the '
+                             'keep-alive session and with batched commands, and exit')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, metavar='N',
+                        help='Show commands per NX-API request; lower it if the switch rejects '
+                             f'large responses, 1 sends one request per command (default: {BATCH_SIZE})')
+    exposition.add_arguments(parser)
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    print("=" * 60)
-    print("  Nexus Switch Prometheus Exporter")
-    print("=" * 60)
-    print(f"  Switch: {SWITCH_IP}")
-    print(f"  Interfaces: {', '.join(INTERFACES)}")
-    print(f"  Metrics endpoint: http://0.0.0.0:9102/metrics")
-    print("=" * 60)
-    print()
-
-    app.run(host='0.0.0.0', port=9102, debug=False)
+    args = parse_args()
+    if args.benchmark:
+        run_benchmark(args.benchmark, args.batch_size)
+    else:
+        CLIENT.keep_alive = args.keep_alive
+        exposition.enable_formats(args.exposition_formats)
+        CLIENT.batch_size = max(1, args.batch_size)
+        print("=" * 60)
+        print("  Nexus Switch Prometheus Exporter")
+        print("=" * 60)
+        print(f"  Switch: {SWITCH_IP}")
+        print(f"  Interfaces: {', '.join(INTERFACES)}")
+        print(f"  NX-API batch size: {CLIENT.batch_size} commands")
+        print(f"  Metrics endpoint: http://0.0.0.0:{args.port}/metrics")
+        print("=" * 60)
+        print()
+
+        serve(ROUTES, args.port)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Per-QP RDMA statistics with bounded cardinality
+Parses 'rdma statistic qp show' into an array-backed table and exports the top K QPs
+"""
+
+import heapq
+import sys
+from array import array
+
+from exporter_selfstats import instrumented, record_error, run_command
+
+# 'rdma statistic qp' counter -> metric name
+QP_COUNTERS = {
+    'rx_bytes': 'rdma_qp_rx_bytes',
+    'tx_bytes': 'rdma_qp_tx_bytes',
+    'rx_write_requests': 'rdma_qp_rx_write_requests',
+    'rx_read_requests': 'rdma_qp_rx_read_requests',
+    'np_ecn_marked_roce_packets': 'rdma_qp_ecn_marked_packets',
+    'np_cnp_sent': 'rdma_qp_cnp_sent',
+    'rp_cnp_handled': 'rdma_qp_cnp_handled',
+    'out_of_sequence': 'rdma_qp_out_of_sequence',
+    'packet_seq_err': 'rdma_qp_packet_seq_err',
+    'implied_nak_seq_err': 'rdma_qp_implied_nak_seq_err',
+    'local_ack_timeout_err': 'rdma_qp_ack_timeout_err',
+    'rnr_nak_retry_err': 'rdma_qp_rnr_nak_retry_err',
+    'roce_adp_retrans': 'rdma_qp_adaptive_retransmits',
+}
+
+QP_COUNTER_HELP = {
+    'rdma_qp_rx_bytes': 'Bytes received on the QP',
+    'rdma_qp_tx_bytes': 'Bytes sent on the QP',
+    'rdma_qp_rx_write_requests': 'RDMA write requests received on the QP',
+    'rdma_qp_rx_read_requests': 'RDMA read requests received on the QP',
+    'rdma_qp_ecn_marked_packets': 'ECN-marked RoCE packets received on the QP',
+    'rdma_qp_cnp_sent': 'CNP packets sent for the QP',
+    'rdma_qp_cnp_handled': 'CNP packets handled by the QP',
+    'rdma_qp_out_of_sequence': 'Out-of-sequence packets received on the QP',
+    'rdma_qp_packet_seq_err': 'Packet sequence errors on the QP',
+    'rdma_qp_implied_nak_seq_err': 'Implied NAK sequence errors on the QP',
+    'rdma_qp_ack_timeout_err': 'Local ACK timeouts (retransmits) on the QP',
+    'rdma_qp_rnr_nak_retry_err': 'RNR NAK retries exceeded on the QP',
+    'rdma_qp_adaptive_retransmits': 'Adaptive retransmissions on the QP',
+}
+
+# Counters summed into each ranking key; the per-interval delta decides the top K
+QP_RANK_COUNTERS = {
+    'bytes': ('rx_bytes', 'tx_bytes'),
+    'cnp': ('np_cnp_sent', 'rp_cnp_handled', 'np_ecn_marked_roce_packets'),
+    'retransmit': ('local_ack_timeout_err', 'packet_seq_err', 'out_of_sequence',
+                   'implied_nak_seq_err', 'rnr_nak_retry_err', 'roce_adp_retrans'),
+}
+
+QP_LABELS = ('device', 'port', 'qp', 'comm')
+OTHER_QP = 'other'
+
+# Per-QP rows only exist for QPs bound to a counter; auto mode binds new ones
+BIND_HINT = "rdma statistic qp set link <dev>/<port> auto type on"
+_warned_unbound = False
+
+
+def register_families(registry):
+    """Register the per-QP metric families on a MetricRegistry"""
+    for name in QP_COUNTERS.values():
+        registry.family(name, QP_COUNTER_HELP[name], labelnames=QP_LABELS)
+    registry.family('rdma_qp_tracked', 'QP counters seen on the link in the last collection',
+                    'gauge', ('device', 'port'))
+
+
+def parse_qp_stats(text):
+    """Parse 'rdma statistic qp show' output into [(device, port, qp, comm, {counter: value})]
+
+    Each bound counter is printed as 'link <dev>/<port> cntn <n> [qp-type ..]
+    [pid .. comm ..] <counter> <value> ...' followed by 'LQPN: <qpns>'; the
+    LQPN list (e.g. '178' or '178-180,182') becomes the qp label.
+    """
+    records = []
+    tokens = text.split()
+    record = None
+    i = 0
+    while i < len(tokens) - 1:
+        name, value = tokens[i], tokens[i + 1]
+        i += 2
+        if name == 'link':
+            device, _, port = value.partition('/')
+            record = [device, port, None, '', {}]
+            records.append(record)
+        elif record is None:
+            continue
+        elif name == 'LQPN:':
+            record[2] = value.strip('<>')
+        elif name == 'comm':
+            record[3] = value
+        elif value.isdigit():
+            record[4][name] = int(value)
+    # Counters without bound QPs carry nothing to attribute
+    return [tuple(record) for record in records if record[2]]
+
+
+def warn_if_unbound(text):
+    """Print once while 'rdma statistic qp show' lists no bound counters at all"""
+    global _warned_unbound
+    bound = any(line.startswith('link ') for line in text.splitlines())
+    if not bound and not _warned_unbound:
+        print(f"Warning: no QP counters are bound, so per-QP metrics stay empty; run '{BIND_HINT}'")
+    _warned_unbound = not bound
+
+
+@instrumented('read_qp_stats')
+def read_qp_stats(target=None):
+    """Run 'rdma statistic qp show' once for every link"""
+    try:
+        result = run_command(['rdma', 'statistic', 'qp', 'show'],
+                             capture_output=True, text=True, timeout=5)
+    except Exception as e:
+        print(f"Error getting QP stats: {e}")
+        record_error()
+        return []
+    if result.returncode != 0:
+        record_error()
+        return []
+    warn_if_unbound(result.stdout)
+    return parse_qp_stats(result.stdout)
+
+
+class QPStatsTable:
+    """QP counters in flat arrays, exported as the top K QPs per link plus 'other'
+
+    Row r holds QP_COUNTERS values at [r * width, (r + 1) * width) of
+    'values', and the change since the previous update in 'deltas'. Rows of
+    vanished QPs are reused. Each update the K QPs per link with the largest
+    delta of the rank counters are exported; deltas of every other QP are
+    added to a per-link 'other' series, which therefore stays monotonic as
+    QPs move in and out of the top K. Those deltas are also kept per row in
+    'attributed' and subtracted from the QP's own series, so a QP that
+    re-enters the top K continues from where it left off and no interval
+    is counted both in 'other' and in the QP.
+    """
+
+    def __init__(self, top_k=10, rank_by='cnp'):
+        if rank_by not in QP_RANK_COUNTERS:
+            raise ValueError(f"Unknown QP rank '{rank_by}', expected one of {tuple(QP_RANK_COUNTERS)}")
+        self.top_k = max(1, top_k)
+        self.rank_by = rank_by
+        self.counters = list(QP_COUNTERS)
+        self.columns = {name: column for column, name in enumerate(self.counters)}
+        self.width = len(self.counters)
+        self.rank_columns = [self.columns[name] for name in QP_RANK_COUNTERS[rank_by]]
+        # Ties (e.g. drivers without byte counters) go to the QP with the most activity overall
+        self.tie_columns = sorted({self.columns[name] for names in QP_RANK_COUNTERS.values() for name in names})
+        self.values = array('d')
+        self.deltas = array('d')
+        self.attributed = array('d')
+        self.seen = array('L')
+        self.rows = {}
+        self.comms = []
+        self.free = []
+        self.generation = 0
+        # Columns any record has carried; counters the driver lacks are not exported
+        self.reported = set()
+        # (device, port) -> array of accumulated deltas of QPs outside the top K
+        self.other = {}
+
+    def _allocate(self, key, comm):
+        width = self.width
+        if self.free:
+            row = self.free.pop()
+            base = row * width
+            for column in range(width):
+                self.values[base + column] = 0.0
+                self.deltas[base + column] = 0.0
+                self.attributed[base + column] = 0.0
+            self.comms[row] = comm
+        else:
+            row = len(self.seen)
+            self.values.extend([0.0] * width)
+            self.deltas.extend([0.0] * width)
+            self.attributed.extend([0.0] * width)
+            self.seen.append(0)
+            self.comms.append(comm)
+        self.rows[key] = row
+        return row
+
+    def update(self, records, devices=None):
+        """Fold one 'parse_qp_stats' result into the table (optionally only for 'devices')"""
+        self.generation += 1
+        generation = self.generation
+        values, deltas, columns, width = self.values, self.deltas, self.columns, self.width
+        for device, port, qp, comm, counters in records:
+            if devices is not None and device not in devices:
+                continue
+            key = (device, port, qp)
+            row = self.rows.get(key)
+            fresh = row is None
+            if fresh:
+                row = self._allocate(key, comm)
+            base = row * width
+            for name, value in counters.items():
+                column = columns.get(name)
+                if column is None:
+                    continue
+                self.reported.add(column)
+                previous = values[base + column]
+                # First sight has no interval to attribute; a drop is a counter reset
+                if fresh:
+                    deltas[base + column] = 0.0
+                elif value >= previous:
+                    deltas[base + column] = value - previous
+                else:
+                    deltas[base + column] = value
+                    self.attributed[base + column] = 0.0
+                values[base + column] = value
+            self.seen[row] = generation
+
+        for key, row in list(self.rows.items()):
+            if self.seen[row] != generation:
+                del self.rows[key]
+                self.free.append(row)
+
+    def _score(self, row):
+        base = row * self.width
+        deltas = self.deltas
+        return (sum(deltas[base + column] for column in self.rank_columns),
+                sum(deltas[base + column] for column in self.tie_columns))
+
+    def export(self, families):
+        """Set the top K QPs and the 'other' series of each link in a registry's families"""
+        by_link = {}
+        for (device, port, qp), row in self.rows.items():
+            by_link.setdefault((device, port), []).append((qp, row))
+
+        metric_families = [(column, families[QP_COUNTERS[self.counters[column]]])
+                           for column in sorted(self.reported)]
+        values, deltas, attributed, width = self.values, self.deltas, self.attributed, self.width
+        for link, qps in by_link.items():
+            families['rdma_qp_tracked'].labels(*link).set(len(qps))
+            if len(qps) > self.top_k:
+                top = heapq.nlargest(self.top_k, qps, key=lambda item: self._score(item[1]))
+                other = self.other.get(link)
+                if other is None:
+                    other = self.other[link] = array('d', [0.0] * width)
+                top_rows = {row for _, row in top}
+                for _, row in qps:
+                    if row not in top_rows:
+                        base = row * width
+                        for column in range(width):
+                            other[column] += deltas[base + column]
+                            attributed[base + column] += deltas[base + column]
+            else:
+                top = qps
+
+            for qp, row in top:
+                base = row * width
+                labels = link + (qp, self.comms[row])
+                for column, family in metric_families:
+                    family.labels(*labels).set(values[base + column] - attributed[base + column])
+
+        # Once a link has overflowed keep exporting its 'other' series
+        for link, other in self.other.items():
+            labels = link + (OTHER_QP, '')
+            for column, family in metric_families:
+                family.labels(*labels).set(other[column])
+
+        # QP numbers are not reused for long; drop series of QPs that left the top K
+        limit = 4 * (self.top_k + 1) * max(1, len(by_link))
+        for _, family in metric_families:
+            if len(family.prefixes) > limit:
+                family.discard_stale()
+
+
+if __name__ == '__main__':
+    # Print the parsed records of 'rdma statistic qp show' (or a saved copy)
+    text = open(sys.argv[1]).read() if len(sys.argv) > 1 else None
+    records = parse_qp_stats(text) if text is not None else read_qp_stats()
+    for device, port, qp, comm, counters in records:
+        print(f"{device}/{port} qp {qp} {comm}: {counters}")
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Per-host RDMA agent
+One sampling pass per interval serves both the rdma_exporter (9101) and
+rdma_stats_exporter (9103) metric names
+"""
+
+import os
+import threading
+
+import exposition
+import rdma_exporter
+import rdma_stats_exporter
+import remote_write
+import sample_ring
+from exporter_http import Payload, compute_etag, make_server
+from exporter_selfstats import PROFILER
+from rdma_exporter import RDMA_COUNTER_MAP, SYSFS_NET, RDMAMetricsCollector
+from rdma_stats_exporter import InterfaceFilter, read_net_dev
+
+# rdma_exporter netdev statistic -> /proc/net/dev column
+NETDEV_COLUMNS = {
+    'rx_bytes': 0,
+    'rx_packets': 1,
+    'rx_dropped': 3,
+    'tx_bytes': 8,
+    'tx_packets': 9,
+    'tx_dropped': 11,
+}
+
+# mlx5 exposes the DCQCN notification (np) and reaction (rp) point settings here
+DCQCN_POINTS = ('roce_np', 'roce_rp')
+
+
+class DCQCNParamsCollector:
+    """Collector plugin exporting DCQCN parameters from <netdev>/ecn/roce_{np,rp}
+
+    Per-priority enable flags become rdma_dcqcn_enabled, every other integer
+    attribute (cnp_dscp, rpg_ai_rate, min_time_between_cnps, ...) an
+    rdma_dcqcn_parameter gauge. Interfaces without the ecn directory (non-mlx5
+    drivers) are skipped.
+    """
+
+    def __init__(self):
+        # interface -> [(point, directory, parameter names)], listed once
+        self._layouts = {}
+
+    def register(self, registry):
+        registry.family('rdma_dcqcn_enabled', 'Whether DCQCN is enabled for the priority (1/0)',
+                        'gauge', ('interface', 'point', 'priority'))
+        registry.family('rdma_dcqcn_parameter', 'DCQCN parameter value from sysfs',
+                        'gauge', ('interface', 'point', 'parameter'))
+
+    def tasks(self, collector):
+        for interface in set(self._layouts) - set(collector.network_interfaces):
+            del self._layouts[interface]
+        return [('dcqcn', interface, lambda interface: self.read(collector.sysfs, interface))
+                for interface in collector.network_interfaces]
+
+    def layout(self, interface):
+        layout = self._layouts.get(interface)
+        if layout is None:
+            layout = []
+            for point in DCQCN_POINTS:
+                directory = f'{SYSFS_NET}/{interface}/ecn/{point}'
+                try:
+                    names = sorted(name for name in os.listdir(directory) if name != 'enable')
+                except OSError:
+                    continue
+                layout.append((point, directory, names))
+            self._layouts[interface] = layout
+        return layout
+
+    def read(self, sysfs, interface):
+        """{point: ({priority: enabled}, {parameter: value})}"""
+        params = {}
+        for point, directory, names in self.layout(interface):
+            enabled = sysfs.read_counters(f'{directory}/enable', [str(prio) for prio in range(8)])
+            params[point] = (enabled, sysfs.read_counters(directory, names))
+        return params
+
+    def export(self, collector, results, families):
+        enabled_family = families['rdma_dcqcn_enabled']
+        parameter_family = families['rdma_dcqcn_parameter']
+        for interface in collector.network_interfaces:
+            if ('dcqcn', interface) not in results:
+                continue
+            params, _ = results[('dcqcn', interface)]
+            for point, (enabled, values) in params.items():
+                for priority, value in enabled.items():
+                    enabled_family.labels(interface, point, priority).set(value)
+                for name, value in values.items():
+                    parameter_family.labels(interface, point, name).set(value)
+
+
+class RDMAAgent(RDMAMetricsCollector):
+    """RDMAMetricsCollector that also renders the rdma_stats_exporter view
+
+    Each pass reads /proc/net/dev once for every interface (replacing the
+    per-interface netdev reads) and the RDMA counters once per device; the
+    9101 body is returned as usual and the 9103 body is kept in
+    'stats_snapshot' as (body, etag).
+    """
+
+    def __init__(self, interface_filter=None, **kwargs):
+        self.interface_filter = interface_filter or InterfaceFilter()
+        self.stats_snapshot = (b'', compute_etag(b''))
+        super().__init__(**kwargs)
+
+    def collector_tasks(self):
+        tasks = [task for task in super().collector_tasks() if task[0] != 'netdev']
+        tasks.append(('netdev', 'all', self.read_net_dev))
+        return tasks
+
+    def read_net_dev(self, target):
+        scraped = set(self.network_interfaces)
+        return read_net_dev(wanted=lambda name: name in scraped or self.interface_filter(name))
+
+    @PROFILER.profiled
+    def collect_all_metrics(self):
+        results, up = self.sample()
+        net_stats, net_collected_at = results.pop(('netdev', 'all'), ({}, None))
+        for interface in self.network_interfaces:
+            values = net_stats.get(interface)
+            if values is not None:
+                results[('netdev', interface)] = (
+                    {name: values[column] for name, column in NETDEV_COLUMNS.items()}, net_collected_at)
+
+        body = self.render_stats(results, net_stats, net_collected_at)
+        self.stats_snapshot = (body, compute_etag(body))
+        return self.render(results, up)
+
+    def render_stats(self, results, net_stats, net_collected_at):
+        """Render the pass with rdma_stats_exporter metric names (bytes)"""
+        registry = rdma_stats_exporter.REGISTRY
+        with registry.lock:
+            registry.begin()
+            for device in self.rdma_devices:
+                if ('rdma', device) not in results:
+                    continue
+                counters, collected_at = results[('rdma', device)]
+                raw = {name: counters[key] for name, key in RDMA_COUNTER_MAP.items() if key in counters}
+                rdma_stats_exporter.export_link_counters((device, '1'), raw, collected_at)
+            if net_collected_at is not None:
+                netdevs = {netdev: (device, '1')
+                           for device, netdevs in self.device_netdevs.items() for netdev in netdevs}
+                # Interfaces read only for the 9101 view stay out of the 9103 one
+                wanted = {interface: values for interface, values in net_stats.items()
+                          if self.interface_filter(interface)}
+                rdma_stats_exporter.export_interface_stats(wanted, netdevs, net_collected_at)
+            body = registry.render()
+        return body + ('\n'.join(rdma_stats_exporter.RATES.render()) + '\n').encode('utf-8')
+
+    def stats_payload(self, sampler):
+        """The 9103 view of the sampler's latest pass"""
+        if sampler.snapshot is None or sampler.interval <= 0:
+            sampler.refresh()
+        body, etag = self.stats_snapshot
+        return Payload(body, etag=etag, extras={})
+
+
+def parse_args():
+    parser = rdma_exporter.build_parser('Per-host RDMA agent (rdma_exporter and rdma_stats_exporter in one)')
+    parser.add_argument('--stats-port', type=int, default=9103,
+                        help='Port serving the rdma_stats_exporter metric names; 0 disables (default: 9103)')
+    parser.add_argument('--interface-include', type=rdma_exporter.pattern_list, metavar='PATTERNS',
+                        help='Comma-separated interface globs for the rdma_interface_* metrics (default: all)')
+    parser.add_argument('--interface-exclude', type=rdma_exporter.pattern_list, metavar='PATTERNS',
+                        help='Comma-separated interface globs to leave out of the rdma_interface_* metrics '
+                             f'(default: {",".join(rdma_stats_exporter.DEFAULT_INTERFACE_EXCLUDE)})')
+    parser.add_argument('--no-dcqcn', dest='dcqcn', action='store_false',
+                        help='Do not export DCQCN parameters from <netdev>/ecn/roce_np and roce_rp')
+    args = parser.parse_args()
+    if (args.remote_write_url or args.ring_file) and args.interval <= 0:
+        parser.error('--remote-write-url and --ring-file need a background --interval above 0')
+    return args
+
+
+def run_agent(args):
+    exposition.enable_formats(args.exposition_formats)
+    agent = RDMAAgent(InterfaceFilter(args.interface_include, args.interface_exclude),
+                      backend=args.backend, ethtool_allow=args.ethtool_allow, ethtool_deny=args.ethtool_deny,
+                      workers=args.workers, deadline=args.deadline, interfaces=args.interfaces,
+                      rediscover_interval=args.rediscover_interval)
+    if args.dcqcn:
+        agent.add_collector(DCQCNParamsCollector())
+    httpd, sampler = rdma_exporter.start_server(
+        agent, args.port, args.interval, args.microburst_ms, args.microburst_threshold,
+        args.microburst_cpu_budget, remote_write.from_args(args, 'rdma_agent'), sample_ring.from_args(args),
+        args.qp_top_k, args.qp_rank_by)
+    if args.stats_port:
+        stats_httpd = make_server({
+            '/metrics': lambda query: agent.stats_payload(sampler),
+            '/health': lambda query: 'OK',
+        }, args.stats_port, host='')
+        threading.Thread(target=stats_httpd.serve_forever, name='rdma-stats-http', daemon=True).start()
+        print(f"rdma_stats_exporter metrics: http://localhost:{args.stats_port}/metrics")
+    httpd.serve_forever()
+
+
+if __name__ == '__main__':
+    try:
+        run_agent(parse_args())
+    except KeyboardInterrupt:
+        print("\nShutting down...")
+    except Exception as e:
+        print(f"Error: {e}")
@@ -5,54 +5,745 @@ Collects RDMA statistics, PFC pause frames, and ECN metrics
 Runs on port 9101
 """
 
+import argparse
+import bisect
+import concurrent.futures
+import fnmatch
+import os
+import resource
 import subprocess
 import re
 import time
-from http.server import HTTPServer, BaseHTTPRequestHandler
 import threading
+from array import array
+from collections import namedtuple
+
+import exporter_selfstats
+import exposition
+import qp_stats
+import remote_write
+import sample_ring
+from counter_rates import RateTracker
+from ethtool_stats import EthtoolStatsReader
+from exporter_http import Payload, compute_etag, make_server
+from exporter_selfstats import PROFILER, instrumented, record_error, run_command
+from metric_registry import MetricRegistry
+
+SYSFS_INFINIBAND = '/sys/class/infiniband'
+SYSFS_NET = '/sys/class/net'
+
+# hw_counters/counters file name -> collector metric key
+RDMA_COUNTER_MAP = {
+    'np_ecn_marked_roce_packets': 'ecn_marked_packets',
+    'np_cnp_sent': 'cnp_sent',
+    'rp_cnp_handled': 'cnp_handled',
+    'rp_cnp_ignored': 'cnp_ignored',
+    'rx_write_requests': 'rx_write_requests',
+    'tx_write_requests': 'tx_write_requests',
+    'rx_read_requests': 'rx_read_requests',
+    'tx_read_requests': 'tx_read_requests',
+    'out_of_sequence': 'out_of_sequence',
+    'packet_seq_err': 'packet_seq_err',
+    'local_ack_timeout_err': 'local_ack_timeout_err',
+}
+
+# ethtool -S counter names for per-priority PFC and global pause frames
+PFC_COUNTER_RE = re.compile(r'(rx|tx)_(?:pfc_frames_prio([0-7])|prio([0-7])_pause|(pause)_ctrl_phy)$')
+
+# Table-driven export of the remaining ethtool counters: the first pattern
+# that fully matches a counter name picks the family, its named groups
+# become labels. PFC pause counters are exported as pfc_pause_frames instead.
+ETHTOOL_COUNTER_TABLE = [
+    (r'(?P<direction>rx|tx)_prio(?P<priority>[0-7])_bytes', 'ethtool_priority_bytes'),
+    (r'(?P<direction>rx|tx)_prio(?P<priority>[0-7])_packets', 'ethtool_priority_packets'),
+    (r'(?P<direction>rx|tx)_prio(?P<priority>[0-7])_pause_duration', 'ethtool_priority_pause_duration'),
+    (r'(?P<direction>rx|tx)_prio(?P<priority>[0-7])_pause_transition', 'ethtool_priority_pause_transitions'),
+    (r'(?P<direction>rx|tx)_prio(?P<priority>[0-7])_(?P<counter>\w+)', 'ethtool_priority_counter'),
+    (r'(?P<direction>rx|tx)(?P<queue>\d+)_(?P<counter>\w+)', 'ethtool_queue_counter'),
+    (r'(?P<counter>.+)', 'ethtool_counter'),
+]
+ETHTOOL_COUNTER_RULES = [(re.compile(pattern), family) for pattern, family in ETHTOOL_COUNTER_TABLE]
+ETHTOOL_FAMILY_LABELS = {family: ('interface',) + tuple(rule.groupindex)
+                         for rule, family in ETHTOOL_COUNTER_RULES}
+
+ETHTOOL_FAMILY_HELP = {
+    'ethtool_priority_bytes': 'Bytes per PFC priority from ethtool -S',
+    'ethtool_priority_packets': 'Packets per PFC priority from ethtool -S',
+    'ethtool_priority_pause_duration': 'Pause duration per PFC priority (driver units)',
+    'ethtool_priority_pause_transitions': 'Pause state transitions per PFC priority',
+    'ethtool_priority_counter': 'Other per-priority ethtool counters',
+    'ethtool_queue_counter': 'Per-queue ethtool counters',
+    'ethtool_counter': 'Other ethtool -S counters',
+}
+
+# Cardinality control for the table-driven export (fnmatch patterns)
+DEFAULT_ETHTOOL_ALLOW = ['*prio*', '*_phy', '*discard*', 'rx_out_of_buffer']
+DEFAULT_ETHTOOL_DENY = ['rx[0-9]*', 'tx[0-9]*', 'ch[0-9]*']
+
+# Microburst sampler: hw_counters polled every few milliseconds, plus the
+# PFC pause counters of this priority (RoCE traffic class)
+MICROBURST_COUNTERS = {
+    'np_ecn_marked_roce_packets': 'ecn_marked_packets',
+    'rp_cnp_handled': 'cnp_handled',
+}
+MICROBURST_PFC_PRIORITY = 3
+# Histogram buckets for per-interval counter deltas (events per sample)
+MICROBURST_DELTA_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+MICROBURST_MAX_INTERVAL = 0.010
+MICROBURST_RING_SECONDS = 30
+
+# Counter families that also get a server-side '<family>_rate' gauge
+RATE_FAMILIES = {
+    'rdma_ecn_marked_packets': 'ECN-marked RoCE packets',
+    'rdma_cnp_sent': 'CNP packets sent',
+    'rdma_cnp_handled': 'CNP packets handled',
+    'pfc_pause_frames': 'PFC pause frames',
+    'network_bytes': 'Network bytes',
+    'ethtool_priority_bytes': 'Bytes per PFC priority',
+    'rdma_operations': 'RDMA read/write operations',
+}
+# Rate families read from 32-bit counters (mlx5 Q counters such as
+# rx_write_requests), whose decreases near 2^32 are wraps, not resets
+WRAP_32_FAMILIES = ('rdma_operations',)
+
+NETWORK_STATISTICS = ['rx_bytes', 'tx_bytes', 'rx_packets', 'tx_packets', 'rx_dropped', 'tx_dropped']
+
+
+def pfc_metric_key(counter):
+    """Map an ethtool counter name to its PFC metric key, or None"""
+    match = PFC_COUNTER_RE.match(counter.lower())
+    if match is None:
+        return None
+    direction, pfc_prio, pause_prio, global_pause = match.groups()
+    if global_pause:
+        return f'{direction}_pause_global'
+    return f'{direction}_pfc_prio{pfc_prio or pause_prio}'
+
+
+def classify_ethtool_counter(counter):
+    """Map an ethtool counter name to (family, label values) via the counter table
+
+    Label values follow the rule's named groups, see ETHTOOL_FAMILY_LABELS.
+    """
+    for rule, family in ETHTOOL_COUNTER_RULES:
+        match = rule.fullmatch(counter)
+        if match:
+            return family, match.groups()
+    return None
+
+
+def read_sysfs_text(path):
+    """Contents of a small sysfs attribute, stripped; '' when unreadable"""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+
+def discover_roce_netdevs():
+    """Map each RoCE device with an ACTIVE port to its netdevs through sysfs
+
+    Returns {device: [netdev, ...]}, or None when /sys/class/infiniband is
+    not available. InfiniBand-link-layer ports are skipped: they have no
+    Ethernet netdev carrying RoCE traffic.
+    """
+    try:
+        devices = sorted(os.listdir(SYSFS_INFINIBAND))
+    except OSError:
+        return None
+    mapping = {}
+    for device in devices:
+        port_dir = f'{SYSFS_INFINIBAND}/{device}/ports/1'
+        if read_sysfs_text(f'{port_dir}/link_layer') != 'Ethernet':
+            continue
+        if 'ACTIVE' not in read_sysfs_text(f'{port_dir}/state'):
+            continue
+        try:
+            mapping[device] = sorted(os.listdir(f'{SYSFS_INFINIBAND}/{device}/device/net'))
+        except OSError:
+            mapping[device] = []
+    return mapping
+
+
+def compile_patterns(patterns):
+    """Compile fnmatch patterns into one regex (None when the list is empty)"""
+    if not patterns:
+        return None
+    return re.compile('|'.join(fnmatch.translate(pattern) for pattern in patterns))
+
+
+class SysfsCounterReader:
+    """Reads sysfs counter files through kept-open file descriptors
+
+    Each counter file is opened once and re-read with pread() at offset 0,
+    which makes sysfs regenerate the value without another open() or fork.
+    """
+
+    def __init__(self):
+        self._fds = {}
+        self._listings = {}
+
+    def read_counter(self, path):
+        """Read one integer counter, opening the file on first use"""
+        fd = self._fds.get(path)
+        if fd is None:
+            fd = os.open(path, os.O_RDONLY)
+            self._fds[path] = fd
+        try:
+            return int(os.pread(fd, 64, 0))
+        except (OSError, ValueError):
+            # Device went away or file is not a counter; reopen next time
+            self._close_fd(path)
+            raise
+
+    def read_counters(self, directory, names):
+        """Read the given counter names that exist in a sysfs directory"""
+        listing = self._listings.get(directory)
+        if listing is None:
+            try:
+                listing = frozenset(os.listdir(directory))
+            except OSError:
+                listing = frozenset()
+            self._listings[directory] = listing
+
+        values = {}
+        for name in names:
+            if name in listing:
+                try:
+                    values[name] = self.read_counter(f'{directory}/{name}')
+                except (OSError, ValueError):
+                    pass
+        return values
+
+    def _close_fd(self, path):
+        fd = self._fds.pop(path, None)
+        if fd is not None:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def forget(self, prefix):
+        """Close descriptors and drop listings under a path prefix (a removed device)"""
+        for path in [path for path in self._fds if path.startswith(prefix)]:
+            self._close_fd(path)
+        for directory in [directory for directory in self._listings if directory.startswith(prefix)]:
+            del self._listings[directory]
+
+    def close(self):
+        """Close every kept-open descriptor"""
+        for path in list(self._fds):
+            self._close_fd(path)
+        self._listings.clear()
+
+
+class MicroburstSampler:
+    """High-rate sampler for sub-scrape ECN, CNP and PFC bursts
+
+    A thread polls a fixed set of counters every 1-10 ms into preallocated
+    array rings. Each scrape drains the new rows into cumulative delta
+    histograms, the peak rate seen since the previous scrape and a count of
+    bursts (runs of intervals above the rate threshold). The thread measures
+    its own CPU time and stretches the interval, up to 10 ms, to stay within
+    the CPU budget. retarget() follows rediscovered devices and interfaces
+    without resetting the series that remain.
+    """
+
+    def __init__(self, devices, interfaces, interval=0.001, threshold=10000.0, cpu_budget=0.05):
+        self.interval = self.target_interval = max(0.001, min(interval, MICROBURST_MAX_INTERVAL))
+        self.threshold = threshold
+        self.cpu_budget = cpu_budget
+        self.sysfs = SysfsCounterReader()
+        self.ethtool = EthtoolStatsReader()
+        self.capacity = int(MICROBURST_RING_SECONDS / self.interval)
+        self.written = 0
+        self.errors = 0
+        self.overruns = 0
+        self.cpu_seconds = 0.0
+        self.dropped = 0
+        self._drained = 0
+
+        self._probes, self.series = self._build_probes(devices, interfaces)
+        width = self.width = len(self.series)
+        self._allocate_ring()
+        # Scrape-side state, only touched by drain()
+        self._prev_time = None
+        self._prev_values = [0] * width
+        self._above = [False] * width
+        self.bucket_counts = [[0] * (len(MICROBURST_DELTA_BUCKETS) + 1) for _ in range(width)]
+        self.delta_sums = [0] * width
+        self.native = [exposition.NativeHistogram() for _ in range(width)]
+        self.bursts = [0] * width
+        # (labels, value, Unix time) of the latest burst onset per series
+        self.burst_exemplars = [None] * width
+        self.peak_rates = [0.0] * width
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _build_probes(self, devices, interfaces):
+        """One probe per device/interface returning a tuple of counter values, and the (target, counter) series"""
+        series = []
+        probes = []
+        for device in devices:
+            hw_dir = f'{SYSFS_INFINIBAND}/{device}/ports/1/hw_counters'
+            paths = [f'{hw_dir}/{name}' for name in MICROBURST_COUNTERS if os.path.exists(f'{hw_dir}/{name}')]
+            if paths:
+                probes.append(self._sysfs_probe(paths))
+                series.extend((device, MICROBURST_COUNTERS[path.rsplit('/', 1)[1]]) for path in paths)
+        for interface in interfaces:
+            probe = self._pfc_probe(interface)
+            if probe is not None:
+                probes.append(probe)
+                series.extend([(interface, f'rx_pfc_prio{MICROBURST_PFC_PRIORITY}'),
+                               (interface, f'tx_pfc_prio{MICROBURST_PFC_PRIORITY}')])
+        return probes, series
+
+    def _allocate_ring(self):
+        self.times = array('d', bytes(8 * self.capacity))
+        self.values = array('Q', bytes(8 * self.capacity * self.width))
+
+    def retarget(self, devices, interfaces):
+        """Sample a new set of devices and interfaces
+
+        The thread is stopped and the pending rows drained; the histograms,
+        burst counts, exemplars and burst state of the series that remain
+        carry over, so their counters stay monotonic, and only new series
+        start from zero.
+        """
+        running = self._thread is not None
+        self.stop()
+        self.drain()
+        previous = {key: i for i, key in enumerate(self.series)}
+        carried = (self.bucket_counts, self.delta_sums, self.native, self.bursts,
+                   self.burst_exemplars, self.peak_rates, self._above)
+
+        probes, series = self._build_probes(devices, interfaces)
+        targets = {target for target, _ in series}
+        for target in {target for target, _ in self.series} - targets:
+            self.sysfs.forget(f'{SYSFS_INFINIBAND}/{target}/')
+            self.ethtool.forget(target)
+        width = len(series)
+        self._probes, self.series, self.width = probes, series, width
+        self._allocate_ring()
+        # Every written row has been drained; the next one sets the baselines
+        self._prev_time = None
+        self._prev_values = [0] * width
+        self._above = [False] * width
+        self.bucket_counts = [[0] * (len(MICROBURST_DELTA_BUCKETS) + 1) for _ in range(width)]
+        self.delta_sums = [0] * width
+        self.native = [exposition.NativeHistogram() for _ in range(width)]
+        self.bursts = [0] * width
+        self.burst_exemplars = [None] * width
+        self.peak_rates = [0.0] * width
+        for i, key in enumerate(series):
+            j = previous.get(key)
+            if j is not None:
+                (self.bucket_counts[i], self.delta_sums[i], self.native[i], self.bursts[i],
+                 self.burst_exemplars[i], self.peak_rates[i], self._above[i]) = (state[j] for state in carried)
+
+        self._stop.clear()
+        if running:
+            self.start()
+
+    def _sysfs_probe(self, paths):
+        read_counter = self.sysfs.read_counter
+        return lambda: [read_counter(path) for path in paths]
+
+    def _pfc_probe(self, interface):
+        """Probe returning the rx/tx pause counters of MICROBURST_PFC_PRIORITY"""
+        def positions(names):
+            wanted = {f'rx_pfc_prio{MICROBURST_PFC_PRIORITY}': None, f'tx_pfc_prio{MICROBURST_PFC_PRIORITY}': None}
+            for index, name in enumerate(names):
+                key = pfc_metric_key(name)
+                if key in wanted and wanted[key] is None:
+                    wanted[key] = index
+            return names, tuple(wanted.values())
+
+        try:
+            layout = [positions(self.ethtool.names(interface))]
+        except OSError:
+            return None
+        if None in layout[0][1]:
+            return None
+        ethtool = self.ethtool
+
+        def probe():
+            values = ethtool.read(interface)
+            names = ethtool.names(interface)
+            if names is not layout[0][0]:
+                # The driver's stat set changed; find the counters again
+                layout[0] = positions(names)
+            rx_index, tx_index = layout[0][1]
+            if rx_index is None or tx_index is None:
+                raise ValueError(f"{interface}: PFC counters are gone")
+            return values[rx_index], values[tx_index]
+        return probe
+
+    def start(self):
+        if self.width and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='rdma-microburst', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        times, values, width, capacity = self.times, self.values, self.width, self.capacity
+        probes = self._probes
+        budget_wall = time.perf_counter()
+        budget_cpu = time.thread_time()
+        deadline = time.perf_counter()
+
+        while not self._stop.is_set():
+            row = self.written % capacity
+            offset = row * width
+            try:
+                for probe in probes:
+                    for value in probe():
+                        values[offset] = value
+                        offset += 1
+            except (OSError, ValueError):
+                # Skip this tick; the next row's delta spans the gap
+                self.errors += 1
+            else:
+                times[row] = time.perf_counter()
+                self.written += 1
+
+            now = time.perf_counter()
+            if now - budget_wall >= 1.0:
+                cpu = time.thread_time()
+                self.cpu_seconds += cpu - budget_cpu
+                self._adjust_interval((cpu - budget_cpu) / (now - budget_wall))
+                budget_wall, budget_cpu = now, cpu
+
+            deadline += self.interval
+            if deadline < now:
+                self.overruns += 1
+                deadline = now
+            else:
+                time.sleep(deadline - now)
+
+    def _adjust_interval(self, cpu_fraction):
+        """Keep the sampler's CPU use within budget by stretching the interval"""
+        if cpu_fraction > self.cpu_budget and self.interval < MICROBURST_MAX_INTERVAL:
+            self.interval = min(self.interval * 2, MICROBURST_MAX_INTERVAL)
+        elif cpu_fraction < self.cpu_budget / 4 and self.interval > self.target_interval:
+            self.interval = max(self.interval / 2, self.target_interval)
+
+    def drain(self):
+        """Fold the rows written since the previous drain into the histograms"""
+        width, capacity = self.width, self.capacity
+        times, values = self.times, self.values
+        written = self.written
+        # Leave one row of headroom: the sampler may be overwriting it now
+        start = max(self._drained, written - capacity + 1)
+        if start > self._drained:
+            self.dropped += start - self._drained
+            self._prev_time = None
+
+        prev_values = self._prev_values
+        peak_rates = [0.0] * width
+        # Sample times are perf_counter() readings
+        wall_offset = time.time() - time.perf_counter()
+        for seq in range(start, written):
+            row = seq % capacity
+            offset = row * width
+            now = times[row]
+            prev_time = self._prev_time
+            self._prev_time = now
+            if prev_time is None or now <= prev_time:
+                prev_values[:] = values[offset:offset + width]
+                continue
+            dt = now - prev_time
+            for i in range(width):
+                value = values[offset + i]
+                delta = value - prev_values[i]
+                prev_values[i] = value
+                if delta < 0:
+                    # Counter reset
+                    delta = 0
+                self.bucket_counts[i][bisect.bisect_left(MICROBURST_DELTA_BUCKETS, delta)] += 1
+                self.delta_sums[i] += delta
+                self.native[i].observe(delta)
+                rate = delta / dt
+                if rate > peak_rates[i]:
+                    peak_rates[i] = rate
+                above = rate >= self.threshold
+                if above and not self._above[i]:
+                    self.bursts[i] += 1
+                    self.burst_exemplars[i] = ({'rate': f'{rate:.0f}'}, 1.0, now + wall_offset)
+                self._above[i] = above
+
+        self._drained = written
+        self.peak_rates = peak_rates
+
+    def extras(self):
+        """Native delta histograms and burst exemplars as of the last drain (see exposition.register_extras)"""
+        extras = {}
+        for i, (target, counter) in enumerate(self.series):
+            labels = f'target="{target}",counter="{counter}"'
+            extras[('rdma_microburst_delta', labels)] = {'native': self.native[i].copy()}
+            if self.burst_exemplars[i] is not None:
+                extras[('rdma_microburst_bursts_total', labels)] = {'exemplar': self.burst_exemplars[i]}
+        return extras
+
+    def render(self):
+        """Drain and render the microburst metrics as exposition lines"""
+        self.drain()
+        lines = [
+            "# HELP rdma_microburst_delta Per-sample counter delta seen by the microburst sampler",
+            "# TYPE rdma_microburst_delta histogram",
+        ]
+        for i, (target, counter) in enumerate(self.series):
+            labels = f'target="{target}",counter="{counter}"'
+            cumulative = 0
+            for le, count in zip(MICROBURST_DELTA_BUCKETS, self.bucket_counts[i]):
+                cumulative += count
+                lines.append(f'rdma_microburst_delta_bucket{{{labels},le="{le}"}} {cumulative}')
+            cumulative += self.bucket_counts[i][-1]
+            lines.append(f'rdma_microburst_delta_bucket{{{labels},le="+Inf"}} {cumulative}')
+            lines.append(f'rdma_microburst_delta_sum{{{labels}}} {self.delta_sums[i]}')
+            lines.append(f'rdma_microburst_delta_count{{{labels}}} {cumulative}')
+
+        lines.append("# HELP rdma_microburst_peak_rate Peak per-sample rate (events/s) since the previous scrape")
+        lines.append("# TYPE rdma_microburst_peak_rate gauge")
+        for i, (target, counter) in enumerate(self.series):
+            lines.append(f'rdma_microburst_peak_rate{{target="{target}",counter="{counter}"}} {self.peak_rates[i]:.1f}')
+
+        lines.append(f"# HELP rdma_microburst_bursts_total Intervals entering a burst above {self.threshold:g} events/s")
+        lines.append("# TYPE rdma_microburst_bursts_total counter")
+        for i, (target, counter) in enumerate(self.series):
+            lines.append(f'rdma_microburst_bursts_total{{target="{target}",counter="{counter}"}} {self.bursts[i]}')
+
+        lines.extend([
+            "# HELP rdma_microburst_sampler_interval_seconds Current microburst sampling interval",
+            "# TYPE rdma_microburst_sampler_interval_seconds gauge",
+            f"rdma_microburst_sampler_interval_seconds {self.interval:.4f}",
+            "# HELP rdma_microburst_sampler_cpu_seconds_total CPU time used by the microburst sampler thread",
+            "# TYPE rdma_microburst_sampler_cpu_seconds_total counter",
+            f"rdma_microburst_sampler_cpu_seconds_total {self.cpu_seconds:.6f}",
+            "# HELP rdma_microburst_samples_total Samples taken by the microburst sampler",
+            "# TYPE rdma_microburst_samples_total counter",
+            f"rdma_microburst_samples_total {self.written}",
+            "# HELP rdma_microburst_samples_dropped_total Samples overwritten before a scrape drained them",
+            "# TYPE rdma_microburst_samples_dropped_total counter",
+            f"rdma_microburst_samples_dropped_total {self.dropped}",
+            "# HELP rdma_microburst_sampler_overruns_total Sample ticks that started late",
+            "# TYPE rdma_microburst_sampler_overruns_total counter",
+            f"rdma_microburst_sampler_overruns_total {self.overruns}",
+            "# HELP rdma_microburst_sampler_errors_total Failed counter reads",
+            "# TYPE rdma_microburst_sampler_errors_total counter",
+            f"rdma_microburst_sampler_errors_total {self.errors}",
+        ])
+        return lines
+
 
 class RDMAMetricsCollector:
     """Collects RDMA, PFC, and ECN metrics"""
 
-    def __init__(self):
-        self.rdma_devices = self.detect_rdma_devices()
-        self.network_interfaces = self.detect_network_interfaces()
+    BACKENDS = ('auto', 'sysfs', 'subprocess')
+
+    def __init__(self, backend='auto', ethtool_allow=None, ethtool_deny=None, workers=8, deadline=4.0,
+                 interfaces=None, rediscover_interval=10.0):
+        # RDMA device -> backing netdevs; only those netdevs (plus any
+        # explicitly requested 'interfaces') are scraped
+        self.device_netdevs = {}
+        self.rdma_devices = []
+        self.network_interfaces = []
+        self.extra_interfaces = list(interfaces or [])
+        self.rediscover_interval = rediscover_interval
+        self._discovery_signature = None
+        self._discovered_at = 0.0
+        self.sysfs = SysfsCounterReader()
+        self.backend = self.select_backend(backend)
+        # The sysfs backend reads ethtool counters through SIOCETHTOOL as well
+        self.ethtool = EthtoolStatsReader() if self.backend == 'sysfs' else None
+        self._ethtool_layouts = {}
+        self._ethtool_allow = compile_patterns(DEFAULT_ETHTOOL_ALLOW if ethtool_allow is None else ethtool_allow)
+        self._ethtool_deny = compile_patterns(DEFAULT_ETHTOOL_DENY if ethtool_deny is None else ethtool_deny)
+        self._ethtool_exports = {}
+        self.microburst = None
+        self.qp_stats = None
+        # Pluggable collectors, see add_collector()
+        self.plugins = []
+        self.rates = RateTracker(RATE_FAMILIES, wrap_32=WRAP_32_FAMILIES)
+        self.registry = self.build_registry()
+        # Collectors run on a bounded pool under a per-scrape deadline
+        self.deadline = deadline
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                              thread_name_prefix='rdma-collector')
+        self._pending = {}
+        self.rediscover(force=True)
+
+    def close(self):
+        """Release descriptors, sockets and worker threads"""
+        self.executor.shutdown(wait=False)
+        self.sysfs.close()
+        if self.ethtool is not None:
+            self.ethtool.close()
+        if self.microburst is not None:
+            exposition.unregister_extras(self.microburst.extras)
+            self.microburst.stop()
+
+    @staticmethod
+    def build_registry():
+        """Register every metric family this collector renders"""
+        registry = MetricRegistry()
+        registry.family('rdma_ecn_marked_packets', 'Number of ECN-marked RoCE packets received', labelnames=('device',))
+        registry.family('rdma_cnp_sent', 'Number of CNP packets sent', labelnames=('device',))
+        registry.family('rdma_cnp_handled', 'Number of CNP packets handled', labelnames=('device',))
+        registry.family('rdma_cnp_ignored', 'Number of CNP packets ignored', labelnames=('device',))
+        registry.family('rdma_operations', 'RDMA read/write operations', labelnames=('device', 'operation'))
+        registry.family('pfc_pause_frames', 'PFC pause frames per priority',
+                        labelnames=('interface', 'priority', 'direction'))
+        registry.family('network_bytes', 'Network bytes transferred', labelnames=('interface', 'direction'))
+        registry.family('network_packets', 'Network packets transferred', labelnames=('interface', 'direction'))
+        registry.family('network_packets_dropped', 'Network packets dropped', labelnames=('interface', 'direction'))
+        for family, help_text in ETHTOOL_FAMILY_HELP.items():
+            registry.family(family, help_text, labelnames=ETHTOOL_FAMILY_LABELS[family])
+        registry.family('rdma_device_netdev', 'RDMA device to backing netdev mapping (always 1)',
+                        'gauge', ('device', 'interface'))
+        qp_stats.register_families(registry)
+        registry.family('rdma_exporter_collector_up', 'Whether a collector finished within the scrape deadline',
+                        'gauge', ('collector', 'target'))
+        return registry
+
+    def enable_microburst(self, interval=0.001, threshold=10000.0, cpu_budget=0.05):
+        """Start the high-rate microburst sampler (needs the sysfs backend)"""
+        if self.backend != 'sysfs':
+            print("Microburst sampler needs the sysfs backend; not started")
+            return None
+        self.microburst = MicroburstSampler(self.rdma_devices, self.network_interfaces,
+                                            interval, threshold, cpu_budget)
+        self.microburst.start()
+        exposition.register_extras(self.microburst.extras)
+        return self.microburst
 
-    def detect_rdma_devices(self):
-        """Detect RDMA devices on the system"""
+    def add_collector(self, plugin):
+        """Run an extra collector on the shared executor and deadline
+
+        'plugin' provides register(registry) to add its metric families,
+        tasks(collector) returning (collector name, target, func) tuples run
+        with the built-in ones, and export(collector, results, families)
+        which sets its series from the run_collectors() results.
+        """
+        plugin.register(self.registry)
+        self.plugins.append(plugin)
+        return plugin
+
+    def enable_qp_stats(self, top_k=10, rank_by='cnp'):
+        """Export per-QP counters for the top K QPs per link (plus an 'other' series)"""
+        self.qp_stats = qp_stats.QPStatsTable(top_k, rank_by)
+        return self.qp_stats
+
+    def select_backend(self, backend):
+        """Pick the counter backend; 'auto' prefers sysfs when it is available"""
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown backend '{backend}', expected one of {self.BACKENDS}")
+        if backend == 'auto':
+            return 'sysfs' if os.path.isdir(SYSFS_INFINIBAND) else 'subprocess'
+        return backend
+
+    def detect_rdma_links(self):
+        """Map ACTIVE RDMA links to their netdevs by parsing 'rdma link show'"""
         try:
             result = subprocess.run(['rdma', 'link', 'show'],
                                   capture_output=True, text=True, timeout=5)
-            devices = []
+            mapping = {}
             for line in result.stdout.split('\n'):
+                # link rocep11s0/1 state ACTIVE physical_state LINK_UP netdev ens224
                 if 'link' in line and 'state ACTIVE' in line:
                     match = re.search(r'link\s+(\S+)/\d+', line)
                     if match:
-                        devices.append(match.group(1))
-            return devices
+                        netdev = re.search(r'\bnetdev\s+(\S+)', line)
+                        mapping.setdefault(match.group(1), []).extend([netdev.group(1)] if netdev else [])
+            return mapping
         except Exception:
-            return []
+            return {}
 
-    def detect_network_interfaces(self):
-        """Detect network interfaces associated with RDMA"""
-        try:
-            result = subprocess.run(['ip', 'link', 'show'],
-                                  capture_output=True, text=True, timeout=5)
-            interfaces = []
-            for line in result.stdout.split('\n'):
-                if 'ens' in line or 'eth' in line:
-                    match = re.search(r'^\d+:\s+(\w+):', line)
-                    if match:
-                        interfaces.append(match.group(1))
-            return interfaces
-        except Exception:
-            return []
+    def discovery_signature(self):
+        """Cheap fingerprint of RDMA/netdev presence and port states (no fork)"""
+        signature = []
+        for directory in (SYSFS_INFINIBAND, SYSFS_NET):
+            try:
+                signature.append((os.stat(directory).st_mtime_ns, tuple(sorted(os.listdir(directory)))))
+            except OSError:
+                signature.append(None)
+        if signature[0] is not None:
+            signature.extend(read_sysfs_text(f'{SYSFS_INFINIBAND}/{device}/ports/1/state')
+                             for device in signature[0][1])
+        return tuple(signature)
+
+    def rediscover(self, force=False):
+        """Re-map devices to netdevs when the sysfs fingerprint changed; True on change
 
+        Called before each collection, at most every 'rediscover_interval'
+        seconds, so hot-added or removed NICs are picked up without a restart.
+        """
+        now = time.monotonic()
+        if not force and (self.rediscover_interval <= 0 or now - self._discovered_at < self.rediscover_interval):
+            return False
+        self._discovered_at = now
+        signature = self.discovery_signature()
+        if not force and signature == self._discovery_signature:
+            return False
+        self._discovery_signature = signature
+
+        mapping = discover_roce_netdevs()
+        if mapping is None:
+            mapping = self.detect_rdma_links()
+        interfaces = sorted({netdev for netdevs in mapping.values() for netdev in netdevs}
+                            | set(self.extra_interfaces))
+        if mapping == self.device_netdevs and interfaces == self.network_interfaces:
+            return False
+
+        removed_devices = set(self.rdma_devices) - set(mapping)
+        removed_interfaces = set(self.network_interfaces) - set(interfaces)
+        self.device_netdevs = mapping
+        self.rdma_devices = sorted(mapping)
+        self.network_interfaces = interfaces
+        for device in removed_devices:
+            self.sysfs.forget(f'{SYSFS_INFINIBAND}/{device}/')
+        for interface in removed_interfaces:
+            self.sysfs.forget(f'{SYSFS_NET}/{interface}/')
+            self._ethtool_layouts.pop(interface, None)
+            if self.ethtool is not None:
+                self.ethtool.forget(interface)
+        if not force:
+            print(f"Rediscovered RDMA devices: {mapping}, interfaces: {interfaces}")
+        if self.microburst is not None:
+            self.microburst.retarget(self.rdma_devices, self.network_interfaces)
+        return True
+
+    @instrumented('get_rdma_statistics')
     def get_rdma_statistics(self, device):
         """Get RDMA statistics for a device"""
+        if self.backend == 'sysfs':
+            metrics = self.get_rdma_statistics_sysfs(device)
+            if metrics:
+                return metrics
+        return self.get_rdma_statistics_subprocess(device)
+
+    def get_rdma_statistics_sysfs(self, device):
+        """Get RDMA statistics from the port's hw_counters and counters directories"""
+        metrics = {}
+        port_dir = f'{SYSFS_INFINIBAND}/{device}/ports/1'
+        for subdir in ('hw_counters', 'counters'):
+            values = self.sysfs.read_counters(f'{port_dir}/{subdir}', RDMA_COUNTER_MAP)
+            for name, value in values.items():
+                metrics.setdefault(RDMA_COUNTER_MAP[name], value)
+        return metrics
+
+    def get_rdma_statistics_subprocess(self, device):
+        """Get RDMA statistics by parsing 'rdma statistic show link'"""
         metrics = {}
         try:
-            result = subprocess.run(['rdma', 'statistic', 'show', 'link', f'{device}/1'],
+            result = run_command(['rdma', 'statistic', 'show', 'link', f'{device}/1'],
                                   capture_output=True, text=True, timeout=5)
 
             # Parse RDMA statistics
@@ -99,204 +790,533 @@ class RDMAMetricsCollector:
                     if match:
                         metrics['tx_read_requests'] = int(match.group(1))
 
+                # Transport errors (served by the rdma_stats view of rdma_agent.py)
+                for counter in ('out_of_sequence', 'packet_seq_err', 'local_ack_timeout_err'):
+                    match = re.search(rf'\b{counter}\s+(\d+)', line)
+                    if match:
+                        metrics[counter] = int(match.group(1))
+
         except Exception:
-            pass
+            record_error()
 
         return metrics
 
+    def ethtool_export(self, counter):
+        """(family, label values) for an allowed, non-PFC ethtool counter, else None; cached"""
+        try:
+            return self._ethtool_exports[counter]
+        except KeyError:
+            pass
+        export = None
+        if (pfc_metric_key(counter) is None
+                and (self._ethtool_allow is None or self._ethtool_allow.match(counter))
+                and (self._ethtool_deny is None or not self._ethtool_deny.match(counter))):
+            export = classify_ethtool_counter(counter)
+        self._ethtool_exports[counter] = export
+        return export
+
     def get_pfc_statistics(self, interface):
         """Get PFC (pause frame) statistics for an interface"""
-        metrics = {}
+        return self.get_ethtool_statistics(interface)[0]
+
+    @instrumented('get_ethtool_statistics')
+    def get_ethtool_statistics(self, interface):
+        """Get PFC statistics and the other exported ethtool counters
+
+        Returns (pfc metrics dict, [(family, label values, value), ...]).
+        """
+        if self.ethtool is not None:
+            try:
+                return self.get_ethtool_statistics_ioctl(interface)
+            except OSError:
+                record_error()
+        return self.get_ethtool_statistics_subprocess(interface)
+
+    def get_ethtool_statistics_ioctl(self, interface):
+        """Get ethtool statistics from the cached string set and value array"""
+        values = self.ethtool.read(interface)
+        names = self.ethtool.names(interface)
+        layout = self._ethtool_layouts.get(interface)
+        if layout is None or layout[0] is not names:
+            # Resolve counter positions once per string set
+            pfc_positions = []
+            export_positions = []
+            for index, name in enumerate(names):
+                key = pfc_metric_key(name)
+                if key is not None:
+                    pfc_positions.append((index, key))
+                    continue
+                export = self.ethtool_export(name)
+                if export is not None:
+                    export_positions.append((index, export[0], export[1]))
+            layout = self._ethtool_layouts[interface] = (names, pfc_positions, export_positions)
+
+        pfc_metrics = {key: values[index] for index, key in layout[1]}
+        counters = [(family, labels, values[index]) for index, family, labels in layout[2]]
+        return pfc_metrics, counters
+
+    def get_ethtool_statistics_subprocess(self, interface):
+        """Get ethtool statistics by parsing 'ethtool -S' output"""
+        pfc_metrics = {}
+        counters = []
         try:
-            result = subprocess.run(['ethtool', '-S', interface],
+            result = run_command(['ethtool', '-S', interface],
                                   capture_output=True, text=True, timeout=5)
 
             for line in result.stdout.split('\n'):
-                # RX PFC frames per priority
-                for prio in range(8):
-                    if f'rx_pfc_frames_prio{prio}' in line.lower() or f'rx_prio{prio}_pause' in line.lower():
-                        match = re.search(r':\s*(\d+)', line)
-                        if match:
-                            metrics[f'rx_pfc_prio{prio}'] = int(match.group(1))
-
-                # TX PFC frames per priority
-                for prio in range(8):
-                    if f'tx_pfc_frames_prio{prio}' in line.lower() or f'tx_prio{prio}_pause' in line.lower():
-                        match = re.search(r':\s*(\d+)', line)
-                        if match:
-                            metrics[f'tx_pfc_prio{prio}'] = int(match.group(1))
-
-                # Global pause frames
-                if 'rx_pause_ctrl_phy' in line.lower():
-                    match = re.search(r':\s*(\d+)', line)
-                    if match:
-                        metrics['rx_pause_global'] = int(match.group(1))
-
-                if 'tx_pause_ctrl_phy' in line.lower():
-                    match = re.search(r':\s*(\d+)', line)
-                    if match:
-                        metrics['tx_pause_global'] = int(match.group(1))
+                name, sep, value = line.partition(':')
+                value = value.strip()
+                if not sep or not value.isdigit():
+                    continue
+                name = name.strip()
+                key = pfc_metric_key(name)
+                if key is not None:
+                    pfc_metrics[key] = int(value)
+                    continue
+                export = self.ethtool_export(name)
+                if export is not None:
+                    counters.append((export[0], export[1], int(value)))
 
         except Exception:
-            pass
+            record_error()
 
-        return metrics
+        return pfc_metrics, counters
 
+    @instrumented('get_network_statistics')
     def get_network_statistics(self, interface):
         """Get general network statistics"""
+        if self.backend == 'sysfs':
+            metrics = self.sysfs.read_counters(f'{SYSFS_NET}/{interface}/statistics', NETWORK_STATISTICS)
+            if metrics:
+                return metrics
+        return self.get_network_statistics_subprocess(interface)
+
+    def get_network_statistics_subprocess(self, interface):
+        """Get general network statistics by forking cat per counter file"""
         metrics = {}
         try:
-            result = subprocess.run(['cat', f'/sys/class/net/{interface}/statistics/rx_bytes'],
+            result = run_command(['cat', f'/sys/class/net/{interface}/statistics/rx_bytes'],
                                   capture_output=True, text=True, timeout=2)
             if result.returncode == 0:
                 metrics['rx_bytes'] = int(result.stdout.strip())
 
-            result = subprocess.run(['cat', f'/sys/class/net/{interface}/statistics/tx_bytes'],
+            result = run_command(['cat', f'/sys/class/net/{interface}/statistics/tx_bytes'],
                                   capture_output=True, text=True, timeout=2)
             if result.returncode == 0:
                 metrics['tx_bytes'] = int(result.stdout.strip())
 
-            result = subprocess.run(['cat', f'/sys/class/net/{interface}/statistics/rx_packets'],
+            result = run_command(['cat', f'/sys/class/net/{interface}/statistics/rx_packets'],
                                   capture_output=True, text=True, timeout=2)
             if result.returncode == 0:
                 metrics['rx_packets'] = int(result.stdout.strip())
 
-            result = subprocess.run(['cat', f'/sys/class/net/{interface}/statistics/tx_packets'],
+            result = run_command(['cat', f'/sys/class/net/{interface}/statistics/tx_packets'],
                                   capture_output=True, text=True, timeout=2)
             if result.returncode == 0:
                 metrics['tx_packets'] = int(result.stdout.strip())
 
-            result = subprocess.run(['cat', f'/sys/class/net/{interface}/statistics/rx_dropped'],
+            result = run_command(['cat', f'/sys/class/net/{interface}/statistics/rx_dropped'],
                                   capture_output=True, text=True, timeout=2)
             if result.returncode == 0:
                 metrics['rx_dropped'] = int(result.stdout.strip())
 
-            result = subprocess.run(['cat', f'/sys/class/net/{interface}/statistics/tx_dropped'],
+            result = run_command(['cat', f'/sys/class/net/{interface}/statistics/tx_dropped'],
                                   capture_output=True, text=True, timeout=2)
             if result.returncode == 0:
                 metrics['tx_dropped'] = int(result.stdout.strip())
 
         except Exception:
-            pass
+            record_error()
 
         return metrics
 
-    def collect_all_metrics(self):
-        """Collect all metrics and return Prometheus format"""
-        metrics_output = []
+    @staticmethod
+    @PROFILER.worker
+    def _timed_call(func, target):
+        return func(target), time.monotonic()
 
-        # Add header
-        metrics_output.append("# HELP rdma_ecn_marked_packets Number of ECN-marked RoCE packets received")
-        metrics_output.append("# TYPE rdma_ecn_marked_packets counter")
+    def run_collectors(self, tasks):
+        """Run (collector, target, func) tasks concurrently under the scrape deadline
 
-        metrics_output.append("# HELP rdma_cnp_sent Number of CNP packets sent")
-        metrics_output.append("# TYPE rdma_cnp_sent counter")
+        Returns ({(collector, target): (result, collected_at)}, {(collector, target): up}).
+        Tasks that miss the deadline are reported down and left running; a
+        target whose previous task is still running is not resubmitted.
+        """
+        deadline = time.monotonic() + self.deadline
+        futures = {}
+        up = {}
+        for collector, target, func in tasks:
+            key = (collector, target)
+            previous = self._pending.get(key)
+            if previous is not None and not previous.done():
+                up[key] = 0
+                continue
+            future = self.executor.submit(self._timed_call, func, target)
+            self._pending[key] = future
+            futures[future] = key
 
-        metrics_output.append("# HELP rdma_cnp_handled Number of CNP packets handled")
-        metrics_output.append("# TYPE rdma_cnp_handled counter")
+        done, _ = concurrent.futures.wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+        results = {}
+        for future, key in futures.items():
+            if future in done and future.exception() is None:
+                results[key] = future.result()
+                up[key] = 1
+            else:
+                up[key] = 0
+        return results, up
 
-        metrics_output.append("# HELP rdma_operations RDMA read/write operations")
-        metrics_output.append("# TYPE rdma_operations counter")
+    def collector_tasks(self):
+        """(collector, target, func) tasks of one sampling pass"""
+        tasks = [('rdma', device, self.get_rdma_statistics) for device in self.rdma_devices]
+        for interface in self.network_interfaces:
+            tasks.append(('ethtool', interface, self.get_ethtool_statistics))
+            tasks.append(('netdev', interface, self.get_network_statistics))
+        if self.qp_stats is not None:
+            # One 'rdma statistic qp show' covers every link
+            tasks.append(('qp', 'all', qp_stats.read_qp_stats))
+        for plugin in self.plugins:
+            tasks.extend(plugin.tasks(self))
+        return tasks
 
-        metrics_output.append("# HELP pfc_pause_frames PFC pause frames per priority")
-        metrics_output.append("# TYPE pfc_pause_frames counter")
+    def sample(self):
+        """Run one sampling pass; returns run_collectors() (results, up)"""
+        self.rediscover()
+        return self.run_collectors(self.collector_tasks())
 
-        metrics_output.append("# HELP network_bytes Network bytes transferred")
-        metrics_output.append("# TYPE network_bytes counter")
+    @PROFILER.profiled
+    def collect_all_metrics(self):
+        """Collect all metrics and return Prometheus format (bytes)"""
+        return self.render(*self.sample())
 
-        metrics_output.append("# HELP network_packets Network packets transferred")
-        metrics_output.append("# TYPE network_packets counter")
+    def render(self, results, up):
+        """Render one sampling pass as Prometheus text (bytes)"""
+        registry = self.registry
+        registry.begin()
+        families = registry.families
+        rates = self.rates
 
-        # Collect RDMA metrics
+        # RDMA metrics
         for device in self.rdma_devices:
-            rdma_stats = self.get_rdma_statistics(device)
-
-            if 'ecn_marked_packets' in rdma_stats:
-                metrics_output.append(f'rdma_ecn_marked_packets{{device="{device}"}} {rdma_stats["ecn_marked_packets"]}')
-
-            if 'cnp_sent' in rdma_stats:
-                metrics_output.append(f'rdma_cnp_sent{{device="{device}"}} {rdma_stats["cnp_sent"]}')
-
-            if 'cnp_handled' in rdma_stats:
-                metrics_output.append(f'rdma_cnp_handled{{device="{device}"}} {rdma_stats["cnp_handled"]}')
+            if ('rdma', device) not in results:
+                continue
+            rdma_stats, collected_at = results[('rdma', device)]
 
-            if 'cnp_ignored' in rdma_stats:
-                metrics_output.append(f'rdma_cnp_ignored{{device="{device}"}} {rdma_stats["cnp_ignored"]}')
+            for key in ['ecn_marked_packets', 'cnp_sent', 'cnp_handled', 'cnp_ignored']:
+                if key in rdma_stats:
+                    name = f'rdma_{key}'
+                    series = families[name].labels(device)
+                    series.set(rdma_stats[key])
+                    if name in RATE_FAMILIES:
+                        rates.observe(name, series.labels, rdma_stats[key], collected_at)
 
+            operations = families['rdma_operations']
             for op in ['rx_write_requests', 'tx_write_requests', 'rx_read_requests', 'tx_read_requests']:
                 if op in rdma_stats:
-                    metrics_output.append(f'rdma_operations{{device="{device}",operation="{op}"}} {rdma_stats[op]}')
+                    series = operations.labels(device, op)
+                    series.set(rdma_stats[op])
+                    rates.observe('rdma_operations', series.labels, rdma_stats[op], collected_at)
 
-        # Collect PFC and network metrics
+        # PFC, ethtool and network metrics
+        pfc_frames = families['pfc_pause_frames']
         for interface in self.network_interfaces:
-            pfc_stats = self.get_pfc_statistics(interface)
-            net_stats = self.get_network_statistics(interface)
+            if ('ethtool', interface) in results:
+                (pfc_stats, ethtool_counters), collected_at = results[('ethtool', interface)]
+                for priority in [str(prio) for prio in range(8)] + ['global']:
+                    for direction in ('rx', 'tx'):
+                        key = f'{direction}_pause_global' if priority == 'global' else f'{direction}_pfc_prio{priority}'
+                        if key in pfc_stats:
+                            series = pfc_frames.labels(interface, priority, direction)
+                            series.set(pfc_stats[key])
+                            rates.observe('pfc_pause_frames', series.labels, pfc_stats[key], collected_at)
 
-            # PFC metrics
-            for prio in range(8):
-                if f'rx_pfc_prio{prio}' in pfc_stats:
-                    metrics_output.append(f'pfc_pause_frames{{interface="{interface}",priority="{prio}",direction="rx"}} {pfc_stats[f"rx_pfc_prio{prio}"]}')
+                for name, label_values, value in ethtool_counters:
+                    series = families[name].labels(interface, *label_values)
+                    series.set(value)
+                    if name in RATE_FAMILIES:
+                        rates.observe(name, series.labels, value, collected_at)
 
-                if f'tx_pfc_prio{prio}' in pfc_stats:
-                    metrics_output.append(f'pfc_pause_frames{{interface="{interface}",priority="{prio}",direction="tx"}} {pfc_stats[f"tx_pfc_prio{prio}"]}')
+            if ('netdev', interface) in results:
+                net_stats, collected_at = results[('netdev', interface)]
+                for metric_name, metric_value in net_stats.items():
+                    direction = 'rx' if 'rx' in metric_name else 'tx'
+                    if 'bytes' in metric_name:
+                        series = families['network_bytes'].labels(interface, direction)
+                        series.set(metric_value)
+                        rates.observe('network_bytes', series.labels, metric_value, collected_at)
+                    elif 'packets' in metric_name:
+                        families['network_packets'].labels(interface, direction).set(metric_value)
+                    elif 'dropped' in metric_name:
+                        families['network_packets_dropped'].labels(interface, direction).set(metric_value)
 
-            if 'rx_pause_global' in pfc_stats:
-                metrics_output.append(f'pfc_pause_frames{{interface="{interface}",priority="global",direction="rx"}} {pfc_stats["rx_pause_global"]}')
+        if ('qp', 'all') in results:
+            records, _ = results[('qp', 'all')]
+            self.qp_stats.update(records, set(self.rdma_devices))
+            self.qp_stats.export(families)
 
-            if 'tx_pause_global' in pfc_stats:
-                metrics_output.append(f'pfc_pause_frames{{interface="{interface}",priority="global",direction="tx"}} {pfc_stats["tx_pause_global"]}')
+        for plugin in self.plugins:
+            plugin.export(self, results, families)
 
-            # Network metrics
-            for metric_name, metric_value in net_stats.items():
-                if 'bytes' in metric_name:
-                    direction = 'rx' if 'rx' in metric_name else 'tx'
-                    metrics_output.append(f'network_bytes{{interface="{interface}",direction="{direction}"}} {metric_value}')
-                elif 'packets' in metric_name:
-                    direction = 'rx' if 'rx' in metric_name else 'tx'
-                    metrics_output.append(f'network_packets{{interface="{interface}",direction="{direction}"}} {metric_value}')
-                elif 'dropped' in metric_name:
-                    direction = 'rx' if 'rx' in metric_name else 'tx'
-                    metrics_output.append(f'network_packets_dropped{{interface="{interface}",direction="{direction}"}} {metric_value}')
+        device_netdev = families['rdma_device_netdev']
+        for device, netdevs in self.device_netdevs.items():
+            for netdev in netdevs:
+                device_netdev.labels(device, netdev).set(1)
 
-        return '\n'.join(metrics_output) + '\n'
+        collector_up = families['rdma_exporter_collector_up']
+        for (collector, target), value in sorted(up.items()):
+            collector_up.labels(collector, target).set(value)
 
+        extra_lines = rates.render() + exporter_selfstats.render()
+        if self.microburst is not None:
+            extra_lines.extend(self.microburst.render())
 
-class MetricsHandler(BaseHTTPRequestHandler):
-    """HTTP handler for Prometheus metrics endpoint"""
+        return registry.render() + ('\n'.join(extra_lines) + '\n').encode('utf-8')
 
-    collector = RDMAMetricsCollector()
 
-    def do_GET(self):
-        if self.path == '/metrics':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain; charset=utf-8')
-            self.end_headers()
+def cpu_seconds():
+    """CPU time used by this process and its reaped children"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
 
-            metrics = self.collector.collect_all_metrics()
-            self.wfile.write(metrics.encode('utf-8'))
-        else:
-            self.send_response(404)
-            self.end_headers()
 
-    def log_message(self, format, *args):
-        """Suppress logging"""
-        pass
+def run_benchmark(iterations=20):
+    """Compare scrape wall time and CPU cost of the subprocess and sysfs backends"""
+    print(f"Benchmarking {iterations} scrapes per backend")
+    for backend in ('subprocess', 'sysfs'):
+        collector = RDMAMetricsCollector(backend=backend)
+        # Warm-up scrape opens the sysfs descriptors and directory listings
+        collector.collect_all_metrics()
+
+        wall_start = time.perf_counter()
+        cpu_start = cpu_seconds()
+        for _ in range(iterations):
+            collector.collect_all_metrics()
+        wall_ms = (time.perf_counter() - wall_start) * 1000 / iterations
+        cpu_ms = (cpu_seconds() - cpu_start) * 1000 / iterations
+        collector.close()
+
+        print(f"  {backend:<10} {wall_ms:8.2f} ms/scrape wall  {cpu_ms:8.2f} ms/scrape CPU")
+
+
+Snapshot = namedtuple('Snapshot', 'body etag collected_at duration timestamp extras')
+
+
+class MetricsSampler:
+    """Collects metrics on its own interval and keeps a pre-encoded snapshot
+
+    Scrapes are served from the snapshot instead of collecting inline. When
+    a collection is needed (first scrape, or interval 0 for on-demand mode),
+    concurrent callers coalesce onto the single in-flight collection. Every
+    collection is also handed to the 'sinks' (remote_write.RemoteWriter,
+    sample_ring.SampleRing), whose own gauges are served with the snapshot.
+    """
+
+    def __init__(self, collector, interval=5.0, sinks=()):
+        self.collector = collector
+        self.interval = interval
+        self.sinks = list(sinks)
+        # Latest Snapshot; replaced atomically by the collecting thread
+        self.snapshot = None
+        self._lock = threading.Lock()
+        self._in_flight = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the background sampling thread (no-op in on-demand mode)"""
+        if self.interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='rdma-sampler', daemon=True)
+            self._thread.start()
 
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
 
-def run_server(port=9101):
-    """Run the metrics HTTP server"""
-    server_address = ('', port)
-    httpd = HTTPServer(server_address, MetricsHandler)
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error collecting metrics: {e}")
+            self._stop.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def refresh(self):
+        """Collect once, or wait for the collection another thread already started"""
+        with self._lock:
+            in_flight = self._in_flight
+            leader = in_flight is None
+            if leader:
+                in_flight = self._in_flight = threading.Event()
+
+        if not leader:
+            in_flight.wait()
+            return
+
+        try:
+            started = time.monotonic()
+            body = self.collector.collect_all_metrics()
+            finished = time.monotonic()
+            # Native histograms and exemplars taken together with the text body
+            extras = exposition.extras_snapshot()
+            self.snapshot = Snapshot(body, compute_etag(body), finished, finished - started, time.time(), extras)
+            for sink in self.sinks:
+                try:
+                    sink.add_exposition(body, self.snapshot.timestamp)
+                except Exception as e:
+                    print(f"Error recording metrics to {type(sink).__name__}: {e}")
+        finally:
+            with self._lock:
+                self._in_flight = None
+            in_flight.set()
+
+    def payload(self):
+        """Return the snapshot with freshly rendered collection/staleness gauges"""
+        if self.snapshot is None or self.interval <= 0:
+            self.refresh()
+        snapshot = self.snapshot
+        tail = (
+            "# HELP rdma_exporter_collection_duration_seconds Time taken by the last collection\n"
+            "# TYPE rdma_exporter_collection_duration_seconds gauge\n"
+            f"rdma_exporter_collection_duration_seconds {snapshot.duration:.6f}\n"
+            "# HELP rdma_exporter_last_collection_timestamp_seconds Unix time of the last collection\n"
+            "# TYPE rdma_exporter_last_collection_timestamp_seconds gauge\n"
+            f"rdma_exporter_last_collection_timestamp_seconds {snapshot.timestamp:.3f}\n"
+            "# HELP rdma_exporter_snapshot_age_seconds Seconds since the served snapshot was collected\n"
+            "# TYPE rdma_exporter_snapshot_age_seconds gauge\n"
+            f"rdma_exporter_snapshot_age_seconds {time.monotonic() - snapshot.collected_at:.3f}\n"
+        )
+        for sink in self.sinks:
+            tail += '\n'.join(sink.render()) + '\n'
+        tail = tail.encode('utf-8')
+        # The ETag covers the counters only, so an unchanged host answers 304
+        return Payload(snapshot.body, tail, snapshot.etag, extras=snapshot.extras)
+
+
+def run_server(port=9101, backend='auto', interval=5.0, ethtool_allow=None, ethtool_deny=None,
+               microburst_ms=0.0, microburst_threshold=10000.0, microburst_cpu_budget=0.05,
+               workers=8, deadline=4.0, writer=None, ring=None, interfaces=None, rediscover_interval=10.0,
+               qp_top_k=0, qp_rank_by='cnp'):
+    """Run the metrics HTTP server, optionally pushing through 'writer' and recording to 'ring'"""
+    collector = RDMAMetricsCollector(backend=backend, ethtool_allow=ethtool_allow, ethtool_deny=ethtool_deny,
+                                     workers=workers, deadline=deadline, interfaces=interfaces,
+                                     rediscover_interval=rediscover_interval)
+    httpd, _ = start_server(collector, port, interval, microburst_ms, microburst_threshold,
+                            microburst_cpu_budget, writer, ring, qp_top_k, qp_rank_by)
+    httpd.serve_forever()
+
+
+def start_server(collector, port=9101, interval=5.0, microburst_ms=0.0, microburst_threshold=10000.0,
+                 microburst_cpu_budget=0.05, writer=None, ring=None, qp_top_k=0, qp_rank_by='cnp'):
+    """Start sampling 'collector' and return (HTTP server, MetricsSampler); the caller serves it"""
+    if microburst_ms > 0:
+        microburst = collector.enable_microburst(microburst_ms / 1000.0, microburst_threshold,
+                                                 microburst_cpu_budget)
+        if microburst is not None:
+            print(f"Microburst sampler: {microburst.interval * 1000:g} ms, "
+                  f"{len(microburst.series)} series, CPU budget {microburst_cpu_budget:.0%}")
+    if qp_top_k > 0:
+        collector.enable_qp_stats(qp_top_k, qp_rank_by)
+        print(f"Per-QP statistics: top {qp_top_k} QPs per link by {qp_rank_by} delta")
+    sinks = [sink for sink in (writer, ring) if sink is not None]
+    sampler = MetricsSampler(collector, interval, sinks)
+    if writer is not None:
+        writer.start()
+    sampler.start()
+    routes = {
+        '/metrics': lambda query: sampler.payload(),
+        '/health': lambda query: 'OK',
+        '/debug/profile': PROFILER.route,
+    }
+    if ring is not None:
+        routes['/backfill'] = ring.route
+    httpd = make_server(routes, port, host='')
     print(f"RDMA Metrics Exporter running on port {port}")
     print(f"Metrics endpoint: http://localhost:{port}/metrics")
-    print(f"Detected RDMA devices: {MetricsHandler.collector.rdma_devices}")
-    print(f"Detected network interfaces: {MetricsHandler.collector.network_interfaces}")
-    httpd.serve_forever()
+    print(f"Detected RDMA devices: {collector.device_netdevs}")
+    print(f"Scraped network interfaces: {collector.network_interfaces}")
+    print(f"Counter backend: {collector.backend}")
+    if interval > 0:
+        print(f"Sampling interval: {interval}s")
+    else:
+        print("Sampling interval: on demand (collect per scrape)")
+    if writer is not None:
+        print(f"Pushing to {writer.url.geturl()} (batch {writer.batch_size}, flush {writer.flush_interval}s)")
+    if ring is not None:
+        print(f"Recording to {ring.path} ({ring.capacity} samples); backfill: http://localhost:{port}/backfill")
+    return httpd, sampler
+
+
+def pattern_list(value):
+    """argparse type for comma-separated glob lists"""
+    return [pattern.strip() for pattern in value.split(',') if pattern.strip()]
+
+
+def build_parser(description='RDMA Metrics Exporter for Prometheus'):
+    """Argument parser shared with rdma_agent.py"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--port', type=int, default=9101, help='HTTP port (default: 9101)')
+    parser.add_argument('--backend', choices=RDMAMetricsCollector.BACKENDS, default='auto',
+                        help='Counter backend: sysfs reads kept-open files and ethtool ioctls, subprocess forks rdma/ethtool/cat')
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help='Background sampling interval in seconds; 0 collects on each scrape (default: 5)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Collector worker threads (default: 8)')
+    parser.add_argument('--deadline', type=float, default=4.0,
+                        help='Seconds a collection may take before partial results are returned (default: 4)')
+    parser.add_argument('--interfaces', type=pattern_list, metavar='NAMES',
+                        help='Comma-separated netdevs to scrape in addition to the RoCE-backing ones')
+    parser.add_argument('--rediscover-interval', type=float, default=10.0, metavar='SECONDS',
+                        help='Check sysfs for added/removed RDMA devices and netdevs this often; 0 disables '
+                             '(default: 10)')
+    parser.add_argument('--ethtool-allow', type=pattern_list, metavar='PATTERNS',
+                        help='Comma-separated ethtool counter globs to export '
+                             f'(default: {",".join(DEFAULT_ETHTOOL_ALLOW)}; empty string exports all)')
+    parser.add_argument('--ethtool-deny', type=pattern_list, metavar='PATTERNS',
+                        help='Comma-separated ethtool counter globs to drop '
+                             f'(default: {",".join(DEFAULT_ETHTOOL_DENY)})')
+    parser.add_argument('--microburst-ms', type=float, default=0.0, metavar='MS',
+                        help='Poll ECN/CNP/PFC prio3 counters every MS milliseconds (1-10); 0 disables (default)')
+    parser.add_argument('--microburst-threshold', type=float, default=10000.0, metavar='RATE',
+                        help='Events/s above which a sample interval counts as a burst (default: 10000)')
+    parser.add_argument('--microburst-cpu-budget', type=float, default=0.05, metavar='FRACTION',
+                        help='Max fraction of one core for the microburst sampler (default: 0.05)')
+    parser.add_argument('--qp-top-k', type=int, default=0, metavar='K',
+                        help='Export per-QP counters (rdma statistic qp) for the K busiest QPs per link, '
+                             'folding the rest into qp="other"; 0 disables (default). QPs only have '
+                             f'counters once bound, e.g. with "{qp_stats.BIND_HINT}"')
+    parser.add_argument('--qp-rank-by', choices=sorted(qp_stats.QP_RANK_COUNTERS), default='cnp',
+                        help='Per-interval counter delta that picks the top K QPs (default: cnp)')
+    remote_write.add_arguments(parser)
+    sample_ring.add_arguments(parser)
+    exposition.add_arguments(parser)
+    return parser
+
+
+def parse_args():
+    parser = build_parser()
+    parser.add_argument('--benchmark', type=int, metavar='N', nargs='?', const=20,
+                        help='Time N scrapes with each backend and exit')
+    args = parser.parse_args()
+    if (args.remote_write_url or args.ring_file) and args.interval <= 0:
+        parser.error('--remote-write-url and --ring-file need a background --interval above 0')
+    return args
 
 
 if __name__ == '__main__':
+    args = parse_args()
+    exposition.enable_formats(args.exposition_formats)
     try:
-        run_server(9101)
+        if args.benchmark:
+            run_benchmark(args.benchmark)
+        else:
+            run_server(args.port, args.backend, args.interval, args.ethtool_allow, args.ethtool_deny,
+                       args.microburst_ms, args.microburst_threshold, args.microburst_cpu_budget,
+                       args.workers, args.deadline, remote_write.from_args(args, 'rdma_exporter'),
+                       sample_ring.from_args(args), args.interfaces, args.rediscover_interval,
+                       args.qp_top_k, args.qp_rank_by)
     except KeyboardInterrupt:
         print("\nShutting down...")
     except Exception as e:
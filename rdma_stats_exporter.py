@@ -4,166 +4,359 @@ RDMA Statistics Exporter for Prometheus
 Exports RoCE/RDMA metrics including ECN and CNP statistics
 """
 
-from flask import Flask, Response
+import argparse
 import subprocess
 import re
+import threading
 import time
+from array import array
 
-app = Flask(__name__)
+import exporter_selfstats
+import exposition
+import remote_write
+from counter_rates import RateTracker
+from exporter_http import serve
+from exporter_selfstats import PROFILER, instrumented, record_bytes, record_error, run_command
+from metric_registry import MetricRegistry
+from rdma_exporter import compile_patterns, pattern_list
 
-# RDMA device to monitor
-RDMA_DEVICE = "rocep11s0"  # Will auto-detect if not found
+# RDMA device to monitor when discovery finds none
+RDMA_DEVICE = "rocep11s0"
 RDMA_PORT = "1"
 
-def get_rdma_device():
-    """Auto-detect RDMA device"""
-    try:
-        result = subprocess.run(['rdma', 'link', 'show'],
-                              capture_output=True, text=True, timeout=5)
-        if result.returncode == 0:
-            # Parse output like: "link rocep11s0/1 state ACTIVE"
-            match = re.search(r'link (\w+)/(\d+)', result.stdout)
-            if match:
-                return match.group(1), match.group(2)
-    except Exception as e:
-        print(f"Error detecting RDMA device: {e}")
+# Seconds between background refreshes of the RDMA link list
+DISCOVERY_TTL = 60.0
 
-    return RDMA_DEVICE, RDMA_PORT
+PROC_NET_DEV = '/proc/net/dev'
+# Interfaces exported by default; container and loopback links are skipped
+DEFAULT_INTERFACE_INCLUDE = ['*']
+DEFAULT_INTERFACE_EXCLUDE = ['lo', 'veth*', 'docker*', 'br-*', 'cni*', 'flannel*', 'cali*', 'virbr*']
 
-def parse_rdma_stats():
-    """Parse RDMA statistics from rdma tool"""
-    metrics = []
+# /proc/net/dev column -> metric name (receive columns 0-7, transmit 8-15)
+NET_DEV_COLUMNS = [
+    (0, 'rdma_interface_rx_bytes'),
+    (1, 'rdma_interface_rx_packets'),
+    (2, 'rdma_interface_rx_errors'),
+    (3, 'rdma_interface_rx_dropped'),
+    (7, 'rdma_interface_rx_multicast'),
+    (8, 'rdma_interface_tx_bytes'),
+    (9, 'rdma_interface_tx_packets'),
+    (10, 'rdma_interface_tx_errors'),
+    (11, 'rdma_interface_tx_dropped'),
+]
+
+# 'rdma statistic' counter -> metric name
+RDMA_STATS_MAP = {
+    'rx_write_requests': 'rdma_rx_write_requests',
+    'rx_read_requests': 'rdma_rx_read_requests',
+    'out_of_sequence': 'rdma_out_of_sequence',
+    'packet_seq_err': 'rdma_packet_seq_err',
+    'local_ack_timeout_err': 'rdma_ack_timeout_err',
+
+    # ECN/CNP statistics (key metrics!)
+    'np_ecn_marked_roce_packets': 'rdma_ecn_marked_packets',
+    'np_cnp_sent': 'rdma_cnp_sent',
+    'rp_cnp_handled': 'rdma_cnp_handled',
+    'rp_cnp_ignored': 'rdma_cnp_ignored',
+}
+
+# Server-side rates, computed between scrapes from collection timestamps
+RATES = RateTracker({
+    'rdma_ecn_marked_packets': 'ECN-marked RoCE packets',
+    'rdma_cnp_sent': 'CNP packets sent',
+    'rdma_cnp_handled': 'CNP packets received and handled',
+    'rdma_interface_rx_bytes': 'Interface RX bytes',
+    'rdma_interface_tx_bytes': 'Interface TX bytes',
+    'rdma_rx_write_requests': 'RDMA write requests received',
+    'rdma_rx_read_requests': 'RDMA read requests received',
+}, window=30.0, wrap_32=(
+    # mlx5 Q counters are 32 bits wide; a decrease near 2^32 is a wrap, not a reset
+    'rdma_rx_write_requests', 'rdma_rx_read_requests', 'rdma_out_of_sequence',
+    'rdma_packet_seq_err', 'rdma_ack_timeout_err',
+))
+
+REGISTRY = MetricRegistry()
+RDMA_LABELS = ('device', 'port')
+for name, help_text in [
+        ('rdma_ecn_marked_packets', 'ECN-marked RoCE packets'),
+        ('rdma_cnp_sent', 'CNP packets sent'),
+        ('rdma_cnp_handled', 'CNP packets received and handled'),
+        ('rdma_cnp_ignored', 'CNP packets ignored'),
+        ('rdma_rx_write_requests', 'RDMA write requests received'),
+        ('rdma_rx_read_requests', 'RDMA read requests received'),
+        ('rdma_out_of_sequence', 'Out-of-sequence packets received'),
+        ('rdma_packet_seq_err', 'Packet sequence errors'),
+        ('rdma_ack_timeout_err', 'Local ACK timeout errors')]:
+    REGISTRY.family(name, help_text, labelnames=RDMA_LABELS)
+for name, help_text in [
+        ('rdma_interface_rx_bytes', 'Interface RX bytes'),
+        ('rdma_interface_rx_packets', 'Interface RX packets'),
+        ('rdma_interface_rx_errors', 'Interface RX errors'),
+        ('rdma_interface_rx_dropped', 'Interface RX packets dropped'),
+        ('rdma_interface_rx_multicast', 'Interface RX multicast packets'),
+        ('rdma_interface_tx_bytes', 'Interface TX bytes'),
+        ('rdma_interface_tx_packets', 'Interface TX packets'),
+        ('rdma_interface_tx_errors', 'Interface TX errors'),
+        ('rdma_interface_tx_dropped', 'Interface TX packets dropped')]:
+    # device/port are set for netdevs that back an RDMA link, empty otherwise
+    REGISTRY.family(name, help_text, labelnames=('interface', 'device', 'port'))
+
+class InterfaceFilter:
+    """Include/exclude glob filter over interface names, memoised per name"""
+
+    def __init__(self, include=None, exclude=None):
+        self.include = compile_patterns(DEFAULT_INTERFACE_INCLUDE if include is None else include)
+        self.exclude = compile_patterns(DEFAULT_INTERFACE_EXCLUDE if exclude is None else exclude)
+        self._decisions = {}
+
+    def __call__(self, name):
+        decision = self._decisions.get(name)
+        if decision is None:
+            decision = ((self.include is None or self.include.match(name) is not None)
+                        and (self.exclude is None or self.exclude.match(name) is None))
+            if len(self._decisions) > 4096:
+                # veth churn on container hosts; keep the memo bounded
+                self._decisions.clear()
+            self._decisions[name] = decision
+        return decision
+
+INTERFACE_FILTER = InterfaceFilter()
+
+class LinkDiscovery:
+    """Cached list of RDMA links, refreshed every 'ttl' seconds
+
+    With start() a background thread keeps the list fresh so scrapes never
+    fork 'rdma link show'; without it, links() refreshes inline once stale.
+    A failed refresh keeps the previous list.
+    """
+
+    def __init__(self, ttl=DISCOVERY_TTL):
+        self.ttl = ttl
+        # [(device, port, netdev or None), ...]
+        self._links = None
+        self._refreshed_at = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        try:
+            result = run_command(['rdma', 'link', 'show'],
+                                  capture_output=True, text=True, timeout=5)
+        except Exception as e:
+            print(f"Error detecting RDMA devices: {e}")
+            record_error()
+            return
+        if result.returncode != 0:
+            record_error()
+            return
+
+        active, listed = [], []
+        for line in result.stdout.split('\n'):
+            # link rocep11s0/1 state ACTIVE physical_state LINK_UP netdev ens224
+            match = re.match(r'link\s+(\S+)/(\d+)', line)
+            if not match:
+                continue
+            netdev = re.search(r'\bnetdev\s+(\S+)', line)
+            link = (match.group(1), match.group(2), netdev.group(1) if netdev else None)
+            listed.append(link)
+            if 'state ACTIVE' in line:
+                active.append(link)
+        with self._lock:
+            self._links = active or listed
+            self._refreshed_at = time.monotonic()
+
+    def links(self):
+        """Active (device, port, netdev) links; every listed link if none is active"""
+        if self._links is None or time.monotonic() - self._refreshed_at > self.ttl * 2:
+            self.refresh()
+        return self._links or [(RDMA_DEVICE, RDMA_PORT, None)]
+
+    def netdevs(self):
+        """netdev -> (device, port)"""
+        return {netdev: (device, port) for device, port, netdev in self.links() if netdev}
 
-    device, port = get_rdma_device()
+    def start(self):
+        threading.Thread(target=self._run, name='rdma-discovery', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.ttl)
+            self.refresh()
+
+DISCOVERY = LinkDiscovery()
+
+@instrumented('parse_rdma_stats')
+def parse_rdma_stats():
+    """Parse RDMA statistics of every discovered link from one rdma tool call into REGISTRY"""
+    links = {(device, port) for device, port, _ in DISCOVERY.links()}
 
     try:
-        # Get RDMA link statistics
-        result = subprocess.run(
-            ['rdma', 'statistic', 'show', 'link', f'{device}/{port}'],
+        # One call reports every link: "link <dev>/<port> <name> <value> ..."
+        result = run_command(
+            ['rdma', 'statistic', 'show', 'link'],
             capture_output=True, text=True, timeout=5
         )
 
         if result.returncode != 0:
             print(f"Error getting RDMA stats: {result.stderr}")
-            return metrics
-
-        output = result.stdout
-
-        # Parse key statistics
-        stats_map = {
-            'rx_write_requests': 'rdma_rx_write_requests',
-            'rx_read_requests': 'rdma_rx_read_requests',
-            'out_of_sequence': 'rdma_out_of_sequence',
-            'packet_seq_err': 'rdma_packet_seq_err',
-            'local_ack_timeout_err': 'rdma_ack_timeout_err',
-
-            # ECN/CNP statistics (key metrics!)
-            'np_ecn_marked_roce_packets': 'rdma_ecn_marked_packets',
-            'np_cnp_sent': 'rdma_cnp_sent',
-            'rp_cnp_handled': 'rdma_cnp_handled',
-            'rp_cnp_ignored': 'rdma_cnp_ignored',
-        }
-
-        for stat_name, metric_name in stats_map.items():
-            # Use regex to find the statistic value
-            match = re.search(rf'{stat_name}\s+(\d+)', output)
-            if match:
-                value = match.group(1)
-                metrics.append(f'{metric_name}{{device="{device}",port="{port}"}} {value}')
+            record_error()
+            return
+
+        collected_at = time.monotonic()
+        counters = {}
+        tokens = result.stdout.split()
+        link = None
+        i = 0
+        while i < len(tokens) - 1:
+            name, value = tokens[i], tokens[i + 1]
+            i += 2
+            if name == 'link':
+                device, _, port = value.partition('/')
+                link = (device, port) if (device, port) in links else None
+                continue
+            if link is not None and name in RDMA_STATS_MAP and value.isdigit():
+                counters.setdefault(link, {})[name] = int(value)
+        for link, values in counters.items():
+            export_link_counters(link, values, collected_at)
 
     except subprocess.TimeoutExpired:
         print("Timeout getting RDMA stats")
+        record_error()
     except Exception as e:
         print(f"Error parsing RDMA stats: {e}")
+        record_error()
 
-    return metrics
+def export_link_counters(link, counters, collected_at):
+    """Set REGISTRY series of one (device, port) link from {rdma counter: value}"""
+    families = REGISTRY.families
+    for name, value in counters.items():
+        metric_name = RDMA_STATS_MAP.get(name)
+        if metric_name is None:
+            continue
+        series = families[metric_name].labels(*link)
+        series.set(value)
+        if metric_name in RATES.families:
+            RATES.observe(metric_name, series.labels, value, collected_at)
 
-def get_interface_stats():
-    """Get network interface statistics"""
-    metrics = []
+def read_net_dev(path=PROC_NET_DEV, wanted=None):
+    """Parse /proc/net/dev into {interface: array('Q') of its 16 counters}
 
-    try:
-        # Try to find RDMA interface (usually ens224, ens192, etc.)
-        result = subprocess.run(['ip', '-s', 'link'],
-                              capture_output=True, text=True, timeout=5)
-
-        if result.returncode == 0:
-            lines = result.stdout.split('\n')
-            current_iface = None
-
-            for i, line in enumerate(lines):
-                # Match interface name like "ens224:"
-                if_match = re.match(r'^\d+:\s+(\w+):', line)
-                if if_match:
-                    current_iface = if_match.group(1)
-
-                # Parse RX/TX stats
-                if current_iface and 'RX:' in line and i+1 < len(lines):
-                    stats_line = lines[i+1].strip()
-                    parts = stats_line.split()
-                    if len(parts) >= 2:
-                        rx_bytes = parts[0]
-                        rx_packets = parts[1]
-                        metrics.append(f'rdma_interface_rx_bytes{{interface="{current_iface}"}} {rx_bytes}')
-                        metrics.append(f'rdma_interface_rx_packets{{interface="{current_iface}"}} {rx_packets}')
-
-                if current_iface and 'TX:' in line and i+1 < len(lines):
-                    stats_line = lines[i+1].strip()
-                    parts = stats_line.split()
-                    if len(parts) >= 2:
-                        tx_bytes = parts[0]
-                        tx_packets = parts[1]
-                        metrics.append(f'rdma_interface_tx_bytes{{interface="{current_iface}"}} {tx_bytes}')
-                        metrics.append(f'rdma_interface_tx_packets{{interface="{current_iface}"}} {tx_packets}')
+    Interfaces rejected by 'wanted' are skipped before their counters are
+    parsed.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    record_bytes(len(data))
+    stats = {}
+    # Two header lines, then "  name: rx_bytes rx_packets ... tx_compressed"
+    for line in data.split(b'\n')[2:]:
+        name, sep, counters = line.partition(b':')
+        if not sep:
+            continue
+        name = name.strip().decode()
+        if wanted is not None and not wanted(name):
+            continue
+        values = counters.split()
+        if len(values) == 16:
+            stats[name] = array('Q', map(int, values))
+    return stats
 
-    except Exception as e:
+@instrumented('get_interface_stats')
+def get_interface_stats():
+    """Get network interface statistics from one /proc/net/dev read into REGISTRY"""
+    netdevs = DISCOVERY.netdevs()
+    try:
+        stats = read_net_dev(wanted=INTERFACE_FILTER)
+    except (OSError, ValueError) as e:
         print(f"Error getting interface stats: {e}")
+        record_error()
+        return
 
-    return metrics
+    export_interface_stats(stats, netdevs, time.monotonic())
 
-@app.route('/metrics')
-def metrics():
+def export_interface_stats(stats, netdevs, collected_at):
+    """Set REGISTRY interface series from a read_net_dev() result; netdevs maps netdev -> (device, port)"""
+    families = REGISTRY.families
+    columns = [(column, families[name], name in RATES.families) for column, name in NET_DEV_COLUMNS]
+    for interface, values in stats.items():
+        link = netdevs.get(interface, ('', ''))
+        for column, family, has_rate in columns:
+            series = family.labels(interface, *link)
+            series.set(values[column])
+            if has_rate:
+                RATES.observe(family.name, series.labels, values[column], collected_at)
+
+# remote_write.RemoteWriter when push mode is enabled
+WRITER = None
+
+def collect():
+    """Collect all statistics and render them as exposition bytes"""
+    # Concurrent scrapes share the registry, so collect and render one at a time
+    with REGISTRY.lock:
+        REGISTRY.begin()
+        parse_rdma_stats()
+        get_interface_stats()
+        body = REGISTRY.render()
+
+    # Server-side rates
+    output = RATES.render()
+    output.extend(exporter_selfstats.render())
+
+    return body + ('\n'.join(output) + '\n').encode('utf-8')
+
+@PROFILER.profiled
+def metrics(query=None):
     """Prometheus metrics endpoint"""
-    output = []
-
-    # RDMA statistics
-    output.append('# HELP rdma_ecn_marked_packets ECN-marked RoCE packets')
-    output.append('# TYPE rdma_ecn_marked_packets counter')
-    output.append('# HELP rdma_cnp_sent CNP packets sent')
-    output.append('# TYPE rdma_cnp_sent counter')
-    output.append('# HELP rdma_cnp_handled CNP packets received and handled')
-    output.append('# TYPE rdma_cnp_handled counter')
-    output.append('# HELP rdma_cnp_ignored CNP packets ignored')
-    output.append('# TYPE rdma_cnp_ignored counter')
-    output.append('# HELP rdma_rx_write_requests RDMA write requests received')
-    output.append('# TYPE rdma_rx_write_requests counter')
-    output.append('# HELP rdma_rx_read_requests RDMA read requests received')
-    output.append('# TYPE rdma_rx_read_requests counter')
-
-    # Collect metrics
-    rdma_metrics = parse_rdma_stats()
-    output.extend(rdma_metrics)
-
-    # Add interface stats
-    output.append('')
-    output.append('# HELP rdma_interface_rx_bytes Interface RX bytes')
-    output.append('# TYPE rdma_interface_rx_bytes counter')
-    output.append('# HELP rdma_interface_tx_bytes Interface TX bytes')
-    output.append('# TYPE rdma_interface_tx_bytes counter')
-
-    iface_metrics = get_interface_stats()
-    output.extend(iface_metrics)
-
-    return Response('\n'.join(output) + '\n', mimetype='text/plain')
-
-@app.route('/health')
-def health():
+    body = collect()
+    if WRITER is not None:
+        body += ('\n'.join(WRITER.render()) + '\n').encode('utf-8')
+    return body
+
+def push_loop(writer, interval):
+    """Collect every 'interval' seconds and queue the samples for remote_write"""
+    while True:
+        started = time.monotonic()
+        try:
+            writer.add_exposition(collect())
+        except Exception as e:
+            print(f"Error collecting metrics for remote_write: {e}")
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+def health(query=None):
     """Health check endpoint"""
     return 'OK'
 
+ROUTES = {
+    '/metrics': metrics,
+    '/health': health,
+    '/debug/profile': PROFILER.route,
+}
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='RDMA Statistics Exporter for Prometheus')
+    parser.add_argument('--port', type=int, default=9103, help='HTTP port (default: 9103)')
+    parser.add_argument('--interface-include', type=pattern_list, metavar='PATTERNS',
+                        help='Comma-separated interface globs to export (default: all)')
+    parser.add_argument('--interface-exclude', type=pattern_list, metavar='PATTERNS',
+                        help='Comma-separated interface globs to skip '
+                             f'(default: {",".join(DEFAULT_INTERFACE_EXCLUDE)}; empty string skips none)')
+    parser.add_argument('--push-interval', type=float, default=15.0, metavar='SECONDS',
+                        help='Collection interval in push mode (default: 15)')
+    remote_write.add_arguments(parser)
+    exposition.add_arguments(parser)
+    args = parser.parse_args()
+    exposition.enable_formats(args.exposition_formats)
+    INTERFACE_FILTER = InterfaceFilter(args.interface_include, args.interface_exclude)
+
     print("Starting RDMA Statistics Exporter...")
-    device, port = get_rdma_device()
-    print(f"Monitoring RDMA device: {device}/{port}")
-    print("Listening on http://0.0.0.0:9103/metrics")
-    app.run(host='0.0.0.0', port=9103)
+    DISCOVERY.refresh()
+    DISCOVERY.start()
+    for device, port, netdev in DISCOVERY.links():
+        print(f"Monitoring RDMA device: {device}/{port}" + (f" (netdev {netdev})" if netdev else ""))
+    WRITER = remote_write.from_args(args, 'rdma_stats_exporter')
+    if WRITER is not None:
+        WRITER.start()
+        threading.Thread(target=push_loop, args=(WRITER, args.push_interval),
+                         name='remote-write-collect', daemon=True).start()
+        print(f"Pushing to {args.remote_write_url} every {args.push_interval}s")
+    print(f"Listening on http://0.0.0.0:{args.port}/metrics")
+    serve(ROUTES, args.port)
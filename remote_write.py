@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+Prometheus remote_write push mode for the host exporters
+Batches samples into snappy-compressed protobuf WriteRequests and sends them
+from a background thread with a bounded retry queue
+"""
+
+import http.client
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit
+
+from exposition import decode_varint, encode_varint, pb_field
+
+REMOTE_WRITE_HEADERS = {
+    'Content-Type': 'application/x-protobuf',
+    'Content-Encoding': 'snappy',
+    'X-Prometheus-Remote-Write-Version': '0.1.0',
+    'User-Agent': 'rdma-exporter-remote-write',
+}
+
+LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+LABEL_UNESCAPE_RE = re.compile(r'\\(.)')
+
+# Parsed series are cached by their exposition text; cleared past this size
+SERIES_CACHE_MAX = 50000
+
+
+def encode_labels(labels):
+    """Encoded prometheus.Label fields (TimeSeries field 1) for sorted (name, value) pairs"""
+    return b''.join(
+        pb_field(b'\x0a', pb_field(b'\x0a', name.encode('utf-8')) + pb_field(b'\x12', value.encode('utf-8')))
+        for name, value in labels
+    )
+
+
+def encode_timeseries(encoded_labels, value, timestamp_ms):
+    """One prometheus.TimeSeries with a single sample, as a WriteRequest field"""
+    sample = b'\x09' + struct.pack('<d', value) + b'\x10' + encode_varint(timestamp_ms & 0xffffffffffffffff)
+    return pb_field(b'\x0a', encoded_labels + pb_field(b'\x12', sample))
+
+
+def decode_write_request(data):
+    """Decode a WriteRequest into [(labels dict, [(value, timestamp_ms), ...]), ...]"""
+    def fields(buf):
+        pos = 0
+        while pos < len(buf):
+            key, pos = decode_varint(buf, pos)
+            wire = key & 7
+            if wire == 0:
+                value, pos = decode_varint(buf, pos)
+            elif wire == 1:
+                value, pos = buf[pos:pos + 8], pos + 8
+            elif wire == 2:
+                length, pos = decode_varint(buf, pos)
+                value, pos = buf[pos:pos + length], pos + length
+            else:
+                raise ValueError(f"Unsupported wire type {wire}")
+            yield key >> 3, value
+
+    series = []
+    for number, ts in fields(data):
+        if number != 1:
+            continue
+        labels, samples = {}, []
+        for ts_number, item in fields(ts):
+            parts = dict(fields(item))
+            if ts_number == 1:
+                labels[parts.get(1, b'').decode('utf-8')] = parts.get(2, b'').decode('utf-8')
+            elif ts_number == 2:
+                timestamp = parts.get(2, 0)
+                if timestamp >= 1 << 63:
+                    timestamp -= 1 << 64
+                samples.append((struct.unpack('<d', parts.get(1, bytes(8)))[0], timestamp))
+        series.append((labels, samples))
+    return series
+
+
+def _emit_literal(out, data, start, end):
+    length = end - start - 1
+    if length < 60:
+        out.append(length << 2)
+    else:
+        count = (length.bit_length() + 7) // 8
+        out.append((59 + count) << 2)
+        out.extend(length.to_bytes(count, 'little'))
+    out.extend(data[start:end])
+
+
+def _emit_copy(out, offset, length):
+    # A copy carries at most 64 bytes; split so the last piece keeps at least 4
+    while length >= 68:
+        out.append((63 << 2) | 2)
+        out.extend(struct.pack('<H', offset))
+        length -= 64
+    if length > 64:
+        out.append((59 << 2) | 2)
+        out.extend(struct.pack('<H', offset))
+        length -= 60
+    if length <= 11 and offset < 2048:
+        out.append(((offset >> 8) << 5) | ((length - 4) << 2) | 1)
+        out.append(offset & 0xff)
+    else:
+        out.append(((length - 1) << 2) | 2)
+        out.extend(struct.pack('<H', offset))
+
+
+def snappy_compress(data):
+    """Snappy block-format compression (greedy 4-byte hash matcher)"""
+    data = bytes(data)
+    size = len(data)
+    out = bytearray(encode_varint(size))
+    table = {}
+    literal_start = pos = 0
+    limit = size - 4
+    while pos <= limit:
+        key = data[pos:pos + 4]
+        candidate = table.get(key)
+        table[key] = pos
+        if candidate is None or pos - candidate > 0xffff:
+            pos += 1
+            continue
+        length = 4
+        while pos + length < size and data[candidate + length] == data[pos + length]:
+            length += 1
+        if literal_start < pos:
+            _emit_literal(out, data, literal_start, pos)
+        _emit_copy(out, pos - candidate, length)
+        pos += length
+        literal_start = pos
+    if literal_start < size:
+        _emit_literal(out, data, literal_start, size)
+    return bytes(out)
+
+
+def snappy_decompress(data):
+    """Snappy block-format decompression"""
+    size, pos = decode_varint(data, 0)
+    out = bytearray()
+    while pos < len(data):
+        tag = data[pos]
+        pos += 1
+        kind = tag & 3
+        if kind == 0:
+            length = tag >> 2
+            if length >= 60:
+                count = length - 59
+                length = int.from_bytes(data[pos:pos + count], 'little')
+                pos += count
+            length += 1
+            out.extend(data[pos:pos + length])
+            pos += length
+            continue
+        if kind == 1:
+            length = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | data[pos]
+            pos += 1
+        elif kind == 2:
+            length = (tag >> 2) + 1
+            offset = struct.unpack_from('<H', data, pos)[0]
+            pos += 2
+        else:
+            length = (tag >> 2) + 1
+            offset = struct.unpack_from('<I', data, pos)[0]
+            pos += 4
+        start = len(out) - offset
+        for i in range(length):
+            out.append(out[start + i])
+    if len(out) != size:
+        raise ValueError(f"Snappy length mismatch: {len(out)} != {size}")
+    return bytes(out)
+
+
+class RemoteWriter:
+    """Pushes exposition samples to a remote_write endpoint
+
+    Samples accumulate until 'batch_size' are pending or 'flush_interval'
+    seconds pass, then become one compressed WriteRequest in a queue of at
+    most 'max_batches'. The sender retries the head batch with exponential
+    backoff on connection errors, 5xx and 429, preserving sample order; when
+    the queue is full the oldest batch is dropped.
+    """
+
+    def __init__(self, url, batch_size=500, flush_interval=5.0, max_batches=100,
+                 timeout=10.0, max_backoff=30.0, extra_labels=None):
+        self.url = urlsplit(url)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_batches = max_batches
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        # Added to every series unless the exposition already carries them
+        self.extra_labels = extra_labels or {}
+        self._series_cache = {}
+        self._pending = []
+        self._pending_since = None
+        self._batches = deque()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._conn = None
+        self.sent_samples = 0
+        self.dropped_samples = 0
+        self.failed_requests = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='remote-write', daemon=True)
+            self._thread.start()
+
+    def stop(self, flush=True):
+        """Stop the sender, optionally trying once to send what is queued"""
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if flush:
+            with self._cond:
+                self._cut_batch(force=True)
+            while self._batches and self._send_head():
+                pass
+        if self._conn is not None:
+            self._conn.close()
+
+    def _encoded_labels(self, series):
+        """Encoded label fields for an exposition series like 'name{a="b"}', cached"""
+        encoded = self._series_cache.get(series)
+        if encoded is None:
+            name, _, labels = series.partition('{')
+            pairs = dict(self.extra_labels)
+            for label, value in LABEL_RE.findall(labels):
+                pairs[label] = LABEL_UNESCAPE_RE.sub(lambda m: '\n' if m.group(1) == 'n' else m.group(1), value)
+            pairs['__name__'] = name
+            encoded = encode_labels(sorted(pairs.items()))
+            if len(self._series_cache) >= SERIES_CACHE_MAX:
+                self._series_cache.clear()
+            self._series_cache[series] = encoded
+        return encoded
+
+    def add_exposition(self, body, timestamp=None):
+        """Queue every sample of a text-format body (bytes or str) at 'timestamp' (Unix seconds)"""
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        timestamp_ms = int((time.time() if timestamp is None else timestamp) * 1000)
+        encoded = []
+        for line in body.split('\n'):
+            if not line or line[0] == '#':
+                continue
+            series, _, value = line.rpartition(' ')
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+            encoded.append(encode_timeseries(self._encoded_labels(series), value, timestamp_ms))
+
+        with self._cond:
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending.extend(encoded)
+            if len(self._pending) >= self.batch_size:
+                self._cut_batch()
+                self._cond.notify()
+
+    def _cut_batch(self, force=False):
+        """Move pending samples into compressed batches; caller holds _cond"""
+        if not self._pending:
+            return
+        if time.monotonic() - self._pending_since >= self.flush_interval:
+            force = True
+        while len(self._pending) >= self.batch_size or (force and self._pending):
+            chunk = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            if len(self._batches) >= self.max_batches:
+                self.dropped_samples += self._batches.popleft()[0]
+            self._batches.append((len(chunk), snappy_compress(b''.join(chunk))))
+        self._pending_since = time.monotonic()
+
+    def _post(self, payload):
+        """POST one WriteRequest; returns the HTTP status"""
+        if self._conn is None:
+            connection = http.client.HTTPSConnection if self.url.scheme == 'https' else http.client.HTTPConnection
+            self._conn = connection(self.url.netloc, timeout=self.timeout)
+        try:
+            self._conn.request('POST', self.url.path or '/', payload, REMOTE_WRITE_HEADERS)
+            response = self._conn.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            self._conn.close()
+            self._conn = None
+            raise
+
+    def _send_head(self):
+        """Send the oldest batch; False when it should be retried later"""
+        count, payload = self._batches[0]
+        try:
+            status = self._post(payload)
+        except (OSError, http.client.HTTPException) as e:
+            print(f"remote_write to {self.url.netloc} failed: {e}")
+            status = None
+        with self._cond:
+            if status is not None and (200 <= status < 300 or (400 <= status < 500 and status != 429)):
+                if self._batches and self._batches[0][1] is payload:
+                    self._batches.popleft()
+                if status < 300:
+                    self.sent_samples += count
+                else:
+                    # The receiver rejected the data itself; retrying cannot help
+                    print(f"remote_write batch rejected with HTTP {status}, dropping {count} samples")
+                    self.dropped_samples += count
+                return True
+            self.failed_requests += 1
+            return False
+
+    def _run(self):
+        backoff = 0.0
+        while not self._stop.is_set():
+            with self._cond:
+                if not self._batches:
+                    self._cond.wait(self.flush_interval / 2 if self._pending else self.flush_interval)
+                if self._pending:
+                    self._cut_batch()
+                has_batch = bool(self._batches)
+            if not has_batch or self._stop.is_set():
+                continue
+            if self._send_head():
+                backoff = 0.0
+            else:
+                backoff = min(self.max_backoff, backoff * 2 or 0.5)
+                self._stop.wait(backoff)
+
+    def render(self):
+        """Exposition lines describing the push queue"""
+        with self._cond:
+            queued = sum(count for count, _ in self._batches) + len(self._pending)
+            batches = len(self._batches)
+        return [
+            "# HELP exporter_remote_write_samples_sent_total Samples accepted by the remote_write endpoint",
+            "# TYPE exporter_remote_write_samples_sent_total counter",
+            f"exporter_remote_write_samples_sent_total {self.sent_samples}",
+            "# HELP exporter_remote_write_samples_dropped_total Samples dropped (queue full or rejected)",
+            "# TYPE exporter_remote_write_samples_dropped_total counter",
+            f"exporter_remote_write_samples_dropped_total {self.dropped_samples}",
+            "# HELP exporter_remote_write_failed_requests_total remote_write requests to be retried",
+            "# TYPE exporter_remote_write_failed_requests_total counter",
+            f"exporter_remote_write_failed_requests_total {self.failed_requests}",
+            "# HELP exporter_remote_write_queued_samples Samples waiting to be sent",
+            "# TYPE exporter_remote_write_queued_samples gauge",
+            f"exporter_remote_write_queued_samples {queued}",
+            "# HELP exporter_remote_write_queued_batches Compressed batches waiting to be sent",
+            "# TYPE exporter_remote_write_queued_batches gauge",
+            f"exporter_remote_write_queued_batches {batches}",
+        ]
+
+
+def add_arguments(parser):
+    """Add the --remote-write-* options to an exporter's argument parser"""
+    parser.add_argument('--remote-write-url', metavar='URL',
+                        help='Also push samples to this remote_write endpoint, '
+                             'e.g. http://server1:9090/api/v1/write')
+    parser.add_argument('--remote-write-batch-size', type=int, default=500, metavar='N',
+                        help='Samples per remote_write request (default: 500)')
+    parser.add_argument('--remote-write-flush-interval', type=float, default=5.0, metavar='SECONDS',
+                        help='Send a partial batch after this long (default: 5)')
+    parser.add_argument('--remote-write-queue', type=int, default=100, metavar='BATCHES',
+                        help='Batches kept for retry before the oldest is dropped (default: 100)')
+
+
+def from_args(args, job):
+    """RemoteWriter configured from add_arguments() options, or None"""
+    if not args.remote_write_url:
+        return None
+    return RemoteWriter(args.remote_write_url, args.remote_write_batch_size,
+                        args.remote_write_flush_interval, args.remote_write_queue,
+                        extra_labels={'job': job, 'instance': socket.gethostname()})
+
+
+class _ReceiverHandler(BaseHTTPRequestHandler):
+    """Stand-in remote_write receiver that decodes and prints requests"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            series = decode_write_request(snappy_decompress(body))
+        except Exception as e:
+            print(f"Bad remote_write request: {e}")
+            self.send_response(400)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        print(f"{len(series)} series, {len(body)} bytes compressed")
+        for labels, samples in series:
+            name = labels.pop('__name__', '')
+            label_text = ','.join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+            for value, timestamp in samples:
+                print(f"  {name}{{{label_text}}} {value} @{timestamp}")
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} <listen port>")
+        sys.exit(1)
+    print(f"remote_write receiver listening on :{sys.argv[1]}")
+    HTTPServer(('', int(sys.argv[1])), _ReceiverHandler).serve_forever()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+On-disk ring buffer of exporter samples
+Fixed-width records in a memory-mapped file, read back by /backfill as OpenMetrics
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+
+from exporter_http import Stream
+from exposition import OPENMETRICS_CONTENT_TYPE
+
+# Version 2: the .series file is a log of '<id>\t<series>' assignments
+RING_MAGIC = b'RDMARNG2'
+# magic, record size, capacity (records), head (records ever written)
+HEADER = struct.Struct('<8sIQQ')
+HEADER_SIZE = 64
+# timestamp (ms), series id, value
+RECORD = struct.Struct('<qId')
+
+STREAM_CHUNK_BYTES = 64 * 1024
+# Records read per hold of the writer lock while streaming
+STREAM_WINDOW_RECORDS = 4096
+
+
+def format_sample_value(value):
+    if value.is_integer() and abs(value) < 1e18:
+        return '%d' % value
+    return repr(value)
+
+
+class SampleRing:
+    """Fixed-size ring file of (timestamp, series id, value) records
+
+    Records are RECORD.size bytes and written in place through mmap, so
+    memory and per-sample write cost stay constant; once the file is full the
+    oldest records are overwritten. Series texts (e.g. 'pfc_pause_frames{...}')
+    get numeric ids, logged as '<id>\t<series>' lines in '<path>.series',
+    next to the '# TYPE' line of every family seen in the recorded bodies.
+    An id whose last sample has been overwritten is freed and reused, and the
+    log is rewritten with the live ids once it has grown to twice their
+    number, so churning label sets do not grow the table or the file.
+    Samples older than 'retention' seconds are not served.
+    """
+
+    def __init__(self, path, size_bytes, retention):
+        self.path = path
+        self.retention = retention
+        self.capacity = max(1, (size_bytes - HEADER_SIZE) // RECORD.size)
+        self._lock = threading.Lock()
+
+        size = HEADER_SIZE + self.capacity * RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.pread(fd, HEADER.size, 0)
+            fresh = (len(header) < HEADER.size
+                     or HEADER.unpack(header)[:3] != (RING_MAGIC, RECORD.size, self.capacity))
+            if fresh:
+                # New file or different geometry: start over
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self._series_path = path + '.series'
+        if fresh:
+            open(self._series_path, 'w').close()
+            HEADER.pack_into(self._map, 0, RING_MAGIC, RECORD.size, self.capacity, 0)
+        self.head = HEADER.unpack_from(self._map, 0)[3]
+
+        # id -> series text (None when free), and the index of its newest record
+        self.series = []
+        # family name -> type, from the bodies' '# TYPE' lines
+        self.types = {}
+        self._last_index = array('q')
+        self._log_lines = 0
+        try:
+            with open(self._series_path, encoding='utf-8') as f:
+                for line in f:
+                    if line.startswith('# TYPE '):
+                        name, _, metric_type = line[7:].strip().partition(' ')
+                        self.types[name] = metric_type
+                        continue
+                    series_id, _, series = line.rstrip('\n').partition('\t')
+                    if not series_id.isdigit():
+                        continue
+                    series_id = int(series_id)
+                    while len(self.series) <= series_id:
+                        self.series.append(None)
+                        self._last_index.append(-1)
+                    self.series[series_id] = series
+                    self._log_lines += 1
+        except FileNotFoundError:
+            pass
+        for index in range(max(0, self.head - self.capacity), self.head):
+            series_id = self._record(index)[1]
+            if series_id < len(self.series):
+                self._last_index[series_id] = index
+        self._series_ids = {}
+        self._free = []
+        self._swept_at = self.head
+        self._series_file = None
+        self._sweep()
+        self._compact()
+
+    def _series_id(self, series):
+        series_id = self._series_ids.get(series)
+        if series_id is None:
+            if self._free:
+                series_id = self._free.pop()
+                self.series[series_id] = series
+            else:
+                series_id = len(self.series)
+                self.series.append(series)
+                self._last_index.append(-1)
+            self._series_ids[series] = series_id
+            self._series_file.write(f'{series_id}\t{series}\n')
+            self._series_file.flush()
+            self._log_lines += 1
+        return series_id
+
+    def _sweep(self):
+        """Free ids whose newest record has been overwritten"""
+        oldest = self.head - self.capacity
+        self._series_ids = {}
+        self._free = []
+        for series_id, series in enumerate(self.series):
+            if series is not None and self._last_index[series_id] < oldest:
+                self.series[series_id] = None
+            if self.series[series_id] is None:
+                self._free.append(series_id)
+            else:
+                self._series_ids[series] = series_id
+        # Lowest ids are handed out first
+        self._free.reverse()
+        self._swept_at = self.head
+
+    def _compact(self):
+        """Rewrite the series log with only the live ids"""
+        if self._series_file is not None:
+            self._series_file.close()
+        temporary = self._series_path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            for name, metric_type in self.types.items():
+                f.write(f'# TYPE {name} {metric_type}\n')
+            for series, series_id in self._series_ids.items():
+                f.write(f'{series_id}\t{series}\n')
+        os.replace(temporary, self._series_path)
+        self._log_lines = len(self._series_ids)
+        self._series_file = open(self._series_path, 'a', encoding='utf-8')
+
+    def _set_type(self, name, metric_type):
+        if self.types.get(name) != metric_type:
+            self.types[name] = metric_type
+            self._series_file.write(f'# TYPE {name} {metric_type}\n')
+            self._series_file.flush()
+            self._log_lines += 1
+
+    def _family(self, sample_name):
+        """OpenMetrics (family name, type) of a recorded sample name
+
+        Sample names are streamed as recorded so backfilled series match the
+        scraped ones; a counter recorded as '<name>_total' is typed as '<name>'.
+        """
+        name, metric_type = sample_name, self.types.get(sample_name)
+        if metric_type is None:
+            base, _, suffix = sample_name.rpartition('_')
+            if suffix in ('bucket', 'sum', 'count') and self.types.get(base) in ('histogram', 'summary'):
+                name, metric_type = base, self.types[base]
+            else:
+                return sample_name, 'unknown'
+        if metric_type == 'counter' and name.endswith('_total'):
+            name = name[:-6]
+        elif metric_type not in ('counter', 'gauge', 'histogram', 'summary'):
+            metric_type = 'unknown'
+        return name, metric_type
+
+    def add_exposition(self, body, timestamp=None):
+        """Append every sample of a text-format body (bytes or str) at 'timestamp' (Unix seconds)"""
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        timestamp_ms = int((time.time() if timestamp is None else timestamp) * 1000)
+        pack_into, record_size, capacity = RECORD.pack_into, RECORD.size, self.capacity
+        with self._lock:
+            head = self.head
+            for line in body.split('\n'):
+                if not line:
+                    continue
+                if line[0] == '#':
+                    if line.startswith('# TYPE '):
+                        name, _, metric_type = line[7:].partition(' ')
+                        self._set_type(name, metric_type.strip())
+                    continue
+                series, _, value = line.rpartition(' ')
+                try:
+                    value = float(value)
+                except ValueError:
+                    continue
+                series_id = self._series_id(series)
+                pack_into(self._map, HEADER_SIZE + (head % capacity) * record_size,
+                          timestamp_ms, series_id, value)
+                self._last_index[series_id] = head
+                head += 1
+            # Publish the new head once per batch
+            struct.pack_into('<Q', self._map, 20, head)
+            self.head = head
+            # Every quarter of the ring, free the ids that have wrapped out
+            if head - self._swept_at >= max(1, capacity // 4):
+                self._sweep()
+                if self._log_lines > 2 * len(self._series_ids) + 64:
+                    self._compact()
+
+    def _record(self, index):
+        return RECORD.unpack_from(self._map, HEADER_SIZE + (index % self.capacity) * RECORD.size)
+
+    def _bounds(self, start_ms, end_ms):
+        """Record index range [lo, hi) with timestamps in [start_ms, end_ms)"""
+        head = self.head
+        oldest = max(0, head - self.capacity)
+
+        class Timestamps:
+            # Records are appended in time order, so the ring can be bisected
+            def __len__(_):
+                return head - oldest
+
+            def __getitem__(_, i):
+                return self._record(oldest + i)[0]
+
+        timestamps = Timestamps()
+        return (oldest + bisect.bisect_left(timestamps, start_ms),
+                oldest + bisect.bisect_left(timestamps, end_ms))
+
+    def openmetrics(self, start, end):
+        """Generate OpenMetrics text chunks for samples in [start, end) (Unix seconds)
+
+        Samples are grouped by metric family as OpenMetrics requires. Records
+        are read STREAM_WINDOW_RECORDS at a time under the writer lock, so none
+        is overwritten or has its series id reused mid-read, and each window's
+        lines are spilled to one temporary file per family; memory stays
+        bounded however wide the range. The families are then streamed one
+        after another, each under its '# TYPE' line.
+        """
+        start = max(start, time.time() - self.retention)
+        spills = {}
+        try:
+            with self._lock:
+                lo, hi = self._bounds(int(start * 1000), int(end * 1000))
+            for window in range(lo, hi, STREAM_WINDOW_RECORDS):
+                by_family = {}
+                with self._lock:
+                    # Records behind the ring head were overwritten since _bounds()
+                    for index in range(max(window, self.head - self.capacity),
+                                       min(window + STREAM_WINDOW_RECORDS, hi)):
+                        timestamp_ms, series_id, value = self._record(index)
+                        series = self.series[series_id] if series_id < len(self.series) else None
+                        if series is None:
+                            continue
+                        family = self._family(series.partition('{')[0])
+                        by_family.setdefault(family, []).append(
+                            f'{series} {format_sample_value(value)} {timestamp_ms / 1000:.3f}\n')
+                for family, lines in by_family.items():
+                    spill = spills.get(family)
+                    if spill is None:
+                        spill = spills[family] = tempfile.TemporaryFile()
+                    spill.write(''.join(lines).encode('utf-8'))
+
+            for (name, metric_type), spill in sorted(spills.items()):
+                spill.seek(0)
+                chunk = f'# TYPE {name} {metric_type}\n'.encode('utf-8') + spill.read(STREAM_CHUNK_BYTES)
+                while chunk:
+                    yield chunk
+                    chunk = spill.read(STREAM_CHUNK_BYTES)
+        finally:
+            for spill in spills.values():
+                spill.close()
+        yield b'# EOF\n'
+
+    def route(self, query):
+        """HTTP route: /backfill?from=<unix seconds>&to=<unix seconds> (default: whole retention)"""
+        now = time.time()
+        start = float(query.get('from', now - self.retention))
+        end = float(query.get('to', now + 1))
+        return Stream(self.openmetrics(start, end), OPENMETRICS_CONTENT_TYPE)
+
+    def render(self):
+        """Exposition lines describing the ring"""
+        head = self.head
+        lines = [
+            "# HELP exporter_sample_ring_samples_written_total Samples appended to the on-disk ring",
+            "# TYPE exporter_sample_ring_samples_written_total counter",
+            f"exporter_sample_ring_samples_written_total {head}",
+            "# HELP exporter_sample_ring_capacity_samples Samples the ring file holds",
+            "# TYPE exporter_sample_ring_capacity_samples gauge",
+            f"exporter_sample_ring_capacity_samples {self.capacity}",
+            "# HELP exporter_sample_ring_series Series ids in use (freed once their samples are overwritten)",
+            "# TYPE exporter_sample_ring_series gauge",
+            f"exporter_sample_ring_series {len(self._series_ids)}",
+        ]
+        if head:
+            oldest = self._record(max(0, head - self.capacity))[0]
+            lines += [
+                "# HELP exporter_sample_ring_oldest_timestamp_seconds Timestamp of the oldest retained sample",
+                "# TYPE exporter_sample_ring_oldest_timestamp_seconds gauge",
+                f"exporter_sample_ring_oldest_timestamp_seconds {oldest / 1000:.3f}",
+            ]
+        return lines
+
+    def close(self):
+        self._map.flush()
+        self._map.close()
+        self._series_file.close()
+
+
+def add_arguments(parser):
+    """Add the --ring-* options to an exporter's argument parser"""
+    parser.add_argument('--ring-file', metavar='PATH',
+                        help='Record every collection to this ring file and serve it on /backfill')
+    parser.add_argument('--ring-size-mb', type=float, default=64.0, metavar='MB',
+                        help=f'Ring file size; {RECORD.size} bytes per sample (default: 64)')
+    parser.add_argument('--ring-retention', type=float, default=24.0, metavar='HOURS',
+                        help='Serve samples at most this old (default: 24)')
+
+
+def from_args(args):
+    """SampleRing configured from add_arguments() options, or None"""
+    if not args.ring_file:
+        return None
+    return SampleRing(args.ring_file, int(args.ring_size_mb * 1024 * 1024), args.ring_retention * 3600)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 4):
+        print(f"Usage: {sys.argv[0]} <ring file> [<from> <to>]")
+        sys.exit(1)
+    path = sys.argv[1]
+    size = os.path.getsize(path)
+    ring = SampleRing(path, size, float('inf'))
+    start, end = (float(sys.argv[2]), float(sys.argv[3])) if len(sys.argv) == 4 else (0, time.time() + 1)
+    for chunk in ring.openmetrics(start, end):
+        sys.stdout.write(chunk.decode('utf-8'))
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Persistent SSH sessions for the ESXi exporter
+One OpenSSH control master per host; commands are multiplexed over it
+"""
+
+import atexit
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from exporter_selfstats import run_command
+
+# Idle seconds after which an orphaned control master exits on its own
+CONTROL_PERSIST = 600
+
+
+class SSHError(Exception):
+    """The host is unreachable, failed authentication, or is in reconnect backoff"""
+
+
+class SSHConnection:
+    """One authenticated session to a host, reused for every command
+
+    connect() starts an OpenSSH control master ('ssh -M -N -f') through
+    sshpass; run() then opens channels over the master's socket, so a
+    command costs a local fork but no TCP handshake, key exchange or
+    authentication. When the master dies or a command fails at the SSH
+    level (exit status 255) the master is torn down and reconnected on
+    the next run(), with exponential backoff after failed connects.
+    """
+
+    def __init__(self, host, user, password, control_dir, connect_timeout=10,
+                 backoff=1.0, max_backoff=60.0):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.control_path = os.path.join(control_dir, f'{user}@{host}')
+        self.connect_timeout = connect_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.connects = 0
+        self.failures = 0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def target(self):
+        return f'{self.user}@{self.host}'
+
+    def ssh_args(self, *options):
+        return ['ssh', '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null',
+                '-o', 'LogLevel=ERROR', '-o', f'ControlPath={self.control_path}',
+                '-o', f'ConnectTimeout={self.connect_timeout}',
+                '-o', 'ServerAliveInterval=15', '-o', 'ServerAliveCountMax=3', *options]
+
+    def connected(self):
+        """Whether a control master socket is present"""
+        return os.path.exists(self.control_path)
+
+    def connect(self):
+        """Start the control master, or raise SSHError (and back off)"""
+        now = time.monotonic()
+        if now < self._retry_at:
+            raise SSHError(f"{self.host}: reconnecting in {self._retry_at - now:.1f}s")
+        # The password goes through the environment, not the process list
+        args = ['sshpass', '-e'] + self.ssh_args('-o', 'ControlMaster=yes',
+                                                  '-o', f'ControlPersist={CONTROL_PERSIST}',
+                                                  '-N', '-f', self.target)
+        try:
+            result = run_command(args, capture_output=True, text=True, timeout=self.connect_timeout + 5,
+                                 env=dict(os.environ, SSHPASS=self.password))
+            error = None if result.returncode == 0 and self.connected() else (
+                result.stderr.strip() or f"exit status {result.returncode}")
+        except (OSError, subprocess.TimeoutExpired) as e:
+            error = str(e)
+        if error is not None:
+            self.failures += 1
+            delay = min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+            self._retry_at = time.monotonic() + delay
+            raise SSHError(f"{self.host}: connect failed ({error}); retrying in {delay:.0f}s")
+        self.failures = 0
+        self.connects += 1
+
+    def disconnect(self):
+        """Stop the control master if one is running"""
+        if self.connected():
+            try:
+                subprocess.run(self.ssh_args('-O', 'exit', self.target),
+                               capture_output=True, timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+            try:
+                os.unlink(self.control_path)
+            except OSError:
+                pass
+
+    def run(self, command, timeout=10):
+        """Run a remote command over the shared session; returns the CompletedProcess"""
+        with self._lock:
+            if not self.connected():
+                self.connect()
+        result = run_command(self.ssh_args('-o', 'ControlMaster=no', self.target, command),
+                             capture_output=True, text=True, timeout=timeout)
+        if result.returncode == 255:
+            # The session, not the command, failed: start over next time
+            with self._lock:
+                self.disconnect()
+            raise SSHError(f"{self.host}: {result.stderr.strip() or 'session lost'}")
+        return result
+
+
+class SSHPool:
+    """SSHConnection per (user, host), with control sockets in a private directory"""
+
+    def __init__(self, connect_timeout=10, max_backoff=60.0):
+        self.connect_timeout = connect_timeout
+        self.max_backoff = max_backoff
+        self.control_dir = tempfile.mkdtemp(prefix='esxi-ssh-')
+        self._connections = {}
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def get(self, host, user, password):
+        key = (user, host)
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is None:
+                connection = self._connections[key] = SSHConnection(
+                    host, user, password, self.control_dir, self.connect_timeout, max_backoff=self.max_backoff)
+            return connection
+
+    def close(self):
+        with self._lock:
+            connections = list(self._connections.values())
+        for connection in connections:
+            connection.disconnect()
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+    def render(self):
+        """Exposition lines for session state per host"""
+        with self._lock:
+            connections = sorted(self._connections.values(), key=lambda c: c.host)
+        lines = [
+            "# HELP esxi_ssh_connected Whether a persistent SSH session to the host is open",
+            "# TYPE esxi_ssh_connected gauge",
+        ]
+        lines += [f'esxi_ssh_connected{{esxi_ip="{c.host}"}} {int(c.connected())}' for c in connections]
+        lines += [
+            "# HELP esxi_ssh_connects_total SSH sessions established (reconnects included)",
+            "# TYPE esxi_ssh_connects_total counter",
+        ]
+        lines += [f'esxi_ssh_connects_total{{esxi_ip="{c.host}"}} {c.connects}' for c in connections]
+        return lines
+
+
+if __name__ == '__main__':
+    # python3 ssh_pool.py <user@host> <password> <command>: run a command twice over one session
+    if len(sys.argv) != 4:
+        print(f"Usage: {sys.argv[0]} <user@host> <password> <command>")
+        sys.exit(1)
+    user, _, host = sys.argv[1].rpartition('@')
+    pool = SSHPool()
+    connection = pool.get(host, user or 'root', sys.argv[2])
+    for attempt in range(2):
+        started = time.perf_counter()
+        result = connection.run(sys.argv[3])
+        print(f"run {attempt + 1}: exit {result.returncode} in {(time.perf_counter() - started) * 1000:.1f} ms")
+    sys.stdout.write(result.stdout)
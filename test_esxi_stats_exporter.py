@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Parser tests for esxi_stats_exporter against a recorded vsish pNic dump
+Run with: python3 -m unittest test_esxi_stats_exporter
+"""
+
+import os
+import unittest
+
+import esxi_stats_exporter
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vsish_pnic_stats_nmlx5.txt')
+
+
+def load_fixture():
+    with open(FIXTURE) as f:
+        return f.read()
+
+
+class ParseVsishStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.samples = {(family, labels): value for family, names, labels, value
+                        in esxi_stats_exporter.parse_vsish_stats(load_fixture())}
+
+    def test_packet_stats(self):
+        self.assertEqual(self.samples[('esxi_nic_bytes', ('rx',))], 1245874392771)
+        self.assertEqual(self.samples[('esxi_nic_bytes', ('tx',))], 1093220487716)
+        self.assertEqual(self.samples[('esxi_nic_packets', ('rx',))], 184467215)
+        self.assertEqual(self.samples[('esxi_nic_dropped', ('rx',))], 12)
+        self.assertEqual(self.samples[('esxi_nic_errors', ('tx',))], 0)
+
+    def test_packet_stats_win_over_generic_names(self):
+        # rxerr (0) is listed before 'Total receive errors' (3)
+        self.assertEqual(self.samples[('esxi_nic_errors', ('rx',))], 0)
+        byte_series = [labels for family, _, labels, _ in esxi_stats_exporter.parse_vsish_stats(load_fixture())
+                       if family == 'esxi_nic_bytes']
+        self.assertEqual(byte_series, [('rx',), ('tx',)])
+
+    def test_generic_names_with_spaces(self):
+        output = 'private stats:   NIC statistics:\n   Bytes received: 10\n   Bytes sent: 20\n' \
+                 '   Receive packets dropped: 3\n   Total transmit errors: 4\n'
+        samples = {(family, labels): value for family, _, labels, value
+                   in esxi_stats_exporter.parse_vsish_stats(output)}
+        self.assertEqual(samples, {
+            ('esxi_nic_bytes', ('rx',)): 10,
+            ('esxi_nic_bytes', ('tx',)): 20,
+            ('esxi_nic_dropped', ('rx',)): 3,
+            ('esxi_nic_errors', ('tx',)): 4,
+        })
+
+    def test_first_private_counter(self):
+        samples = esxi_stats_exporter.parse_vsish_stats('   private stats:   rxPauseCtrlPhy: 5\n')
+        self.assertEqual(samples, [('esxi_pause_rx_phy', (), (), 5)])
+
+    def test_pause_counters(self):
+        self.assertEqual(self.samples[('esxi_pause_rx_phy', ())], 41872)
+        self.assertEqual(self.samples[('esxi_pause_tx_phy', ())], 913)
+        self.assertEqual(self.samples[('esxi_pause_prio_frames', ('rx', '3'))], 41872)
+        self.assertEqual(self.samples[('esxi_pause_prio_duration', ('rx', '3'))], 2093600)
+        self.assertEqual(self.samples[('esxi_pause_prio_transitions', ('tx', '3'))], 456)
+        self.assertEqual(self.samples[('esxi_pause_storm_errors', ())], 0)
+
+    def test_ring_full(self):
+        self.assertEqual(self.samples[('esxi_nic_ring_full', ('rx_out_of_buffer',))], 7)
+        self.assertEqual(self.samples[('esxi_nic_ring_full', ('rxRingFull',))], 2)
+
+    def test_unknown_counters_ignored(self):
+        families = {family for family, _ in self.samples}
+        self.assertTrue(families <= {family for family, _, _ in esxi_stats_exporter.ESXI_FAMILIES})
+        self.assertNotIn('rxmltcast', str(self.samples))
+
+    def test_batched_sections(self):
+        dump = load_fixture()
+        output = f'{esxi_stats_exporter.SECTION_MARKER}vmnic4\n{dump}{esxi_stats_exporter.SECTION_MARKER}vmnic5\n{dump}'
+        sections = esxi_stats_exporter.split_sections(output)
+        self.assertEqual(sorted(sections), ['vmnic4', 'vmnic5'])
+        lines = esxi_stats_exporter.format_vmnic_stats('esxi1', '192.0.2.1', 'vmnic4', sections['vmnic4'], 0.0)
+        self.assertIn('esxi_nic_bytes{host="esxi1",vmnic="vmnic4",esxi_ip="192.0.2.1",direction="rx"} '
+                      '1245874392771', lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
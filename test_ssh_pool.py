@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Tests for ssh_pool against fake 'ssh' and 'sshpass' commands on PATH
+Run with: python3 -m unittest test_ssh_pool
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from ssh_pool import SSHConnection, SSHError, SSHPool
+
+PASSWORD = 'secret'
+
+# Stands in for OpenSSH: 'ControlMaster=yes' creates the control socket
+# (a plain file), '-O exit' removes it, and channels run the command locally
+# while the socket exists. Marker files in $FAKE_SSH_STATE make the host
+# unreachable or the master unresponsive; every invocation is logged there.
+FAKE_SSH = f'''#!{sys.executable}
+import os, sys
+state = os.environ['FAKE_SSH_STATE']
+options, rest = {{}}, []
+args = sys.argv[1:]
+while args:
+    arg = args.pop(0)
+    if arg in ('-o', '-O'):
+        key, _, value = args.pop(0).partition('=')
+        options[key if arg == '-o' else '-O'] = value or key
+    elif arg.startswith('-'):
+        options[arg] = True
+    else:
+        rest.append(arg)
+
+def log(event):
+    with open(os.path.join(state, 'log'), 'a') as f:
+        f.write(event + '\\n')
+
+path = options['ControlPath']
+if options.get('-O') == 'exit':
+    log('exit')
+    if os.path.exists(path):
+        os.unlink(path)
+    sys.exit(0)
+if options.get('ControlMaster') == 'yes':
+    log('master')
+    if os.path.exists(os.path.join(state, 'unreachable')):
+        sys.stderr.write('ssh: connect to host: Connection refused\\n')
+        sys.exit(255)
+    if os.environ.get('SSHPASS') != {PASSWORD!r}:
+        sys.stderr.write('Permission denied\\n')
+        sys.exit(5)
+    open(path, 'w').close()
+    sys.exit(0)
+if not os.path.exists(path) or os.path.exists(os.path.join(state, 'master_dead')):
+    sys.stderr.write('Control socket connect: Connection refused\\n')
+    sys.exit(255)
+log('run ' + rest[-1])
+os.execvp('sh', ['sh', '-c', rest[-1]])
+'''
+
+FAKE_SSHPASS = '''#!/bin/sh
+[ "$1" = -e ] && shift
+exec "$@"
+'''
+
+
+class FakeSSHTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='test-ssh-pool-')
+        self.bin = os.path.join(self.directory, 'bin')
+        self.state = os.path.join(self.directory, 'state')
+        self.control_dir = os.path.join(self.directory, 'control')
+        for path in (self.bin, self.state, self.control_dir):
+            os.mkdir(path)
+        for name, script in (('ssh', FAKE_SSH), ('sshpass', FAKE_SSHPASS)):
+            path = os.path.join(self.bin, name)
+            with open(path, 'w') as f:
+                f.write(script)
+            os.chmod(path, 0o755)
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = self.bin + os.pathsep + os.environ.get('PATH', '')
+        os.environ['FAKE_SSH_STATE'] = self.state
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def events(self):
+        try:
+            with open(os.path.join(self.state, 'log')) as f:
+                return f.read().split('\n')[:-1]
+        except FileNotFoundError:
+            return []
+
+    def mark(self, name, present=True):
+        path = os.path.join(self.state, name)
+        if present:
+            open(path, 'w').close()
+        elif os.path.exists(path):
+            os.unlink(path)
+
+    def connection(self, password=PASSWORD, **kwargs):
+        return SSHConnection('192.0.2.1', 'root', password, self.control_dir, connect_timeout=2, **kwargs)
+
+
+class SSHConnectionTest(FakeSSHTestCase):
+    def test_commands_reuse_the_control_master(self):
+        connection = self.connection()
+        outputs = [connection.run(f'echo {i}').stdout for i in range(3)]
+        self.assertEqual(outputs, ['0\n', '1\n', '2\n'])
+        self.assertEqual(self.events(), ['master', 'run echo 0', 'run echo 1', 'run echo 2'])
+        self.assertEqual(connection.connects, 1)
+        self.assertTrue(connection.connected())
+
+    def test_exit_status_of_the_command_is_returned(self):
+        result = self.connection().run('echo oops >&2; exit 3')
+        self.assertEqual((result.returncode, result.stderr), (3, 'oops\n'))
+
+    def test_reconnects_after_the_master_exits(self):
+        connection = self.connection()
+        connection.run('true')
+        os.unlink(connection.control_path)
+        self.assertFalse(connection.connected())
+        self.assertEqual(connection.run('echo again').stdout, 'again\n')
+        self.assertEqual(connection.connects, 2)
+        self.assertEqual(self.events().count('master'), 2)
+
+    def test_dead_master_is_torn_down_and_replaced(self):
+        connection = self.connection()
+        connection.run('true')
+        self.mark('master_dead')
+        with self.assertRaises(SSHError):
+            connection.run('true')
+        self.assertIn('exit', self.events())
+        self.assertFalse(connection.connected())
+        self.mark('master_dead', False)
+        self.assertEqual(connection.run('echo back').stdout, 'back\n')
+        self.assertEqual(connection.connects, 2)
+
+    def test_failed_connects_back_off_exponentially(self):
+        connection = self.connection(backoff=0.2, max_backoff=0.5)
+        self.mark('unreachable')
+        with self.assertRaisesRegex(SSHError, 'connect failed'):
+            connection.run('true')
+        # Within the backoff no connect is attempted
+        with self.assertRaisesRegex(SSHError, 'reconnecting in'):
+            connection.run('true')
+        self.assertEqual(self.events(), ['master'])
+
+        time.sleep(0.25)
+        with self.assertRaisesRegex(SSHError, 'connect failed'):
+            connection.run('true')
+        self.assertAlmostEqual(connection._retry_at - time.monotonic(), 0.4, delta=0.1)
+        self.assertEqual(connection.failures, 2)
+
+        time.sleep(0.45)
+        with self.assertRaises(SSHError):
+            connection.run('true')
+        # Capped at max_backoff
+        self.assertAlmostEqual(connection._retry_at - time.monotonic(), 0.5, delta=0.1)
+
+        self.mark('unreachable', False)
+        time.sleep(0.55)
+        self.assertEqual(connection.run('echo up').stdout, 'up\n')
+        self.assertEqual((connection.failures, connection.connects), (0, 1))
+
+    def test_wrong_password_fails_to_connect(self):
+        with self.assertRaisesRegex(SSHError, 'Permission denied'):
+            self.connection(password='wrong').run('true')
+
+    def test_command_timeout_keeps_the_session(self):
+        connection = self.connection()
+        connection.run('true')
+        started = time.monotonic()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            connection.run('sleep 5', timeout=0.3)
+        self.assertLess(time.monotonic() - started, 2.0)
+        self.assertTrue(connection.connected())
+        self.assertEqual(connection.run('echo still here').stdout, 'still here\n')
+        self.assertEqual(connection.connects, 1)
+
+
+class SSHPoolTest(FakeSSHTestCase):
+    def test_one_connection_per_user_and_host(self):
+        pool = SSHPool(connect_timeout=2)
+        try:
+            first = pool.get('192.0.2.1', 'root', PASSWORD)
+            self.assertIs(pool.get('192.0.2.1', 'root', PASSWORD), first)
+            self.assertIsNot(pool.get('192.0.2.2', 'root', PASSWORD), first)
+            self.assertIsNot(pool.get('192.0.2.1', 'admin', PASSWORD), first)
+        finally:
+            pool.close()
+
+    def test_render_and_close(self):
+        pool = SSHPool(connect_timeout=2)
+        connection = pool.get('192.0.2.1', 'root', PASSWORD)
+        connection.run('true')
+        lines = pool.render()
+        self.assertIn('esxi_ssh_connected{esxi_ip="192.0.2.1"} 1', lines)
+        self.assertIn('esxi_ssh_connects_total{esxi_ip="192.0.2.1"} 1', lines)
+        pool.close()
+        self.assertIn('exit', self.events())
+        self.assertFalse(os.path.exists(pool.control_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()